@@ -0,0 +1,210 @@
+import json
+import sqlite3
+import threading
+
+"""Persistent on-disk catalog for Image_Database.
+
+The catalog is a small SQLite file that holds one row per directory and one
+row per image. It lets the Manager skip the full filesystem walk at boot - the
+saved Image_Directory objects are rebuilt straight from the catalog, and only
+directories whose st_mtime has changed since the last save get re-listed.
+
+Writes are incremental. Image_Database keeps track of which directories were
+added, rescanned or removed since the last save, and only those rows are
+rewritten.
+
+Rows are never dropped just because a root is missing at boot. Each root
+remembers the id of the volume it was scanned from (see volumes.py), so the
+entries of an unplugged drive survive until it is plugged in again.
+
+The verified table records the (mtime, size) of each image that passed the
+integrity check (see integrity.py), so it is only checked again once it changes.
+
+The duplicate_dirs and duplicate_files tables hold the duplicate index (see
+duplicates.py), with the directory mtime each directory was indexed at.
+
+The play_state table keeps small bits of Manager state, such as where a shuffle
+is up to, as JSON values by name.
+"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS roots (
+    path        TEXT PRIMARY KEY,
+    volume      TEXT
+);
+CREATE TABLE IF NOT EXISTS directories (
+    path        TEXT PRIMARY KEY,
+    mtime       REAL,
+    children    TEXT,
+    reads_failed INTEGER
+);
+CREATE TABLE IF NOT EXISTS images (
+    dir         TEXT,
+    fname       TEXT,
+    date        REAL,
+    orientation INTEGER,
+    PRIMARY KEY (dir, fname)
+);
+CREATE TABLE IF NOT EXISTS failures (
+    path        TEXT PRIMARY KEY,
+    mtime       REAL,
+    size        INTEGER,
+    reason      TEXT
+);
+CREATE TABLE IF NOT EXISTS verified (
+    dir         TEXT,
+    fname       TEXT,
+    mtime       REAL,
+    size        INTEGER,
+    PRIMARY KEY (dir, fname)
+);
+CREATE TABLE IF NOT EXISTS duplicate_dirs (
+    path        TEXT PRIMARY KEY,
+    mtime       REAL
+);
+CREATE TABLE IF NOT EXISTS duplicate_files (
+    path        TEXT PRIMARY KEY,
+    dir         TEXT,
+    size        INTEGER,
+    mtime       REAL,
+    quick       BLOB,
+    full        BLOB
+);
+CREATE INDEX IF NOT EXISTS duplicate_files_dir ON duplicate_files (dir);
+CREATE TABLE IF NOT EXISTS play_state (
+    name        TEXT PRIMARY KEY,
+    value       TEXT
+);
+"""
+
+# Child paths are stored as a single text column, separated by a character that
+# cannot appear in a filename
+CHILD_SEP = "\0"
+
+
+class Catalog:
+    """Thin wrapper around the SQLite connection used to persist Image_Database.
+    All methods are safe to call from any thread."""
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(fname, check_same_thread=False)
+        # WAL journal keeps writes cheap and leaves a consistent file behind if
+        # the Pi loses power in the middle of a save
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        # Catalogs written before roots had a volume column
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(roots)")]
+        if 'volume' not in columns:
+            self.conn.execute("ALTER TABLE roots ADD COLUMN volume TEXT")
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def load_roots(self):
+        """Returns a dict of root path : volume id (None if not known)"""
+        with self.lock:
+            return {path : volume for path, volume in self.conn.execute("SELECT path, volume FROM roots")}
+
+    def load_directories(self):
+        """Returns a dict of path : (mtime, child_names, reads_failed, [(fname, date, orientation)])"""
+        with self.lock:
+            dirs = {}
+            for path, mtime, children, reads_failed in self.conn.execute(
+                    "SELECT path, mtime, children, reads_failed FROM directories"):
+                child_names = children.split(CHILD_SEP) if children else []
+                dirs[path] = (mtime, child_names, reads_failed, [])
+
+            for dir_path, fname, date, orientation in self.conn.execute(
+                    "SELECT dir, fname, date, orientation FROM images"):
+                if dir_path in dirs:
+                    # SQLite stores NaN as NULL
+                    dirs[dir_path][3].append((fname, float("nan") if date is None else date, orientation))
+            return dirs
+
+    def load_failures(self):
+        """Returns a list of (path, mtime, size, reason) of images that could 
+        not be opened"""
+        with self.lock:
+            return list(self.conn.execute("SELECT path, mtime, size, reason FROM failures"))
+
+    def save_failures(self, added, removed):
+        """Insert or replace the given (path, mtime, size, reason) rows, and
+        delete the rows of the removed paths"""
+        with self.lock, self.conn:
+            self.conn.executemany("DELETE FROM failures WHERE path = ?", [(p,) for p in removed])
+            self.conn.executemany("INSERT OR REPLACE INTO failures (path, mtime, size, reason) VALUES (?,?,?,?)",
+                added)
+
+    def load_verified(self, directory):
+        """Returns {fname : (mtime, size)} of the images in directory that passed
+        the integrity check"""
+        with self.lock:
+            return {fname : (mtime, size) for fname, mtime, size in self.conn.execute(
+                "SELECT fname, mtime, size FROM verified WHERE dir = ?", (directory,))}
+
+    def save_verified(self, directory, rows):
+        """Replace the verified images of a directory with the given 
+        (fname, mtime, size) rows"""
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM verified WHERE dir = ?", (directory,))
+            self.conn.executemany("INSERT INTO verified (dir, fname, mtime, size) VALUES (?,?,?,?)",
+                [(directory,) + tuple(row) for row in rows])
+
+    def load_duplicates(self):
+        """Returns ({directory : mtime}, [(path, size, mtime, quick, full)]) of
+        the duplicate index"""
+        with self.lock:
+            dirs = {path : mtime for path, mtime in self.conn.execute("SELECT path, mtime FROM duplicate_dirs")}
+            files = list(self.conn.execute("SELECT path, size, mtime, quick, full FROM duplicate_files"))
+            return dirs, files
+
+    def save_duplicates(self, changed, removed):
+        """Replace the duplicate index rows of the changed directories, given as
+        {directory : (mtime, [(path, size, mtime, quick, full)])}, and delete 
+        those of the removed directories"""
+        with self.lock, self.conn:
+            stale = [(d,) for d in list(changed) + list(removed)]
+            self.conn.executemany("DELETE FROM duplicate_dirs WHERE path = ?", stale)
+            self.conn.executemany("DELETE FROM duplicate_files WHERE dir = ?", stale)
+            self.conn.executemany("INSERT INTO duplicate_dirs (path, mtime) VALUES (?,?)",
+                [(d, mtime) for d, (mtime, rows) in changed.items() if mtime is not None])
+            self.conn.executemany("INSERT OR REPLACE INTO duplicate_files (path, dir, size, mtime, quick, full) VALUES (?,?,?,?,?,?)",
+                [(path, d, size, mtime, quick, full) for d, (dir_mtime, rows) in changed.items()
+                    for path, size, mtime, quick, full in rows])
+
+    def load_state(self):
+        """Returns the saved play state as a dict of name : value"""
+        with self.lock:
+            return {name : json.loads(value) for name, value in 
+                    self.conn.execute("SELECT name, value FROM play_state")}
+
+    def save_state(self, state):
+        """Insert or replace the given dict of name : JSON serialisable value"""
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO play_state (name, value) VALUES (?,?)",
+                [(name, json.dumps(value)) for name, value in state.items()])
+
+    def save(self, roots, changed, removed):
+        """Write back the given roots (dict of path : volume id), the rows of the changed Image_Directory
+        objects, and delete the rows of the removed directory paths. Done in a
+        single transaction."""
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM roots")
+            self.conn.executemany("INSERT INTO roots (path, volume) VALUES (?,?)", list(roots.items()))
+
+            stale = list(removed) + [img_dir.path for img_dir in changed]
+            self.conn.executemany("DELETE FROM directories WHERE path = ?", [(p,) for p in stale])
+            self.conn.executemany("DELETE FROM images WHERE dir = ?", [(p,) for p in stale])
+            self.conn.executemany("DELETE FROM verified WHERE dir = ?", [(p,) for p in removed])
+
+            self.conn.executemany(
+                "INSERT INTO directories (path, mtime, children, reads_failed) VALUES (?,?,?,?)",
+                [(d.path, d.mtime, CHILD_SEP.join(d.child_names), d.image_reads_failed) for d in changed])
+            self.conn.executemany(
+                "INSERT INTO images (dir, fname, date, orientation) VALUES (?,?,?,?)",
+                [(d.path, img.fname, None if img.date != img.date else img.date, img.orientation)
+                    for d in changed for img in d.images])
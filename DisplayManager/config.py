@@ -69,6 +69,20 @@ parse.add_argument(      "--display_x",     default=0, type=int, help="offset fr
 parse.add_argument(      "--display_y",     default=0, type=int, help="offset from top of screen (can be negative)")
 parse.add_argument(      "--display_w",     default=None, type=int, help="width of display surface (None will use max returned by hardware)")
 parse.add_argument(      "--display_h",     default=None, type=int, help="height of display surface")
+parse.add_argument(      "--scan_workers",  default=4, type=int, help="number of threads used to scan picture directories. Higher values help on slow USB or network drives")
+parse.add_argument(      "--compact_records", default=True, type=str_to_bool, help="store image records in compact arrays rather than lists of tuples. Saves memory on large libraries")
+parse.add_argument(      "--poll_tm",       default=3600.0, type=float, help="time in seconds between polling picture roots inotify does not cover (network and FUSE mounts, or all roots without inotify) for changes. Other roots are not polled. 0 disables")
+parse.add_argument(      "--skip_duplicates", default=True, type=str_to_bool, help="find copies of the same picture across the picture directories and only play one of them")
+parse.add_argument(      "--snapshot",      default="picframe_catalog.snap", help="memory mapped copy of the image database written after rescans, for near instant startup. Empty to disable")
+parse.add_argument(      "--prefetch_depth", default=3, type=int, help="number of upcoming pictures kept decoded and ready to display")
+parse.add_argument(      "--prefetch_workers", default=2, type=int, help="threads decoding and resizing upcoming pictures")
+parse.add_argument(      "--verify_library", default=True, type=str_to_bool, help="check the pictures for corrupt files in the background, so they are skipped rather than found mid slideshow")
+parse.add_argument(      "--schedule",      default="picframe.schedule", help="file of calendar rules choosing which pictures to play on which days. Empty to disable")
+parse.add_argument(      "--history_size",  default=100, type=int, help="number of pictures remembered for going back")
+parse.add_argument(      "--image_cache_mb", default=64, type=int, help="memory for keeping pictures ready to show again when going back and forward")
+parse.add_argument(      "--warm_start",    default="picframe_warm", help="folder where the pictures on screen and next in line are kept over a restart, so the slideshow carries on at once. Empty to disable")
+parse.add_argument(      "--warm_start_images", default=3, type=int, help="number of those pictures saved ready to show, the others are decoded again")
+parse.add_argument(      "--catalog",       default="picframe_catalog.db", help="file used to save the image database between runs so the picture directories don't need a full rescan on startup")
 args = parse.parse_args()
 print(args.display_x)
 
@@ -114,6 +128,20 @@ DISPLAY_X = args.display_x
 DISPLAY_Y = args.display_y
 DISPLAY_W = args.display_w
 DISPLAY_H = args.display_h
+SCAN_WORKERS = args.scan_workers
+CATALOG_PATH = args.catalog
+COMPACT_RECORDS = args.compact_records
+POLL_TM = args.poll_tm
+SKIP_DUPLICATES = args.skip_duplicates
+SNAPSHOT_PATH = args.snapshot
+PREFETCH_DEPTH = args.prefetch_depth
+PREFETCH_WORKERS = args.prefetch_workers
+VERIFY_LIBRARY = args.verify_library
+SCHEDULE_PATH = args.schedule
+HISTORY_SIZE = args.history_size
+IMAGE_CACHE_MB = args.image_cache_mb
+WARM_START_PATH = args.warm_start
+WARM_START_IMAGES = args.warm_start_images
 
 
 CODEPOINTS = '1234567890AÄÀBCÇDÈÉÊEFGHIÍJKLMNÑOÓÖPQRSTUÚÙÜVWXYZ., _-/abcdefghijklmnñopqrstuvwxyzáéèêàçíóúäöüß' # limit to 49 ie 7x7 grid_size
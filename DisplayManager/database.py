@@ -5,8 +5,24 @@ import math
 import numpy as np 
 
 import os
+import io
+import random
+import bisect
+import itertools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from PIL import Image, ExifTags, ImageFilter # these are needed for getting exif data from images
 from collections import namedtuple
+from array import array
+
+from catalog import Catalog
+import snapshot
+from date_index import Date_Index, IDX_BITS, IDX_MASK
+from duplicates import Duplicate_Index
+from failures import Failure_Cache
+from exif import read_exif
+from volumes import get_volume_id
 
 
 """
@@ -42,7 +58,8 @@ Where (Image Tuple) = (Filename, Rotation, Date, etc) (Maybe a named tuple)
 * Within a playlist, can sort Image tuples according to filename, date, or randomize
 * Completely randomize images = randomly select playlist, randomly select image.
   
-TODO - See if I can implement iterator(s) for Image_Database object
+Image_Database provides lazy iterators in tree, date and random order (see 
+ITERATORS below).
 """
 
 # Global variables to make handling exif data easier
@@ -54,6 +71,24 @@ for k in ExifTags.TAGS:
   elif ExifTags.TAGS[k] == 'Orientation':
     EXIF_ORIENTATION = k
 
+# Orientation value of a placeholder Img_Tup whose EXIF data hasn't been read
+# yet (see enrich.py). Valid EXIF orientations are 1-8; a corrupt tag can hold
+# anything, 0 included, so the placeholder is a value no tag is stored as.
+ORIENTATION_PENDING = -1
+
+def valid_orientation(orientation):
+    """orientation, or 1 (no rotation) if it isn't a valid EXIF orientation or
+    ORIENTATION_PENDING - e.g. a corrupt tag. Image_List keeps orientations
+    in a signed char array, which can't hold just any value."""
+    if orientation == ORIENTATION_PENDING or 1 <= orientation <= 8:
+        return orientation
+    return 1
+
+# Aggregate values for a directory subtree. Empty date ranges use +/-inf so that 
+# min/max comparisons work without special cases.
+Tree_Stats = namedtuple("Tree_Stats", ['pics', 'folders', 'date_sum', 'date_n', 'date_min', 'date_max'])
+EMPTY_STATS = Tree_Stats(0, 0, 0.0, 0, float("inf"), float("-inf"))
+
 def isnan(num):
     """If an item does not equal itself, then it is a NaN"""
     return num != num
@@ -62,19 +97,87 @@ def list_subdirs(path):
     """Returns a list of full paths to all subdirectories in the given path"""
     return [os.path.join(path,d) for d in os.listdir(path) if os.path.isdir(os.path.join(path, d))]
 
+IMAGE_EXTENSIONS = ('.png','.jpg','.jpeg','.heif','.heic')
+
 def list_images(path):
     """Return a list of filenames for all images in the given directory."""
 
-    extensions = ['.png','.jpg','.jpeg','.heif','.heic']
-    
     files = os.listdir(path)
     pics = []
     for filename in files:
         ext = os.path.splitext(filename)[1].lower()
-        if ext in extensions and not filename.startswith('.'):
+        if ext in IMAGE_EXTENSIONS and not filename.startswith('.'):
             pics.append(filename)
     return pics
 
+def scan_directory(path):
+    """Read a directory in a single pass. Returns (mtime, subdirs, image names)
+    where subdirs are full paths. Uses the file type cached in each DirEntry, 
+    so no extra stat() is needed per entry. Symlinks to directories aren't
+    followed (like os.walk), so a link loop can't make the scan run forever."""
+    # Read mtime before listing so a change during the listing is not missed
+    mtime = os.stat(path).st_mtime
+    subdirs = []
+    pics = []
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                    continue
+            except OSError:
+                continue
+            ext = os.path.splitext(entry.name)[1].lower()
+            if ext in IMAGE_EXTENSIONS and not entry.name.startswith('.'):
+                pics.append(entry.name)
+    subdirs.sort(key=lambda x: x.lower())
+    return mtime, subdirs, pics
+
+def position_after(n, name_at, name):
+    """Index of the first of n names, sorted case insensitively, that comes 
+    after name. name_at(i) returns the i-th name. name doesn't have to be one
+    of them (e.g. a directory that was removed). O(log n)."""
+    key = name.lower()
+    lo, hi = 0, n
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if name_at(mid).lower() < key:
+            lo = mid + 1
+        else:
+            hi = mid
+    # Names that differ from name only in case are in scan order
+    for i in range(lo, n):
+        other = name_at(i)
+        if other.lower() != key:
+            break
+        if other == name:
+            return i + 1
+    return lo
+
+def scan_tree(root_dir, workers=None):
+    """Generator that scans root_dir and all directories below it, yielding an
+    Image_Directory for each one as soon as it is ready. Subtrees are spread
+    over a bounded thread pool, which hides most of the latency of slow USB 
+    and network mounts. Directories that cannot be read are logged and skipped."""
+    if workers is None:
+        workers = config.SCAN_WORKERS
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {pool.submit(Image_Directory, os.path.abspath(root_dir))}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                try:
+                    img_dir = fut.result()
+                except Exception as e:
+                    # Only this directory (and its subtree) is lost - one bad
+                    # file mustn't end the scan of the whole root
+                    logging.error("Could not scan directory: {}".format(e))
+                    continue
+                for child in img_dir.child_names:
+                    pending.add(pool.submit(Image_Directory, child))
+                yield img_dir
+
 
 class Image_Database(dict):
     """Main data structure to hold all information relating to available images
@@ -85,110 +188,948 @@ class Image_Database(dict):
     external storage directory, directory tied to cloud storage, etc)"""
 
     def __init__(self):
+        super().__init__()
         self.roots = []
 
-    def add_directory(self, directory):
+        # Root path : id of the volume it was scanned from (see volumes.py).
+        # Roots whose volume is not mounted are offline - their entries are
+        # kept, but they are not played, polled or rescanned until it returns.
+        self.volumes = {}
+        self.offline = set()
+
+        # Directory paths that were added/rescanned or removed since the last
+        # save. Lets save_database() write back only the rows that changed.
+        self.changed = set()
+        self.removed = set()
+
+        # Held by anything that modifies the database from a background thread
+        self.lock = threading.RLock()
+
+        # Each directory path gets a small integer id, kept for the lifetime of
+        # the database (also if the directory is removed and comes back)
+        self.dir_ids = {}
+        self.dir_paths = []
+
+        # Sorted (date, dir id, image index) entries for all dated images
+        self.date_index = Date_Index()
+
+        # Incremented whenever directories are added or removed
+        self.version = 0
+
+        # Groups of identical image files, filled in by a duplicates.Duplicate_Finder
+        self.duplicates = Duplicate_Index()
+
+        # Image files that could not be opened, skipped until they change
+        self.failures = Failure_Cache()
+
+        # Called with a directory path (under self.lock) whenever a directory
+        # is added, replaced, removed, or its root goes offline or comes back
+        self.on_directory_change = None
+
+    def add_directory(self, directory, known_images=None):
         """Given a full directory path, create a new Image_Directory object 
         and add it to the dict. If a directory has no images, Image_Directory 
-        object will have a zero length images list"""
+        object will have a zero length images list. known_images is an optional
+        dict of {filename : Img_Tup} whose metadata can be reused."""
 
         # Make sure we have been given a real directory
         if os.path.isdir(directory):
-            img_dir = Image_Directory(os.path.abspath(directory))
+            # To ensure that all keys are unique, use the full path as the key
+            directory = os.path.abspath(directory)
+            img_dir = Image_Directory(directory, known_images)
 
             # Only add the directory to the database if it has images in it (???)
             #if img_dir.images_present:
 
-            # To ensure that all keys are unique, use the full path as the key
-            self.__setitem__(directory, img_dir)
+            self.insert_directory(img_dir)
         else:
             #TODO - Work on better error handling than this
             raise ValueError("Not a directory: " + directory)
 
+    def insert_directory(self, img_dir):
+        """Add an already built Image_Directory object to the dict"""
+        with self.lock:
+            dir_id = self.get_dir_id(img_dir.path)
+            old = self.get(img_dir.path)
+            if old is not None:
+                self.date_index.remove_directory(dir_id, old.images)
+            self.date_index.add_directory(dir_id, img_dir.images)
+
+            self.__setitem__(img_dir.path, img_dir)
+            self.changed.add(img_dir.path)
+            self.removed.discard(img_dir.path)
+            self.version += 1
+
+            before = old.subtree_stats() if old is not None else EMPTY_STATS
+            self.update_aggregates(img_dir, before)
+            self.count_failures(img_dir)
+            if self.on_directory_change is not None:
+                self.on_directory_change(img_dir.path)
+
+    def count_failures(self, img_dir):
+        """Set image_reads_failed of a directory from the failure cache. Failures
+        of images no longer in the directory are forgotten."""
+        failed = self.failures.in_directory(img_dir.path)
+        if failed:
+            names = set(img.fname for img in img_dir.images)
+            for path in list(failed):
+                if os.path.basename(path) not in names:
+                    self.failures.discard(path)
+        img_dir.image_reads_failed = len(self.failures.in_directory(img_dir.path))
+
+    def add_failure(self, path, reason):
+        """Record that the image at path could not be opened, so play methods
+        skip it until the file changes"""
+        with self.lock:
+            if self.failures.add(path, reason):
+                logging.warning("Skipping {} until it changes: {}".format(path, reason))
+            self.recount_failures(os.path.dirname(path))
+
+    def is_failed(self, path):
+        """True if the image at path failed to open before and hasn't changed
+        since. A file that did change is dropped from the cache for another try."""
+        if path not in self.failures:
+            return False
+        if self.failures.is_bad(path):
+            return True
+        with self.lock:
+            self.failures.discard(path)
+            self.recount_failures(os.path.dirname(path))
+        return False
+
+    def recount_failures(self, directory):
+        """Update image_reads_failed of a directory after a failure was added
+        or dropped"""
+        img_dir = self.get(directory)
+        if img_dir is not None:
+            img_dir.image_reads_failed = len(self.failures.in_directory(directory))
+            if self.on_directory_change is not None:
+                self.on_directory_change(directory)
+
+    def get_dir_id(self, path):
+        """Returns the integer id of a directory path, assigning one if needed"""
+        dir_id = self.dir_ids.get(path)
+        if dir_id is None:
+            dir_id = len(self.dir_paths)
+            self.dir_paths.append(path)
+            self.dir_ids[path] = dir_id
+        return dir_id
+
+    def update_image(self, img_dir, idx, date, orientation):
+        """Replace the date and orientation of an image, e.g. once its EXIF 
+        data has been read in the background"""
+        with self.lock:
+            img = img_dir.images[idx]
+            # The EXIF data has been read, so the image isn't pending any more
+            # whatever the tag held
+            if orientation == ORIENTATION_PENDING:
+                orientation = 1
+            orientation = valid_orientation(orientation)
+            img_dir.images[idx] = Img_Tup(img.fname, date, orientation)
+            if img.orientation == ORIENTATION_PENDING and orientation != ORIENTATION_PENDING:
+                img_dir.exif_pending -= 1
+            if self.get(img_dir.path) is img_dir:
+                self.changed.add(img_dir.path)
+                if not (date == img.date or (isnan(date) and isnan(img.date))):
+                    dir_id = self.dir_ids[img_dir.path]
+                    self.date_index.remove(img.date, dir_id, idx)
+                    self.date_index.add(date, dir_id, idx)
+
+    def update_date_score(self, img_dir):
+        """Recompute the date score of a directory after its image dates changed"""
+        with self.lock:
+            before = img_dir.subtree_stats()
+            img_dir.compute_date_stats()
+            if self.get(img_dir.path) is img_dir:
+                self.update_aggregates(img_dir, before)
+
+    def update_aggregates(self, img_dir, before):
+        """Recompute the subtree aggregates of img_dir from its own images and
+        its children, then pass the difference on to its ancestors. before is
+        what the node (or the node it replaced) contributed until now."""
+        self.sum_children(img_dir)
+        if self.is_linked(img_dir.path):
+            self.propagate(img_dir.parent_name, before, img_dir.subtree_stats())
+
+    def is_linked(self, path):
+        """True if the parent of path is in the database and lists path as a 
+        child, i.e. the parent's aggregates include this subtree"""
+        parent = self.get(os.path.dirname(path))
+        return parent is not None and path in parent.child_names
+
+    def sum_children(self, img_dir):
+        """Set the subtree aggregates of img_dir from scratch. O(children)"""
+        pics, folders, date_sum, date_n, date_min, date_max = img_dir.own_stats()
+        for child in img_dir.child_names:
+            sub = self.get(child)
+            if sub is not None:
+                pics += sub.sub_pics
+                folders += sub.sub_folders
+                date_sum += sub.sub_date_sum
+                date_n += sub.sub_date_n
+                date_min = min(date_min, sub.sub_date_min)
+                date_max = max(date_max, sub.sub_date_max)
+        img_dir.set_subtree_stats(Tree_Stats(pics, folders, date_sum, date_n, date_min, date_max))
+
+    def propagate(self, path, before, after):
+        """Apply the change of a child subtree from before to after to the 
+        directory at path and its ancestors. O(depth), except where the child 
+        held the min/max date of an ancestor and that value went away."""
+        while before != after:
+            node = self.get(path)
+            if node is None:
+                return
+            node_before = node.subtree_stats()
+
+            if ((before.date_min == node.sub_date_min and after.date_min > before.date_min) or
+                    (before.date_max == node.sub_date_max and after.date_max < before.date_max)):
+                self.sum_children(node)
+            else:
+                node.set_subtree_stats(Tree_Stats(
+                    node.sub_pics + after.pics - before.pics,
+                    node.sub_folders + after.folders - before.folders,
+                    node.sub_date_sum + after.date_sum - before.date_sum,
+                    node.sub_date_n + after.date_n - before.date_n,
+                    min(node.sub_date_min, after.date_min),
+                    max(node.sub_date_max, after.date_max)))
+
+            before, after = node_before, node.subtree_stats()
+            path = node.parent_name
+
+    def add_tree(self, root_dir):
+        """Add root_dir and every directory below it to the database"""
+        for img_dir in scan_tree(root_dir):
+            self.insert_directory(img_dir)
+
     def remove_directory(self, directory):
         """Remove the given directory and all child directories from the database"""
-        pass
+        directory = os.path.abspath(directory)
+        if directory not in self:
+            return
+
+        with self.lock:
+            # Unlink from the parent so tree traversals don't hit a missing key
+            top = self.__getitem__(directory)
+            if self.is_linked(directory):
+                parent = self.__getitem__(top.parent_name)
+                parent.child_names.remove(directory)
+                self.changed.add(parent.path)
+                self.propagate(parent.path, top.subtree_stats(), EMPTY_STATS)
+
+            stack = [directory]
+            dir_ids = []
+            while stack:
+                img_dir = self.pop(stack.pop(), None)
+                if img_dir is not None:
+                    self.version += 1
+                    dir_ids.append(self.dir_ids[img_dir.path])
+                    stack.extend(img_dir.child_names)
+                    self.changed.discard(img_dir.path)
+                    self.removed.add(img_dir.path)
+                    if self.on_directory_change is not None:
+                        self.on_directory_change(img_dir.path)
+            # A single pass over the date index for the whole subtree
+            self.date_index.remove_directories(dir_ids)
+
+    def rescan_directory(self, directory):
+        """Re-list a directory that has changed on disk. Metadata of images that
+        are still present is reused. New subdirectories are added with their
+        whole subtree, and subdirectories that disappeared are removed."""
+        directory = os.path.abspath(directory)
+        old = self.get(directory)
+        if not os.path.isdir(directory):
+            if not self.volume_lost(directory):
+                self.remove_directory(directory)
+            return
+
+        known = {img.fname : img for img in old.images} if old is not None else None
+        self.add_directory(directory, known)
+
+        new_children = set(self.__getitem__(directory).child_names)
+        if old is not None:
+            for child in old.child_names:
+                if child not in new_children:
+                    self.remove_directory(child)
+        for child in self.__getitem__(directory).child_names:
+            if child not in self:
+                self.add_tree(child)
+
+    def refresh(self, roots=None):
+        """Bring the database up to date with the filesystem. Only directories 
+        whose st_mtime changed since they were last listed are rescanned - all 
+        others only cost a single stat() call. Covers the given roots, or all
+        roots that are online. Returns the number of directories that were
+        rescanned."""
+        n_rescanned = 0
+        if roots is None:
+            roots = [r for r in self.roots if r not in self.offline]
+        stack = [r for r in roots if r in self]
+        while stack:
+            directory = stack.pop()
+            img_dir = self.get(directory)
+            if img_dir is None:
+                # Listed by its parent but never scanned, e.g. the catalog was
+                # saved part way through the first scan
+                if os.path.isdir(directory):
+                    self.add_tree(directory)
+                    n_rescanned += 1
+                continue
+            try:
+                mtime = os.stat(directory).st_mtime
+            except OSError:
+                if self.volume_lost(directory):
+                    continue
+                self.remove_directory(directory)
+                continue
+
+            if mtime != img_dir.mtime:
+                self.rescan_directory(directory)
+                n_rescanned += 1
+            stack.extend(self.__getitem__(directory).child_names if directory in self else [])
+
+        return n_rescanned
+
+    def is_online(self, path):
+        """False if path lies under a root whose volume is not mounted"""
+        for root in self.offline:
+            if path == root or path.startswith(root + os.sep):
+                return False
+        return True
+
+    def root_of(self, path):
+        for root in self.roots:
+            if path == root or path.startswith(root + os.sep):
+                return root
+        return None
+
+    def volume_lost(self, path):
+        """Called when path has gone missing. If that is because its whole
+        root is unavailable (drive unplugged), the root is set offline and True
+        is returned - the entries must be kept, not removed."""
+        root = self.root_of(path)
+        if root is None:
+            return False
+        if root in self.offline:
+            return True
+        if not self.root_available(root):
+            self.set_offline(root)
+            return True
+        return False
+
+    def root_available(self, root):
+        """True if root can be scanned: it exists, and is either on the volume
+        it was catalogued from or on another removable volume (a different
+        drive plugged in in its place). A bare mount point directory left behind
+        on the system volume does not count."""
+        volume = get_volume_id(root)
+        if volume is None:
+            return False
+        expected = self.volumes.get(root)
+        return expected is None or volume == expected or volume != get_volume_id(os.sep)
+
+    def set_offline(self, root):
+        with self.lock:
+            if root not in self.offline:
+                self.offline.add(root)
+                self.version += 1
+                self.notify_subtree(root)
+                logging.warning("Picture root {} is not available. Keeping its {} cataloged pictures "
+                    "until it returns.".format(root, self[root].sub_pics if root in self else 0))
+
+    def check_volumes(self):
+        """Update the online/offline state of every root. Cheap - a stat() and
+        a read of /proc/self/mounts per root. Returns the roots that came back
+        online; they need a call to revalidate_root()."""
+        returned = []
+        for root in list(self.roots):
+            if not self.root_available(root):
+                self.set_offline(root)
+            elif root in self.offline:
+                returned.append(root)
+        return returned
+
+    def revalidate_root(self, root):
+        """Bring a root that is (back) online up to date. If it is on the same
+        volume as before, only directories whose mtime changed are re-listed.
+        A different volume, or a root never scanned before, is scanned in full.
+        Returns the number of directories that were (re)scanned."""
+        volume = get_volume_id(root)
+        if volume is None:
+            self.set_offline(root)
+            return 0
+
+        if root in self and self.volumes.get(root) in (None, volume):
+            n_rescanned = self.refresh([root])
+        else:
+            if root in self:
+                logging.info("Picture root {} is on a different volume ({}) than cataloged. "
+                    "Scanning it from scratch.".format(root, volume))
+                self.remove_directory(root)
+            self.add_tree(root)
+            n_rescanned = self.__getitem__(root).sub_folders if root in self else 0
+
+        with self.lock:
+            self.volumes[root] = volume
+            if root in self.offline:
+                self.offline.discard(root)
+                self.version += 1
+                self.notify_subtree(root)
+        return n_rescanned
+
+    def notify_subtree(self, directory):
+        """Call on_directory_change for directory and everything below it"""
+        if self.on_directory_change is None:
+            return
+        stack = [directory]
+        while stack:
+            img_dir = self.get(stack.pop())
+            if img_dir is not None:
+                self.on_directory_change(img_dir.path)
+                stack.extend(img_dir.child_names)
 
     def load_database(self, fname):
-        """Load a database from a file."""
+        """Load a database from a catalog file. Call refresh() afterwards to 
+        pick up any changes made while the catalog was not being updated."""
+        cat = Catalog(fname)
+        try:
+            self.volumes = cat.load_roots()
+            self.roots = list(self.volumes)
+            self.failures.load(cat.load_failures())
+            self.duplicates.load(*cat.load_duplicates())
+            for path, (mtime, child_names, reads_failed, images) in cat.load_directories().items():
+                self.insert_directory(Image_Directory.from_catalog(path, mtime, 
+                    child_names, reads_failed, images))
+        finally:
+            cat.close()
+
+        self.changed.clear()
+        self.removed.clear()
+
+    def save_database(self, fname):
+        """Save the database to a catalog file. Only the directories that were
+        added, rescanned or removed since the last save are written. Returns 
+        the number of directories written."""
+        with self.lock:
+            changed = [self.__getitem__(p) for p in self.changed if p in self]
+            removed = self.removed
+            self.changed = set()
+            self.removed = set()
+
+        failed, recovered = self.failures.take_changes()
+        dups_changed, dups_removed = self.duplicates.take_changes()
+
+        cat = Catalog(fname)
+        try:
+            cat.save({r : self.volumes.get(r) for r in self.roots}, changed, removed)
+            cat.save_failures(failed, recovered)
+            cat.save_duplicates(dups_changed, dups_removed)
+        finally:
+            cat.close()
+        return len(changed) + len(removed)
+
+    def load_failures(self, fname):
+        """Load just the failure cache from a catalog file, e.g. after 
+        load_snapshot()"""
+        cat = Catalog(fname)
+        try:
+            self.failures.load(cat.load_failures())
+        finally:
+            cat.close()
+        with self.lock:
+            for img_dir in self.values():
+                img_dir.image_reads_failed = len(self.failures.in_directory(img_dir.path))
+
+    def load_duplicates(self, fname):
+        """Load just the duplicate index from a catalog file, e.g. after 
+        load_snapshot()"""
+        cat = Catalog(fname)
+        try:
+            self.duplicates.load(*cat.load_duplicates())
+        finally:
+            cat.close()
+
+    def load_snapshot(self, fname):
+        """Load the database from a snapshot file (see snapshot.py). Only the
+        directory paths are decoded up front - each directory's record is read
+        from the mapped file as its node is built, image lists stay there until
+        used, and the date index until it changes. Raises ValueError or 
+        OSError, without changing the database, if the file can't be used."""
+        snap = snapshot.Snapshot(fname)
+        paths = snap.dir_paths()
+
+        with self.lock:
+            self.volumes = snap.meta['roots']
+            self.roots = list(self.volumes)
+            # Directory ids are the record numbers, so the saved date index keys
+            # can be used as they are
+            self.dir_paths = paths
+            self.dir_ids = {path : i for i, path in enumerate(paths)}
+            for i, path in enumerate(paths):
+                rec = snap.dirs[i].item()
+                child_names = [paths[c] for c in snap.child_records(rec)]
+                self.__setitem__(path, Image_Directory.from_snapshot(path, rec, child_names, snap))
+
+            self.date_index = Date_Index(snap.dates, snap.keys)
+            self.version += 1
+            self.changed.clear()
+            self.removed.clear()
+
+    def save_snapshot(self, fname):
+        """Write the whole database to a new snapshot file, atomically replacing
+        any previous one"""
+        # Only a copy of the state is taken under the lock - a shallow copy of
+        # each directory and a copy of the date index arrays. Packing and
+        # writing (an fsync on the SD card can take a while) happen outside it.
+        with self.lock:
+            directories = [img_dir.frozen_copy() for img_dir in self.values()]
+            roots = {r : self.volumes.get(r) for r in self.roots}
+            dir_paths = list(self.dir_paths)
+            self.date_index.flush()
+            dates = np.array(self.date_index.dates, dtype='<f8')
+            keys = np.array(self.date_index.keys, dtype='<u8')
+
+        records = {img_dir.path : i for i, img_dir in enumerate(directories)}
+        # Date index keys are rewritten from directory ids to record numbers
+        to_record = np.array([records.get(p, 0) for p in dir_paths], dtype='<u8')
+        dir_ids = (keys >> np.uint64(IDX_BITS)).astype(np.intp)
+        keys = (to_record[dir_ids] << np.uint64(IDX_BITS)) | (keys & np.uint64(IDX_MASK))
+        parts = snapshot.pack(roots, directories, records, dates, keys)
+        snapshot.write(fname, parts)
+
+    # *************** ITERATORS *********************************************
+    # All iterators are lazy and yield (Image_Directory, image index) pairs - 
+    # the image itself is img_dir.images[idx]. They look directories up by path 
+    # as they go, so they keep working while the database is being updated.
+
+    def iter_tree(self, root=None, include=None):
+        """Depth first, alphabetical order: the images of a directory, then each
+        of its subdirectories in turn. Starts at root, or covers every root.
+        include is an optional function of a directory path; directories for
+        which it returns False are skipped (their subdirectories are not)."""
+        stack = list(reversed(self.roots if root is None else [root]))
+        while stack:
+            img_dir = self.get(stack.pop())
+            if img_dir is None:
+                continue
+            if include is None or include(img_dir.path):
+                idx = 0
+                while idx < len(img_dir.images):
+                    yield img_dir, idx
+                    idx += 1
+            stack.extend(reversed(img_dir.child_names))
+
+    def iter_tree_from(self, path, fname=None, include=None):
+        """Carries on the order of iter_tree() after the image fname in the
+        directory path - e.g. a position saved before a reboot. Either may have
+        been removed since; play then continues from where they were in the
+        order. Getting started costs a binary search per level of path, and 
+        directories are looked up one at a time as the walk goes on, so changes
+        to the tree while iterating are picked up."""
+        path = os.path.abspath(path)
+        lineage = [path]
+        while lineage[-1] not in self.roots:
+            parent = os.path.dirname(lineage[-1])
+            if parent == lineage[-1]:
+                # Not under any root (any more)
+                yield from self.iter_tree(include=include)
+                return
+            lineage.append(parent)
+        lineage.reverse()
+
+        # Each frame is [directory path, child played last, index of that 
+        # child when it was played]. The top frame (directory None) is the list
+        # of roots. The index is used as is unless the children have changed.
+        frames = [[None, lineage[0], -1]] + [[lineage[i], lineage[i+1], -1] for i in range(len(lineage)-1)]
+        img_dir = self.get(path)
+        if img_dir is not None:
+            frames.append([path, None, -1])
+            if include is None or include(path):
+                with self.lock:
+                    idx = 0 if fname is None else position_after(len(img_dir.images), 
+                        lambda i: img_dir.images[i].fname, fname)
+                while idx < len(img_dir.images):
+                    yield img_dir, idx
+                    idx += 1
+
+        while frames:
+            frame = frames[-1]
+            with self.lock:
+                if frame[0] is None:
+                    names = self.roots
+                    idx = self.roots.index(frame[1]) + 1 if frame[1] in self.roots else 0
+                else:
+                    parent = self.get(frame[0])
+                    if parent is None:
+                        frames.pop()
+                        continue
+                    names = parent.child_names
+                    if frame[1] is None:
+                        idx = 0
+                    elif 0 <= frame[2] < len(names) and names[frame[2]] == frame[1]:
+                        idx = frame[2] + 1
+                    else:
+                        idx = position_after(len(names), names.__getitem__, frame[1])
+                if idx >= len(names):
+                    frames.pop()
+                    continue
+                frame[1], frame[2] = names[idx], idx
+                img_dir = self.get(frame[1])
+            if img_dir is None:
+                continue
+            frames.append([img_dir.path, None, -1])
+            if include is None or include(img_dir.path):
+                idx = 0
+                while idx < len(img_dir.images):
+                    yield img_dir, idx
+                    idx += 1
+
+    def iter_by_date(self, dt_from=None, dt_to=None):
+        """Images in order of their date (seconds since epoch), optionally 
+        limited to dt_from <= date < dt_to. Images without a date are not 
+        included."""
+        last = None
+        while True:
+            with self.lock:
+                index = self.date_index
+                lo, hi = index.range(dt_from, dt_to)
+                pos = lo if last is None else max(lo, index.position_after(*last))
+                if pos >= hi:
+                    return
+                date, dir_id, idx = index[pos]
+                last = (date, index.keys[pos])
+                img_dir = self.get(self.dir_paths[dir_id])
+            if img_dir is not None:
+                yield img_dir, idx
+
+    def iter_random(self, include=None):
+        """Endless stream of images picked uniformly at random (with replacement)
+        from all images in the database. include works as for iter_tree. The 
+        directory weights are only rebuilt when directories are added/removed."""
+        version = None
+        while True:
+            with self.lock:
+                if version != self.version:
+                    version = self.version
+                    paths = [p for p in self.keys() if include is None or include(p)]
+                    cumdist = list(itertools.accumulate(len(self.__getitem__(p).images) for p in paths))
+                if not cumdist or cumdist[-1] == 0:
+                    return
+                img_dir = self.get(paths[bisect.bisect(cumdist, random.random() * cumdist[-1])])
+            if img_dir is not None and len(img_dir.images) > 0:
+                yield img_dir, random.randrange(len(img_dir.images))
+
+    # *************** END ITERATORS *****************************************
 
     def __repr__(self):
-        rep = "============ Image Database ============\n"
-        rep += "- Number of roots in db: {}\n".format(len(self.roots))
-        rep += "- Folders in db: {}\n\n".format(self.__len__())
+        rep = io.StringIO()
+        self.dump(rep)
+        return rep.getvalue()
+
+    def summary(self):
+        """Database and per root totals, without the directory tree"""
+        rep = io.StringIO()
+        self.dump(rep, tree=False)
+        return rep.getvalue()
+
+    def dump(self, f, tree=True):
+        """Write a description of the database to the file-like object f, 
+        including the whole directory tree if tree is True. Written line by 
+        line rather than built up as one big string."""
+        f.write("============ Image Database ============\n")
+        f.write("- Number of roots in db: {}\n".format(len(self.roots)))
+        f.write("- Folders in db: {}\n\n".format(self.__len__()))
 
         for i in range(len(self.roots)):
             root = self.roots[i]
-            rep += "Root {} at: {}\n".format(i+1, self.__getitem__(root).path)
+            if root not in self:
+                f.write("Root {} at: {} (not loaded)\n".format(i+1, root))
+                continue
+            f.write("Root {} at: {}{}\n".format(i+1, self.__getitem__(root).path,
+                " (offline)" if root in self.offline else ""))
             num_pics, num_folders = self.stats(root)
-            rep += "Num folders: {}, Num Pictures: {}\n".format(num_folders,num_pics)
-            rep += ("-"*30 + "\n")
-            rep += self.repr(root, level=0)
+            f.write("Num folders: {}, Num Pictures: {}\n".format(num_folders,num_pics))
+            if tree:
+                f.write("-"*30 + "\n")
+                self.dump_tree(f, root)
 
             if i != (len(self.roots)-1):
-                rep += "\n\n"
+                f.write("\n\n")
 
-        rep += "="*40
-        return rep
+        f.write("="*40)
 
-    def repr(self, dir_name, level):
-        """Recursive representation function to support __repr__"""
-        rep = "   "*level
-        rep += (self.__getitem__(dir_name).__repr__() + "\n")
-        for sub in self.__getitem__(dir_name).child_names:
-            rep += self.repr(sub, level+1)
-        return rep
+    def dump_tree(self, f, dir_name):
+        """Write one line per directory below dir_name, indented by depth.
+        Uses an explicit stack, so deep trees can't hit the recursion limit."""
+        stack = [(dir_name, 0)]
+        while stack:
+            path, level = stack.pop()
+            img_dir = self.get(path)
+            if img_dir is None:
+                continue
+            f.write("   "*level + img_dir.__repr__() + "\n")
+            stack.extend((sub, level+1) for sub in reversed(img_dir.child_names))
 
     def stats(self, dir_name):
-        """Recursively traverse tree to get basic stats"""
-        num_pics = len(self.__getitem__(dir_name).images)
-        num_folders = 1
-        for sub in self.__getitem__(dir_name).child_names:
-            np, nf = self.stats(sub)
-            num_pics += np
-            num_folders += nf
-        
-        return num_pics, num_folders
+        """Returns (number of pictures, number of folders) in the subtree at 
+        dir_name. O(1) - the totals are kept up to date as directories change."""
+        img_dir = self.__getitem__(dir_name)
+        return img_dir.sub_pics, img_dir.sub_folders
+
+    def date_stats(self, dir_name):
+        """Returns (earliest, latest, mean) image date in the subtree at dir_name,
+        NaN if no image has a date"""
+        img_dir = self.__getitem__(dir_name)
+        if img_dir.sub_date_n == 0:
+            return float("nan"), float("nan"), float("nan")
+        return img_dir.sub_date_min, img_dir.sub_date_max, img_dir.sub_date_sum/img_dir.sub_date_n
 
 
 Img_Tup = namedtuple("Img_Tup", ['fname', 'date', 'orientation'])
 
+
+class String_Table:
+    """Table of interned filenames. Each distinct name is stored once and 
+    referred to by an integer id. Names are never removed - a removed directory
+    leaves its names behind, which is harmless since they are usually reused
+    when the directory comes back."""
+    def __init__(self):
+        self.ids = {}
+        self.names = []
+        self.lock = threading.Lock()
+
+    def intern(self, name):
+        """Return the id of name, adding it to the table if needed"""
+        name_id = self.ids.get(name)
+        if name_id is None:
+            with self.lock:
+                name_id = self.ids.get(name)
+                if name_id is None:
+                    name_id = len(self.names)
+                    self.names.append(name)
+                    self.ids[name] = name_id
+        return name_id
+
+    def __getitem__(self, name_id):
+        return self.names[name_id]
+
+# Shared by all Image_List objects
+FILENAMES = String_Table()
+
+
+class Image_List:
+    """Compact replacement for a list of Img_Tup objects. Dates and orientations
+    are kept in typed arrays and filenames as ids into FILENAMES, so a directory
+    costs a few bytes per image instead of a namedtuple, a float and a str.
+    None of the arrays are tracked by the garbage collector. Indexing returns 
+    an Img_Tup, so play methods can use it just like a list."""
+    __slots__ = ('name_ids', 'dates', 'orientations')
+
+    def __init__(self, images=()):
+        self.name_ids = array('I')
+        self.dates = array('d')
+        self.orientations = array('b')
+        for img in images:
+            self.append(img)
+
+    def append(self, img):
+        self.name_ids.append(FILENAMES.intern(img.fname))
+        self.dates.append(img.date)
+        self.orientations.append(valid_orientation(img.orientation))
+
+    def __len__(self):
+        return len(self.name_ids)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self.__getitem__(i) for i in range(*idx.indices(len(self)))]
+        return Img_Tup(FILENAMES[self.name_ids[idx]], self.dates[idx], self.orientations[idx])
+
+    def __setitem__(self, idx, img):
+        self.name_ids[idx] = FILENAMES.intern(img.fname)
+        self.dates[idx] = img.date
+        self.orientations[idx] = valid_orientation(img.orientation)
+
+    def copy(self):
+        img_list = Image_List.__new__(Image_List)
+        img_list.name_ids = self.name_ids[:]
+        img_list.dates = self.dates[:]
+        img_list.orientations = self.orientations[:]
+        return img_list
+
+    def __iter__(self):
+        names = FILENAMES.names
+        for name_id, date, orientation in zip(self.name_ids, self.dates, self.orientations):
+            yield Img_Tup(names[name_id], date, orientation)
+
+    def __repr__(self):
+        return "Image_List({} images)".format(len(self))
+
+
+class Snapshot_Image_List:
+    """Image list of a directory loaded from a snapshot. Reads image records
+    straight from the mapped file, so nothing is loaded until it is used. The
+    first change turns it into an ordinary image list."""
+    __slots__ = ('snap', 'start', 'count', 'owned')
+
+    def __init__(self, snap, start, count):
+        self.snap = snap
+        self.start = start
+        self.count = count
+        self.owned = None
+
+    def materialise(self):
+        if self.owned is None:
+            self.owned = new_image_list(list(self))
+        return self.owned
+
+    def append(self, img):
+        self.materialise().append(img)
+
+    def __len__(self):
+        return self.count if self.owned is None else len(self.owned)
+
+    def __getitem__(self, idx):
+        if self.owned is not None:
+            return self.owned[idx]
+        if isinstance(idx, slice):
+            return [self.__getitem__(i) for i in range(*idx.indices(self.count))]
+        if idx < 0:
+            idx += self.count
+        if not 0 <= idx < self.count:
+            raise IndexError("image index out of range")
+        return Img_Tup(*self.snap.image(self.start + idx))
+
+    def __setitem__(self, idx, img):
+        self.materialise()[idx] = img
+
+    def copy(self):
+        if self.owned is not None:
+            return self.owned.copy()
+        # The mapped records never change
+        return Snapshot_Image_List(self.snap, self.start, self.count)
+
+    def __iter__(self):
+        if self.owned is not None:
+            return iter(self.owned)
+        return (Img_Tup(*self.snap.image(i)) for i in range(self.start, self.start + self.count))
+
+    def __repr__(self):
+        return "Snapshot_Image_List({} images)".format(len(self))
+
+
+def new_image_list(images=()):
+    """Returns the container used for Image_Directory.images"""
+    if config.COMPACT_RECORDS:
+        return Image_List(images)
+    return list(images)
+
+
 class Image_Directory():
     """Holds the data relating to a given directory - images present, parent
     directory, child directories, etc. Acts as a node in a branching tree data 
     structure"""
-    def __init__(self, path):
+    __slots__ = ('path', 'name', 'parent_name', 'mtime', 'child_names', 'images', 
+                 'image_reads_failed', 'date_score', 'exif_pending', 'images_present', 
+                 'subdirs_present', 'updated', 'update_time',
+                 'date_sum', 'date_n', 'date_min', 'date_max',
+                 'sub_pics', 'sub_folders', 'sub_date_sum', 'sub_date_n', 'sub_date_min', 'sub_date_max')
+
+    def __init__(self, path, known_images=None):
         if os.path.isdir(path):
             self.path = path
             self.name = os.path.basename(path)
             self.parent_name = os.path.dirname(path)
-            self.child_names = list_subdirs(path)
+            # Directory mtime changes whenever an entry is added/removed/renamed.
+            self.mtime, self.child_names, img_names = scan_directory(path)
             
-            self.images = []
-            img_names = list_images(path) 
+            images = []
             # TODO - is sort order here the same as the sort order the filesystem does?  I.e. does filesystem do a different lexigraphical ordering?
             # Sort image names by alphabetical order
             img_names.sort(key=lambda x: x.lower())
             for img_name in img_names:
-                img_tuple = self.get_image_tuple(img_name, path)
+                if known_images is not None and img_name in known_images:
+                    img_tuple = known_images[img_name]
+                else:
+                    img_tuple = self.get_image_tuple(img_name, path)
                 if img_tuple is not None:
-                    self.images.append(self.get_image_tuple(img_name, path))
+                    images.append(img_tuple)
             
-            self.date_score = self.compute_date_score()
-
-            # Set flags indicating state of directory
-            self.images_present = (len(self.images) > 0)
-            self.subdirs_present = (len(self.child_names) > 0)
+            self.images = new_image_list(images)
             self.image_reads_failed = len(img_names) - len(self.images)
-
-            self.updated = True
-            self.update_time = time.time()
+            self.set_flags()
         else:
-            raise ValueError("Not a directory: " + directory)
+            raise ValueError("Not a directory: " + path)
             # TODO - Provide exception handling for this case
+
+    @classmethod
+    def from_catalog(cls, path, mtime, child_names, reads_failed, images):
+        """Rebuild a directory node from catalog data without touching the 
+        filesystem"""
+        img_dir = cls.__new__(cls)
+        img_dir.path = path
+        img_dir.name = os.path.basename(path)
+        img_dir.parent_name = os.path.dirname(path)
+        img_dir.mtime = mtime
+        img_dir.child_names = child_names
+        images = [Img_Tup(*img) for img in images]
+        images.sort(key=lambda x: x.fname.lower())
+        img_dir.images = new_image_list(images)
+        img_dir.image_reads_failed = reads_failed
+        img_dir.set_flags()
+        return img_dir
+
+    @classmethod
+    def from_snapshot(cls, path, rec, child_names, snap):
+        """Rebuild a directory node from a snapshot record (a tuple in 
+        snapshot.DIR_DTYPE field order). The image list stays in the snapshot,
+        and all derived values come from the record."""
+        (path_off, path_len, n_children, first_child, first_image, n_images, reads_failed, 
+            exif_pending, date_n, mtime, date_sum, date_min, date_max, *sub_stats) = rec
+        img_dir = cls.__new__(cls)
+        img_dir.path = path
+        img_dir.name = os.path.basename(path)
+        img_dir.parent_name = os.path.dirname(path)
+        img_dir.mtime = mtime
+        img_dir.child_names = child_names
+        img_dir.images = Snapshot_Image_List(snap, first_image, n_images)
+        img_dir.image_reads_failed = reads_failed
+        img_dir.exif_pending = exif_pending
+        img_dir.date_sum, img_dir.date_n, img_dir.date_min, img_dir.date_max = date_sum, date_n, date_min, date_max
+        img_dir.date_score = img_dir.compute_date_score()
+        pics, folders, sub_date_n, sub_date_sum, sub_date_min, sub_date_max = sub_stats
+        img_dir.set_subtree_stats(Tree_Stats(pics, folders, sub_date_sum, sub_date_n, sub_date_min, sub_date_max))
+        img_dir.images_present = n_images > 0
+        img_dir.subdirs_present = len(child_names) > 0
+        img_dir.updated = True
+        img_dir.update_time = time.time()
+        return img_dir
+
+    def frozen_copy(self):
+        """Copy that later changes to this directory don't show up in, e.g. to
+        be written out without holding the database lock. Costs a copy of the
+        child list and the image arrays, not of each image."""
+        img_dir = Image_Directory.__new__(Image_Directory)
+        for name in self.__slots__:
+            if hasattr(self, name):
+                setattr(img_dir, name, getattr(self, name))
+        img_dir.child_names = list(self.child_names)
+        img_dir.images = self.images.copy()
+        return img_dir
+
+    def set_flags(self):
+        """Compute derived values once the image list is populated"""
+        self.compute_date_stats()
+        # Until the database links it to its children, the subtree is just this node
+        self.set_subtree_stats(self.own_stats())
+        self.exif_pending = sum(1 for img in self.images if img.orientation == ORIENTATION_PENDING)
+
+        # Set flags indicating state of directory
+        self.images_present = (len(self.images) > 0)
+        self.subdirs_present = (len(self.child_names) > 0)
+
+        self.updated = True
+        self.update_time = time.time()
         
-    # TODO - This may not be feasible. At least not as the way we have it. Opening every image and
-    # getting the metadata on startup is not great. Super slow. 
     def get_image_tuple(self, image_name, path):
         """Given an image name, produce a tuple containing 
         (Filename, Rotation, Date)
@@ -198,51 +1139,65 @@ class Image_Directory():
         date = float("nan")
         orientation = 1 # No orientation fix needed
 
-        # EXIF data only for JPEG images
+        # EXIF data only for JPEG images. Only the EXIF header is read - opening
+        # every image with PIL on startup is far too slow.
         ext = os.path.splitext(image_name)[1].lower()
         if ext == ".jpg" or ext == '.jpeg':
+            # Placeholder, to be filled in by the background Exif_Enricher
+            if config.DELAY_EXIF:
+                return Img_Tup(image_name, date, ORIENTATION_PENDING)
             try:
-                im = None #Image.open(os.path.join(path, image_name))
-                exif_data = None# im._getexif()
-
-                if exif_data is not None:
-                    if EXIF_DATE in exif_data:
-                        # Convert date string to time.struct_time object
-                        exif_date = time.strptime(exif_data[EXIF_DATE], r'%Y:%m:%d %H:%M:%S') 
-                        # Converts struct_time object to total seconds since epoch
-                        date = time.mktime(exif_date)
-
-                    if EXIF_ORIENTATION in exif_data:
-                        orientation = int(exif_data[EXIF_ORIENTATION])
-               
-                    #if config.LOAD_GEOLOC and geo.EXIF_GPSINFO in exif_data:
-                    #    location = geo.get_location(exif_data[geo.EXIF_GPSINFO])
-                    
-                    # Convert time to date string of specified format. For display purposes
-                    # Perhaps move to viewer functionality
-                    #fdt = time.strftime(config.SHOW_TEXT_FM, time.localtime(dt))
+                date, orientation = read_exif(os.path.join(path, image_name))
+                orientation = valid_orientation(orientation)
+
+                #if config.LOAD_GEOLOC and geo.EXIF_GPSINFO in exif_data:
+                #    location = geo.get_location(exif_data[geo.EXIF_GPSINFO])
+                
+                # Convert time to date string of specified format. For display purposes
+                # Perhaps move to viewer functionality
+                #fdt = time.strftime(config.SHOW_TEXT_FM, time.localtime(dt))
 
             except Exception as e:
-                # TODO - Just print exception, or log occurence? Setup logging?
-                print("Error reading image: ", os.path.join(path, image_name))
-                print("Received: ", e)
-                return None
+                # Left in - if the image itself is bad, it goes in the failure
+                # cache when it is opened for display
+                logging.debug("Could not read EXIF of {} ({})".format(os.path.join(path, image_name), e))
 
         return Img_Tup(image_name, date, orientation)
 
     def compute_date_score(self):
         """Take an average of the image dates to compute an average date score"""
+        if self.date_n > 0:
+            return self.date_sum/self.date_n
+
+        return float("nan")
+
+    def compute_date_stats(self):
+        """Compute sum, count, min and max of the image dates, and the date score"""
         n = 0
-        dt = 0
+        dt = 0.0
+        dt_min = float("inf")
+        dt_max = float("-inf")
         for img in self.images:
             if not isnan(img.date):
                 dt += img.date
                 n += 1
+                dt_min = min(dt_min, img.date)
+                dt_max = max(dt_max, img.date)
 
-        if dt > 0:
-            return dt/n
+        self.date_sum, self.date_n, self.date_min, self.date_max = dt, n, dt_min, dt_max
+        self.date_score = self.compute_date_score()
 
-        return float("nan")
+    def own_stats(self):
+        """Tree_Stats of the images in this directory only"""
+        return Tree_Stats(len(self.images), 1, self.date_sum, self.date_n, self.date_min, self.date_max)
+
+    def subtree_stats(self):
+        return Tree_Stats(self.sub_pics, self.sub_folders, self.sub_date_sum, self.sub_date_n,
+                          self.sub_date_min, self.sub_date_max)
+
+    def set_subtree_stats(self, stats):
+        (self.sub_pics, self.sub_folders, self.sub_date_sum, self.sub_date_n,
+            self.sub_date_min, self.sub_date_max) = stats
 
     def __repr__(self):
         rep = ("{}, Pics: {}, Date Score: {:e} ".format(self.name, len(self.images), 
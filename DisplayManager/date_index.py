@@ -0,0 +1,134 @@
+import bisect
+from array import array
+
+import numpy as np
+
+"""Global date index for Image_Database.
+
+Holds one entry per dated image, sorted by date, in two parallel typed arrays:
+the date, and a key packing (directory id, image index). Finding all images in
+a date range is then two bisections. Entries are added to a small pending
+buffer and merged into the sorted arrays the next time the index is read, so
+adding a whole library costs one sort rather than one insertion per image.
+"""
+
+# Image index occupies the low bits of a key, directory id the high bits
+IDX_BITS = 32
+IDX_MASK = (1 << IDX_BITS) - 1
+
+def make_key(dir_id, img_idx):
+    return (dir_id << IDX_BITS) | img_idx
+
+def split_key(key):
+    """Returns (dir_id, img_idx)"""
+    return key >> IDX_BITS, key & IDX_MASK
+
+
+class Date_Index:
+    # Class Constants
+    MERGE_THRESHOLD = 1000 # pending entries above which a full re-sort is cheaper than insertion
+
+    def __init__(self, dates=None, keys=None):
+        # The sorted entries. May start out as read-only views of a snapshot
+        # (numpy arrays), which are only copied into arrays on the first change.
+        self.dates = array('d') if dates is None else dates
+        self.keys = array('Q') if keys is None else keys
+        self.pending = []
+        self.version = 0 # Incremented on every change, so readers can tell if cached positions are stale
+
+    def __len__(self):
+        return len(self.dates) + len(self.pending)
+
+    def add(self, date, dir_id, img_idx):
+        """Add a single image. NaN dates are not indexed."""
+        if date == date:
+            self.pending.append((date, make_key(dir_id, img_idx)))
+            self.version += 1
+
+    def remove(self, date, dir_id, img_idx):
+        if date != date:
+            return
+        self.flush()
+        key = make_key(dir_id, img_idx)
+        i = bisect.bisect_left(self.dates, date)
+        while i < len(self.dates) and self.dates[i] == date:
+            if self.keys[i] == key:
+                self.make_writable()
+                del self.dates[i]
+                del self.keys[i]
+                self.version += 1
+                return
+            i += 1
+
+    def add_directory(self, dir_id, images):
+        for img_idx, img in enumerate(images):
+            self.add(img.date, dir_id, img_idx)
+
+    def remove_directory(self, dir_id, images):
+        self.remove_directories([dir_id])
+
+    def remove_directories(self, dir_ids):
+        """Remove every entry of the given directories, in a single pass over
+        the arrays rather than one deletion (and move of the entries after it)
+        per image"""
+        dir_ids = set(dir_ids)
+        if not dir_ids:
+            return
+        self.pending = [(date, key) for date, key in self.pending if key >> IDX_BITS not in dir_ids]
+        if len(self.keys):
+            keys = np.frombuffer(self.keys, dtype=np.uint64)
+            keep = ~np.isin(keys >> np.uint64(IDX_BITS), np.fromiter(dir_ids, dtype=np.uint64, count=len(dir_ids)))
+            if not keep.all():
+                self.dates = array('d', np.frombuffer(self.dates, dtype=np.float64)[keep].tobytes())
+                self.keys = array('Q', keys[keep].tobytes())
+        self.version += 1
+
+    def make_writable(self):
+        """Copy entries that are still views of a snapshot into arrays"""
+        if not isinstance(self.dates, array):
+            dates, keys = array('d'), array('Q')
+            dates.frombytes(self.dates)
+            keys.frombytes(self.keys)
+            self.dates, self.keys = dates, keys
+
+    def flush(self):
+        """Merge pending entries into the sorted arrays"""
+        if not self.pending:
+            return
+        self.make_writable()
+        if len(self.pending) < self.MERGE_THRESHOLD:
+            for date, key in self.pending:
+                i = bisect.bisect_left(self.dates, date)
+                while i < len(self.dates) and self.dates[i] == date and self.keys[i] < key:
+                    i += 1
+                self.dates.insert(i, date)
+                self.keys.insert(i, key)
+        else:
+            entries = list(zip(self.dates, self.keys)) + self.pending
+            entries.sort()
+            self.dates = array('d', (e[0] for e in entries))
+            self.keys = array('Q', (e[1] for e in entries))
+        self.pending = []
+
+    def range(self, dt_from=None, dt_to=None):
+        """Returns the (lo, hi) positions of the entries with dt_from <= date < dt_to.
+        Either bound may be None for an open range."""
+        self.flush()
+        lo = 0 if dt_from is None else bisect.bisect_left(self.dates, dt_from)
+        hi = len(self.dates) if dt_to is None else bisect.bisect_left(self.dates, dt_to)
+        return lo, max(lo, hi)
+
+    def position_after(self, date, key):
+        """Position of the first entry that sorts after (date, key)"""
+        self.flush()
+        i = bisect.bisect_right(self.dates, date)
+        j = bisect.bisect_left(self.dates, date)
+        # Entries with equal dates are ordered by key
+        while j < i and self.keys[j] <= key:
+            j += 1
+        return j
+
+    def __getitem__(self, pos):
+        """Returns (date, dir_id, img_idx) of the entry at the given position"""
+        dir_id, img_idx = split_key(int(self.keys[pos]))
+        return float(self.dates[pos]), dir_id, img_idx
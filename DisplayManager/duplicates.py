@@ -0,0 +1,331 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+
+"""Duplicate image detection across all picture roots.
+
+Copies of the same photo often end up in several places (e.g. an original and
+a resized copy made by test/picture_transfer.py kept in the same root, or the
+same folder under two roots). Duplicate_Index groups files with identical
+content so play methods can treat each group as a single image.
+
+Hashing every file would mean reading the whole library, so files are only
+compared in stages:
+1. File size (from stat). Only files sharing a size with another file go on.
+2. Quick fingerprint - a hash of the first and last BLOCK_SIZE bytes.
+3. Full content hash, only for files whose quick fingerprints collide.
+
+The index is kept by directory. Each directory's images are only looked at
+again once its mtime is no longer the one they were indexed at, so after a
+change just the changed directories are stat'ed, and no file is read twice. The
+index is saved in the catalog with the database (see Catalog.save_duplicates),
+so a restart carries on from it instead of going through the whole library.
+"""
+
+BLOCK_SIZE = 65536
+
+def quick_fingerprint(path, size):
+    """Hash of the first and last blocks of a file"""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        h.update(f.read(BLOCK_SIZE))
+        if size > 2*BLOCK_SIZE:
+            f.seek(-BLOCK_SIZE, os.SEEK_END)
+        h.update(f.read(BLOCK_SIZE))
+    return h.digest()
+
+def full_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.digest()
+
+def hash_files(files, func):
+    """Returns (path, size, func(path, size)) for the given (path, size) files,
+    leaving out files that can't be read"""
+    results = []
+    for path, size in files:
+        try:
+            results.append((path, size, func(path, size)))
+        except OSError:
+            continue
+    return results
+
+
+class Duplicate_Index:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.stats = {}      # path : (size, mtime)
+        self.by_dir = {}     # directory path : set of paths in it
+        self.dir_mtimes = {} # directory path : directory mtime its images were indexed at
+        self.by_size = {}    # size : set of paths
+        self.by_quick = {}   # (size, quick fingerprint) : set of paths, only for files sharing a size
+        self.quick = {}      # path : quick fingerprint
+        self.full = {}       # path : full hash, only computed on quick fingerprint collisions
+        self.groups = {}     # (size, full hash) : set of paths with identical content (may be just one)
+
+        # Directories indexed/removed since the last save
+        self.changed_dirs = set()
+        self.removed_dirs = set()
+
+    def __contains__(self, path):
+        return path in self.stats
+
+    def add_stat(self, path, size, mtime):
+        """Enter a file by size, without reading it. Returns the paths sharing
+        its size that have no quick fingerprint yet, with their size."""
+        self.stats[path] = (size, mtime)
+        self.by_dir.setdefault(os.path.dirname(path), set()).add(path)
+        self.changed_dirs.add(os.path.dirname(path))
+        peers = self.by_size.setdefault(size, set())
+        peers.add(path)
+        if len(peers) < 2:
+            return []
+        return [(p, size) for p in peers if p not in self.quick]
+
+    def publish_quick(self, fingerprints):
+        """Enter computed (path, size, quick fingerprint) results. Returns the
+        paths whose fingerprints collide that have no full hash yet."""
+        need_full = set()
+        for path, size, quick in fingerprints:
+            if self.stats.get(path, (None,))[0] != size:
+                continue # Changed or removed meanwhile
+            self.quick[path] = quick
+            self.changed_dirs.add(os.path.dirname(path))
+            matches = self.by_quick.setdefault((size, quick), set())
+            matches.add(path)
+            if len(matches) >= 2:
+                need_full.update((p, size) for p in matches if p not in self.full)
+        return list(need_full)
+
+    def publish_full(self, hashes):
+        """Enter computed (path, size, full hash) results"""
+        for path, size, full in hashes:
+            if self.stats.get(path, (None,))[0] != size:
+                continue
+            self.full[path] = full
+            self.changed_dirs.add(os.path.dirname(path))
+            self.groups.setdefault((size, full), set()).add(path)
+
+    def remove(self, path):
+        with self.lock:
+            stat = self.stats.pop(path, None)
+            if stat is None:
+                return
+            size = stat[0]
+            directory = os.path.dirname(path)
+            self.by_dir[directory].discard(path)
+            if not self.by_dir[directory]:
+                del self.by_dir[directory]
+            self.changed_dirs.add(directory)
+            self.by_size[size].discard(path)
+            if not self.by_size[size]:
+                del self.by_size[size]
+
+            quick = self.quick.pop(path, None)
+            if quick is not None:
+                self.by_quick[(size, quick)].discard(path)
+                if not self.by_quick[(size, quick)]:
+                    del self.by_quick[(size, quick)]
+
+            full = self.full.pop(path, None)
+            if full is not None and (size, full) in self.groups:
+                self.groups[(size, full)].discard(path)
+                if not self.groups[(size, full)]:
+                    del self.groups[(size, full)]
+
+    def is_duplicate(self, path, playable=None):
+        """True if path is a copy of another file that will be played instead.
+        The copy played is the first one in sort order that still exists and,
+        if playable is given, whose directory it accepts - so which copy that
+        is follows dirs_to_play and the schedule."""
+        with self.lock:
+            full = self.full.get(path)
+            if full is None:
+                return False
+            members = self.groups.get((self.stats[path][0], full), ())
+            if len(members) < 2:
+                return False
+            members = sorted(members)
+        for p in members:
+            if p == path:
+                return False
+            # Guards against the copy having been deleted since the last check
+            if (playable is None or playable(os.path.dirname(p))) and os.path.isfile(p):
+                return True
+        return False
+
+    def wasted_bytes(self):
+        """Bytes used by all copies beyond the first of each group"""
+        with self.lock:
+            return sum(size * (len(members) - 1) for (size, full), members in self.groups.items())
+
+    def is_current(self, path, size, mtime):
+        return self.stats.get(path) == (size, mtime)
+
+    def is_dir_current(self, directory, mtime):
+        """True if the images of directory were indexed when it had this mtime"""
+        return directory in self.dir_mtimes and self.dir_mtimes[directory] == mtime
+
+    def update_directory(self, directory, mtime, files):
+        """Make the index entries of directory the given (path, size, mtime) 
+        files, indexed at directory mtime mtime. Files are only read if their
+        size matches another file's, and they are read without holding the
+        lock, so is_duplicate() doesn't wait for the hashing. Entries are only
+        changed by one thread (Duplicate_Finder), so nothing else changes them
+        in between."""
+        with self.lock:
+            new = [f for f in files if not self.is_current(*f)]
+            stale = self.by_dir.get(directory, set()) - {path for path, size, file_mtime in files}
+            for path in stale | {path for path, size, file_mtime in new}:
+                self.remove(path)
+            need_quick = set()
+            for path, size, file_mtime in new:
+                need_quick.update(self.add_stat(path, size, file_mtime))
+
+        fingerprints = hash_files(need_quick, quick_fingerprint)
+        with self.lock:
+            need_full = self.publish_quick(fingerprints)
+
+        hashes = hash_files(need_full, lambda path, size: full_hash(path))
+        with self.lock:
+            self.publish_full(hashes)
+            self.dir_mtimes[directory] = mtime
+            self.changed_dirs.add(directory)
+
+    def remove_directory(self, directory):
+        """Forget a directory and its images"""
+        with self.lock:
+            for path in list(self.by_dir.get(directory, ())):
+                self.remove(path)
+            self.dir_mtimes.pop(directory, None)
+            self.changed_dirs.discard(directory)
+            self.removed_dirs.add(directory)
+
+    def invalidate(self, directory):
+        """Have directory indexed again, also if its mtime doesn't change"""
+        with self.lock:
+            if directory in self.dir_mtimes:
+                self.dir_mtimes[directory] = None
+                self.changed_dirs.add(directory)
+
+    def directories(self):
+        with self.lock:
+            return list(self.dir_mtimes)
+
+    def load(self, dirs, files):
+        """Fill the index from saved rows, without reading any file: dirs is a
+        dict of directory path : mtime, files a list of (path, size, mtime, 
+        quick fingerprint, full hash) with None for hashes not computed"""
+        with self.lock:
+            self.stats, self.by_dir, self.by_size, self.by_quick = {}, {}, {}, {}
+            self.quick, self.full, self.groups = {}, {}, {}
+            self.dir_mtimes = dict(dirs)
+            for path, size, mtime, quick, full in files:
+                self.stats[path] = (size, mtime)
+                self.by_dir.setdefault(os.path.dirname(path), set()).add(path)
+                self.by_size.setdefault(size, set()).add(path)
+                if quick is not None:
+                    self.quick[path] = quick
+                    self.by_quick.setdefault((size, quick), set()).add(path)
+                if full is not None:
+                    self.full[path] = full
+                    self.groups.setdefault((size, full), set()).add(path)
+            self.changed_dirs = set()
+            self.removed_dirs = set()
+
+    def take_changes(self):
+        """Returns ({directory : (mtime, [(path, size, mtime, quick, full)])}, 
+        [directory]) of the directories indexed and removed since the last call"""
+        with self.lock:
+            changed = {}
+            for directory in self.changed_dirs:
+                if directory in self.dir_mtimes or directory in self.by_dir:
+                    changed[directory] = (self.dir_mtimes.get(directory), 
+                        [(p,) + self.stats[p] + (self.quick.get(p), self.full.get(p))
+                         for p in self.by_dir.get(directory, ())])
+            removed = list(self.removed_dirs)
+            self.changed_dirs = set()
+            self.removed_dirs = set()
+        return changed, removed
+
+    def report(self):
+        with self.lock:
+            n_groups = sum(1 for members in self.groups.values() if len(members) > 1)
+            n_copies = sum(len(members) - 1 for members in self.groups.values())
+            return "{} duplicate groups, {} extra copies using {:.1f} MB".format(
+                n_groups, n_copies, self.wasted_bytes() / 1e6)
+
+
+class Duplicate_Finder:
+    """Background thread that keeps a Duplicate_Index up to date with the
+    database. Runs a pass at startup and again whenever woken up (e.g. when the
+    watcher reports a change). A pass only stats the images of directories 
+    whose mtime changed since they were indexed."""
+    # Class Constants
+    BATCH_SIZE = 200        # files checked between pauses
+    BATCH_PAUSE = 0.05      # sec
+
+    def __init__(self, pic_db, index):
+        self.alive = True
+        self.pic_db = pic_db
+        self.index = index
+        self.wake = threading.Event()
+        self.wake.set()
+
+    def kill(self):
+        self.alive = False
+        self.wake.set()
+
+    def directories_changed(self, paths):
+        """Index the images of the given directories again on the next pass. 
+        Files overwritten in place don't change the directory mtime."""
+        for path in paths:
+            self.index.invalidate(path)
+        self.wake.set()
+
+    def run(self):
+        while self.alive:
+            self.wake.wait()
+            self.wake.clear()
+            if self.alive:
+                self.scan()
+
+    def scan(self):
+        t_start = time.time()
+        with self.pic_db.lock:
+            dirs = [(path, img_dir.mtime) for path, img_dir in self.pic_db.items()]
+        n = 0
+        n_dirs = 0
+        for path, mtime in dirs:
+            if not self.alive:
+                return
+            # Directories of unplugged drives keep their entries
+            if self.index.is_dir_current(path, mtime) or not self.pic_db.is_online(path):
+                continue
+            img_dir = self.pic_db.get(path)
+            if img_dir is None:
+                continue
+            files = []
+            for img in list(img_dir.images):
+                pic_path = os.path.join(path, img.fname)
+                try:
+                    st = os.stat(pic_path)
+                except OSError:
+                    continue
+                files.append((pic_path, st.st_size, st.st_mtime))
+                n += 1
+                if n % self.BATCH_SIZE == 0:
+                    time.sleep(self.BATCH_PAUSE)
+            self.index.update_directory(path, mtime, files)
+            n_dirs += 1
+
+        for path in self.index.directories():
+            if path not in self.pic_db:
+                self.index.remove_directory(path)
+        if n_dirs > 0:
+            logging.info("Duplicate check of {} images in {} changed folders done in {:.1f} sec: {}".format(
+                n, n_dirs, time.time()-t_start, self.index.report()))
@@ -0,0 +1,107 @@
+import time
+import threading
+import logging
+import os
+from collections import deque
+
+from database import ORIENTATION_PENDING, read_exif
+
+"""Background EXIF enrichment.
+
+With config.DELAY_EXIF set, directories are scanned without reading any image
+headers - each JPEG gets a placeholder Img_Tup (NaN date, ORIENTATION_PENDING).
+Exif_Enricher then fills in the real date and orientation from a background
+thread. Directories picked by the active play method are handled first, the rest
+of the library is worked through at low priority in between.
+"""
+
+class Exif_Enricher:
+    # Class Constants
+    BATCH_SIZE = 50          # images read between checks for priority work
+    BACKGROUND_PAUSE = 0.05  # sec to yield the CPU/disk between background batches
+    IDLE_PERIOD = 5.0        # sec to wait before checking the library again when idle
+
+    def __init__(self, pic_db):
+        self.alive = True
+        self.pic_db = pic_db
+
+        self.priority = deque()  # Directory paths to enrich before anything else
+        self.wake = threading.Event()
+        self.n_enriched = 0
+
+    def kill(self):
+        self.alive = False
+        self.wake.set()
+
+    def prioritise(self, img_dir):
+        """Ask for img_dir to be enriched next (e.g. it is the current playlist)"""
+        if img_dir.exif_pending > 0 and img_dir.path not in self.priority:
+            self.priority.appendleft(img_dir.path)
+            self.wake.set()
+
+    def run(self):
+        """Work through priority directories first, then the rest of the library"""
+        t_start = time.time()
+        while self.alive:
+            if self.priority:
+                self.enrich_directory(self.priority.popleft(), background=False)
+                continue
+
+            # Background pass over a snapshot of the library. Stops early to go
+            # back to priority work as soon as any arrives.
+            n_before = self.n_enriched
+            with self.pic_db.lock:
+                paths = list(self.pic_db.keys())
+            for path in paths:
+                if not self.alive or self.priority:
+                    break
+                img_dir = self.pic_db.get(path)
+                # Pictures on an unplugged drive wait until it is back
+                if img_dir is not None and img_dir.exif_pending > 0 and self.pic_db.is_online(path):
+                    self.enrich_directory(path, background=True)
+
+            # Idle also when a pass got nowhere (e.g. pictures that stay 
+            # pending), rather than going straight round again
+            if self.n_enriched == n_before and not self.priority:
+                if self.n_enriched > 0:
+                    logging.info("EXIF enrichment complete: {} images in {:.1f} sec".format(
+                        self.n_enriched, time.time()-t_start))
+                    self.n_enriched = 0
+                self.wake.wait(self.IDLE_PERIOD)
+                self.wake.clear()
+                t_start = time.time()
+
+    def enrich_directory(self, path, background):
+        """Read EXIF for every pending image in the directory. In background
+        mode, pause between batches and give way to priority work."""
+        img_dir = self.pic_db.get(path)
+        if img_dir is None:
+            return
+
+        n = 0
+        for idx in range(len(img_dir.images)):
+            if not self.alive:
+                return
+            if img_dir.images[idx].orientation == ORIENTATION_PENDING:
+                self.enrich_image(img_dir, idx)
+                n += 1
+                if background and n % self.BATCH_SIZE == 0:
+                    if self.priority:
+                        return
+                    time.sleep(self.BACKGROUND_PAUSE)
+
+        self.pic_db.update_date_score(img_dir)
+
+    def enrich_image(self, img_dir, idx):
+        img = img_dir.images[idx]
+        try:
+            date, orientation = read_exif(os.path.join(img_dir.path, img.fname))
+        except Exception as e:
+            if not self.pic_db.is_online(img_dir.path):
+                # Drive unplugged - keep the image pending rather than losing its metadata
+                return
+            # Leave the image to fail when it is opened for display
+            logging.debug("Could not read EXIF of {}: {}".format(img.fname, e))
+            date, orientation = float("nan"), 1
+        self.pic_db.update_image(img_dir, idx, date, orientation)
+        self.n_enriched += 1
@@ -0,0 +1,142 @@
+import struct
+import time
+
+"""Header-only EXIF reader.
+
+PIL.Image.open() followed by _getexif() parses far more of the file than we
+need at scan time. This module reads only the bytes of the APP1 (EXIF) segment
+of a JPEG, or the first IFDs of a TIFF file, and pulls out the two tags used by
+Image_Database: DateTimeOriginal and Orientation. A typical photo costs a
+few KB of reads.
+"""
+
+TAG_ORIENTATION = 0x0112
+TAG_EXIF_IFD = 0x8769
+TAG_DATE_ORIGINAL = 0x9003
+
+# Bytes of each TIFF field type. Only the types we read are needed.
+TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 7: 1, 9: 4, 10: 8}
+
+# Markers without a length field
+STANDALONE_MARKERS = {0x01, 0xD0, 0xD1, 0xD2, 0xD3, 0xD4, 0xD5, 0xD6, 0xD7}
+SOS = 0xDA
+APP1 = 0xE1
+
+
+def read_exif(path):
+    """Returns (date, orientation) for the given JPEG or TIFF file, where date
+    is seconds since the epoch (NaN if not available) and orientation is the
+    EXIF orientation flag (1 if not available). Raises OSError if the file
+    can't be read and ValueError if it is not a JPEG/TIFF file."""
+    with open(path, 'rb') as f:
+        head = f.read(4)
+        if head[:2] == b'\xff\xd8':
+            tiff = read_jpeg_app1(f, head[2:])
+        elif head in (b'II*\x00', b'MM\x00*'):
+            # For TIFF files the IFDs usually sit near the start of the file
+            f.seek(0)
+            tiff = f.read(65536)
+        else:
+            raise ValueError("Not a JPEG or TIFF file: " + path)
+
+    if tiff is None:
+        return float("nan"), 1
+    try:
+        return parse_tiff(tiff)
+    except (struct.error, ValueError, IndexError):
+        # Malformed EXIF data. The image itself may still be fine.
+        return float("nan"), 1
+
+
+def read_jpeg_app1(f, buf):
+    """Walk the JPEG marker segments and return the TIFF block held in the EXIF
+    APP1 segment, or None. Other segments are skipped with seek() rather than
+    read. Stops at the start of the image data."""
+    while True:
+        if len(buf) < 2:
+            buf += f.read(2 - len(buf))
+            if len(buf) < 2:
+                return None
+        if buf[0] != 0xFF:
+            return None
+        marker = buf[1]
+        if marker == 0xFF: # fill byte
+            buf = buf[1:]
+            continue
+        if marker in STANDALONE_MARKERS:
+            buf = b''
+            continue
+        if marker == SOS:
+            return None
+
+        length_bytes = f.read(2)
+        if len(length_bytes) < 2:
+            return None
+        length = struct.unpack('>H', length_bytes)[0] - 2
+
+        if marker == APP1:
+            data = f.read(length)
+            if data[:6] == b'Exif\x00\x00':
+                return data[6:]
+        else:
+            f.seek(length, 1)
+        buf = b''
+
+
+def parse_tiff(tiff):
+    """Extract (date, orientation) from a TIFF structure"""
+    if tiff[:2] == b'II':
+        endian = '<'
+    elif tiff[:2] == b'MM':
+        endian = '>'
+    else:
+        raise ValueError("Bad TIFF header")
+
+    date = float("nan")
+    orientation = 1
+
+    ifd0 = struct.unpack(endian + 'I', tiff[4:8])[0]
+    tags = read_ifd(tiff, ifd0, endian, (TAG_ORIENTATION, TAG_EXIF_IFD))
+
+    # Only the eight EXIF orientations - anything else is a corrupt tag
+    if TAG_ORIENTATION in tags and tags[TAG_ORIENTATION] in range(1, 9):
+        orientation = int(tags[TAG_ORIENTATION])
+
+    if TAG_EXIF_IFD in tags:
+        exif_tags = read_ifd(tiff, tags[TAG_EXIF_IFD], endian, (TAG_DATE_ORIGINAL,))
+        if TAG_DATE_ORIGINAL in exif_tags:
+            try:
+                # Same conversion as used elsewhere: local time, seconds since epoch
+                exif_date = time.strptime(exif_tags[TAG_DATE_ORIGINAL], r'%Y:%m:%d %H:%M:%S')
+                date = time.mktime(exif_date)
+            except (ValueError, OverflowError):
+                pass # e.g. '0000:00:00 00:00:00' written by some cameras
+
+    return date, orientation
+
+
+def read_ifd(tiff, offset, endian, wanted):
+    """Return {tag : value} for the wanted tags of the IFD at offset. Only
+    single valued SHORT/LONG entries and ASCII strings are decoded."""
+    values = {}
+    n_entries = struct.unpack(endian + 'H', tiff[offset:offset+2])[0]
+    for i in range(n_entries):
+        entry = offset + 2 + 12*i
+        tag, typ, count = struct.unpack(endian + 'HHI', tiff[entry:entry+8])
+        if tag not in wanted:
+            continue
+
+        size = TYPE_SIZES.get(typ, 1) * count
+        if size <= 4:
+            data = tiff[entry+8:entry+8+size]
+        else:
+            data_offset = struct.unpack(endian + 'I', tiff[entry+8:entry+12])[0]
+            data = tiff[data_offset:data_offset+size]
+
+        if typ == 3:
+            values[tag] = struct.unpack(endian + 'H', data[:2])[0]
+        elif typ == 4:
+            values[tag] = struct.unpack(endian + 'I', data[:4])[0]
+        elif typ == 2:
+            values[tag] = data.split(b'\x00', 1)[0].decode('ascii', 'replace').strip()
+    return values
@@ -0,0 +1,100 @@
+import os
+import threading
+
+"""Negative cache of image files that could not be opened or decoded.
+
+A corrupt file (e.g. from a bad card copy) would otherwise fail again every
+time a play method picks it, each time costing an open attempt out of the
+Manager's time budget. Failure_Cache remembers each failed file with its mtime,
+size and the reason it failed. Play methods skip the file until it changes on
+disk - a replaced or re-copied file gets another chance. A file that went
+missing is recorded with no mtime/size, and is retried once it reappears.
+
+The cache is saved in the catalog, so failures are remembered across restarts.
+"""
+
+def file_stat(path):
+    """Returns (mtime, size) of a file, or (None, None) if it doesn't exist"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None, None
+    return st.st_mtime, st.st_size
+
+
+class Failure_Cache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}    # path : (mtime, size, reason)
+        self.by_dir = {}     # directory path : set of failed paths in it
+
+        # Paths added/removed since the last save
+        self.changed = set()
+        self.removed = set()
+
+    def __contains__(self, path):
+        return path in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, path, reason):
+        """Record a failure to open path. Returns True if it wasn't recorded
+        already."""
+        mtime, size = file_stat(path)
+        with self.lock:
+            new = path not in self.entries
+            self.entries[path] = (mtime, size, reason)
+            self.by_dir.setdefault(os.path.dirname(path), set()).add(path)
+            self.changed.add(path)
+            self.removed.discard(path)
+        return new
+
+    def discard(self, path):
+        """Forget a failure. Returns True if path was recorded."""
+        with self.lock:
+            if self.entries.pop(path, None) is None:
+                return False
+            directory = os.path.dirname(path)
+            self.by_dir[directory].discard(path)
+            if not self.by_dir[directory]:
+                del self.by_dir[directory]
+            self.changed.discard(path)
+            self.removed.add(path)
+        return True
+
+    def is_bad(self, path):
+        """True if path failed before and hasn't changed since. O(1) for files
+        that never failed."""
+        entry = self.entries.get(path)
+        if entry is None:
+            return False
+        return file_stat(path) == entry[:2]
+
+    def in_directory(self, directory):
+        """Returns the set of failed paths in a directory"""
+        return self.by_dir.get(directory, set())
+
+    def reason(self, path):
+        entry = self.entries.get(path)
+        return None if entry is None else entry[2]
+
+    def load(self, rows):
+        """Fill the cache from (path, mtime, size, reason) rows"""
+        with self.lock:
+            self.entries = {path : (mtime, size, reason) for path, mtime, size, reason in rows}
+            self.by_dir = {}
+            for path in self.entries:
+                self.by_dir.setdefault(os.path.dirname(path), set()).add(path)
+            self.changed = set()
+            self.removed = set()
+
+    def take_changes(self):
+        """Returns the ([(path, mtime, size, reason)], [path]) rows added and
+        removed since the last call"""
+        with self.lock:
+            added = [(p,) + self.entries[p] for p in self.changed if p in self.entries]
+            removed = list(self.removed)
+            self.changed = set()
+            self.removed = set()
+        return added, removed
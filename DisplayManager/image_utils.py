@@ -0,0 +1,88 @@
+import config
+from PIL import Image, ImageFilter
+
+import database
+
+"""Preparing a decoded PIL image for display: orientation, size, blurred edges.
+
+None of this needs the display, so it can run on any thread (see prefetch.py),
+leaving only the texture upload to the Viewer.
+"""
+
+# -------------------------------------------------
+# NOTE - For all functions, size = (width, height)
+# -------------------------------------------------
+
+# Transposes that undo each EXIF orientation. Rotations are counter clockwise.
+ORIENTATION_TRANSPOSES = {
+    2 : (Image.FLIP_LEFT_RIGHT,),
+    3 : (Image.ROTATE_180,),
+    4 : (Image.FLIP_TOP_BOTTOM,),
+    5 : (Image.FLIP_LEFT_RIGHT, Image.ROTATE_270),
+    6 : (Image.ROTATE_270,),
+    7 : (Image.FLIP_LEFT_RIGHT, Image.ROTATE_90),
+    8 : (Image.ROTATE_90,),
+    }
+
+def get_orientation(img):
+    """Read exif data to get orientation. Returns an oriention of 1 if no exif
+    data is found. """
+    orientation = 1
+    try:
+        exif_data = img._getexif()
+        if database.EXIF_ORIENTATION in exif_data:
+            orientation = int(exif_data[database.EXIF_ORIENTATION])
+    except Exception: # Should really check error here but it's almost certainly due to lack of exif data
+        pass
+
+    return orientation
+
+def limit_size(img, max_dimension):
+    """Scales img down so neither side is larger than max_dimension"""
+    (w, h) = img.size
+    if w > max_dimension:
+        img = img.resize((max_dimension, int(h * max_dimension / w)), resample=Image.BICUBIC)
+    elif h > max_dimension:
+        img = img.resize((int(w * max_dimension / h), max_dimension), resample=Image.BICUBIC)
+    return img
+
+def orient_image(img, orientation):
+    """Returns img turned the right way up for its EXIF orientation"""
+    for transpose in ORIENTATION_TRANSPOSES.get(orientation, ()):
+        img = img.transpose(transpose)
+    return img
+
+def blur_edges(img, size):
+    """If img doesn't have the aspect ratio of size, returns it on a blurred,
+    zoomed in copy of itself that fills size. Otherwise returns img."""
+    wh_rat = (size[0] * img.size[1]) / (size[1] * img.size[0])
+    if abs(wh_rat - 1.0) <= 0.01:
+        return img
+
+    (sc_b, sc_f) = (size[1] / img.size[1], size[0] / img.size[0])
+    if wh_rat > 1.0:
+        (sc_b, sc_f) = (sc_f, sc_b) # swap round
+    (w, h) =  (round(size[0] / sc_b / config.BLUR_ZOOM), round(size[1] / sc_b / config.BLUR_ZOOM))
+    (x, y) = (round(0.5 * (img.size[0] - w)), round(0.5 * (img.size[1] - h)))
+    box = (x, y, x + w, y + h)
+    blr_sz = tuple(int(x * 512 / size[0]) for x in size)
+    img_b = img.resize(size, resample=0, box=box).resize(blr_sz)
+    img_b = img_b.filter(ImageFilter.GaussianBlur(config.BLUR_AMOUNT))
+    img_b = img_b.resize(size, resample=Image.BICUBIC)
+    img_b.putalpha(round(255 * config.EDGE_ALPHA))  # to apply the same EDGE_ALPHA as the no blur method.
+    img = img.resize(tuple(int(x * sc_f) for x in img.size), resample=Image.BICUBIC)
+    img_b.paste(img, box=(round(0.5 * (img_b.size[0] - img.size[0])),
+                          round(0.5 * (img_b.size[1] - img.size[1]))))
+    return img_b # have to do this as paste applies in place
+
+def prepare_image(img, orientation, size, max_dimension):
+    """Everything that is done to a decoded image before it becomes a texture:
+    read the orientation if the Manager doesn't know it yet, scale it down to
+    max_dimension, turn it the right way up and blur the edges if configured."""
+    if orientation == database.ORIENTATION_PENDING:
+        orientation = get_orientation(img)
+    img = limit_size(img, max_dimension)
+    img = orient_image(img, orientation)
+    if config.BLUR_EDGES:
+        img = blur_edges(img, size)
+    return img
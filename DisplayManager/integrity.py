@@ -0,0 +1,186 @@
+import os
+import time
+import logging
+import threading
+
+from PIL import Image
+
+import config
+from catalog import Catalog
+from failures import file_stat
+
+"""Background integrity check of the picture library.
+
+A JPEG cut short by an interrupted copy is otherwise only found when the
+Manager tries to show it. Integrity_Sweeper walks the library during idle time
+and checks each picture that hasn't been checked in its current state:
+
+1. A cheap header check - the file starts with the signature of its format.
+2. A full check - Image.verify(), then a decode. JPEGs are decoded at reduced
+   size with draft(), which still reads all the compressed data - unless the
+   file doesn't end with the end of image marker. Truncated copies don't, but
+   neither do valid JPEGs with data appended (e.g. the video of a Motion
+   Photo, or a camera maker's trailer), so those are decoded in full, and only
+   fail if that decode does.
+
+Bad files go into the database's failure cache, so the play methods skip them
+until they change. Files that passed are recorded in the catalog with their
+(mtime, size), so they aren't checked again until they change either.
+
+The sweep runs with a low thread priority, stays away from the disk while the
+Viewer is loading pictures, and sleeps long enough after each file to keep its
+share of the time below DUTY_CYCLE.
+"""
+
+# File signatures by extension. Formats not listed only get the full check.
+SIGNATURES = {
+    '.jpg'  : (b'\xff\xd8\xff',),
+    '.jpeg' : (b'\xff\xd8\xff',),
+    '.png'  : (b'\x89PNG\r\n\x1a\n',),
+    '.gif'  : (b'GIF87a', b'GIF89a'),
+    '.tif'  : (b'II*\x00', b'MM\x00*'),
+    '.tiff' : (b'II*\x00', b'MM\x00*'),
+    }
+JPEG_EOI = b'\xff\xd9'
+
+def check_header(path):
+    """Returns None if the file starts like its format should, or the reason 
+    it doesn't"""
+    ext = os.path.splitext(path)[1].lower()
+    signatures = SIGNATURES.get(ext)
+    if signatures is None:
+        return None
+    with open(path, 'rb') as f:
+        head = f.read(8)
+    if not any(head.startswith(sig) for sig in signatures):
+        return "Not a {} file".format(ext[1:].upper())
+    return None
+
+def ends_with_eoi(path):
+    """True if the file ends with the JPEG end of image marker"""
+    with open(path, 'rb') as f:
+        # Some cameras pad the file after the end of image marker
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - 32))
+        return JPEG_EOI in f.read()
+
+def check_image(path):
+    """Returns None if the image decodes, or the reason it doesn't"""
+    reason = check_header(path)
+    if reason is not None:
+        return reason
+    if os.path.splitext(path)[1].lower() in ('.heif', '.heic'):
+        return None # needs pyheif - left to Manager.open_pic
+    try:
+        with Image.open(path) as im:
+            im.verify()
+        # verify() leaves the image unusable, so it is opened again to decode
+        with Image.open(path) as im:
+            if im.format == 'JPEG' and ends_with_eoi(path):
+                im.draft('RGB', (im.size[0] // 8, im.size[1] // 8))
+            im.load()
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError) as e:
+        return "{}: {}".format(type(e).__name__, e)
+    return None
+
+
+class Integrity_Sweeper:
+    # Class Constants
+    DUTY_CYCLE = 0.1        # largest share of the time spent checking
+    QUIET_PERIOD = 2.0      # sec the Viewer must have left the disk alone before checking a file
+    REST_PERIOD = 6 * 3600  # sec between sweeps of the whole library
+
+    def __init__(self, pic_db, viewer_idle=None):
+        self.alive = True
+        self.pic_db = pic_db
+        self.viewer_idle = viewer_idle # Function returning the sec since the Viewer last loaded a picture, 0 while loading
+        self.wake = threading.Event()
+        self.n_checked = 0
+        self.n_bad = 0
+
+    def kill(self):
+        self.alive = False
+        self.wake.set()
+
+    def run(self):
+        # Linux gives each thread its own nice value
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        except (AttributeError, OSError):
+            pass
+
+        while self.alive:
+            self.sweep()
+            self.wake.wait(self.REST_PERIOD)
+            self.wake.clear()
+
+    def sweep(self):
+        """Check every picture that hasn't been checked in its current state"""
+        t_start = time.time()
+        self.n_checked = 0
+        self.n_bad = 0
+        cat = Catalog(config.CATALOG_PATH)
+        try:
+            with self.pic_db.lock:
+                paths = list(self.pic_db.keys())
+            for path in paths:
+                if not self.alive:
+                    return
+                if self.pic_db.is_online(path):
+                    self.sweep_directory(cat, path)
+        finally:
+            cat.close()
+        if self.n_checked > 0:
+            logging.info("Integrity check of {} images done in {:.1f} sec: {} bad".format(
+                self.n_checked, time.time()-t_start, self.n_bad))
+
+    def sweep_directory(self, cat, path):
+        img_dir = self.pic_db.get(path)
+        if img_dir is None or len(img_dir.images) == 0:
+            return
+        verified = cat.load_verified(path)
+        still_verified = {}
+        changed = False
+        for img in list(img_dir.images):
+            if not self.alive:
+                break
+            pic_path = os.path.join(path, img.fname)
+            stat = file_stat(pic_path)
+            if stat[0] is None:
+                changed = True
+                continue
+            if verified.get(img.fname) == stat:
+                still_verified[img.fname] = stat
+                continue
+            if self.pic_db.is_failed(pic_path):
+                continue
+
+            self.wait_for_quiet()
+            t_start = time.time()
+            try:
+                reason = check_image(pic_path)
+            except OSError as e:
+                if not self.pic_db.is_online(path):
+                    return # drive unplugged mid sweep
+                reason = "{}: {}".format(type(e).__name__, e)
+            self.n_checked += 1
+            changed = True
+            if reason is None:
+                still_verified[img.fname] = stat
+            else:
+                self.n_bad += 1
+                self.pic_db.add_failure(pic_path, reason)
+
+            # Keep to the duty cycle
+            time.sleep((time.time() - t_start) * (1.0 / self.DUTY_CYCLE - 1.0))
+
+        if changed or len(still_verified) != len(verified):
+            cat.save_verified(path, [(fname, mtime, size) for fname, (mtime, size) in still_verified.items()])
+
+    def wait_for_quiet(self):
+        """Returns once the Viewer hasn't loaded a picture for QUIET_PERIOD"""
+        while self.alive and self.viewer_idle is not None:
+            idle = self.viewer_idle()
+            if idle >= self.QUIET_PERIOD:
+                return
+            time.sleep(self.QUIET_PERIOD - idle)
@@ -10,6 +10,7 @@ import logging
 import threading
 import time
 import os, sys
+import signal
 import config
 
 from viewer import ViewerPi3D
@@ -34,9 +35,24 @@ def check_keyboard(kbd):
         #if next_pic_num < -1:
                 #next_pic_num = -1
 
+def stop_on_sigterm(signum, frame):
+    """Shut down as on Ctrl-C when the system stops the frame, e.g. for a 
+    reboot, so the warm start pictures and play state are saved"""
+    raise KeyboardInterrupt
+
+def shutdown(viewer, manager, manager_thread):
+    """Save the Viewer's pictures for a warm start, then stop the Manager. Its
+    final save of the play state carries on from the pictures saved."""
+    signal.signal(signal.SIGTERM, signal.SIG_IGN) # Don't cut the saving short
+    viewer.alive = False
+    viewer.cleanup()
+    manager.kill()
+    manager_thread.join()
+
 if __name__ == "__main__":
     
     try:
+        signal.signal(signal.SIGTERM, stop_on_sigterm)
         config.PIC_DIRS = []
 
         # Parse config file and extract parameters
@@ -100,11 +116,9 @@ if __name__ == "__main__":
         print("Exiting...")
         #kbd.close()
 
-        viewer.alive = False
-        manager.alive = False
+        shutdown(viewer, manager, manager_thread)
         sensor.alive = False
         
-        manager_thread.join()
         sensor_thread.join()
         
 
@@ -6,12 +6,21 @@ import numpy as np
 import random
 import os
 from PIL import Image, ExifTags, ImageFilter # these are needed for getting exif data from images
-from collections import namedtuple
+from collections import namedtuple, deque
 import itertools
 import bisect
+import json
 import logging
+import threading
 
 from database import *
+from enrich import Exif_Enricher
+from watcher import Directory_Watcher
+from duplicates import Duplicate_Finder
+from integrity import Integrity_Sweeper
+from schedule import Scheduler
+from volumes import get_volume_id
+from sampler import Weighted_Sampler, Indexed_Set, Shuffle
 
 """Exception Handling:
 1. What to do if no media is inserted at all?
@@ -19,19 +28,6 @@ from database import *
 
 """
 
-def weighted_choice(choices, weights):
-    """For Python >= 3.6 there exists the random.choices function to do a
-    weighted random choice. For lower versions, do the following """
-
-    # Arrange weights in a cumulative distribution. 
-    # E.g. weights [1,3,5] --> cumlist [1,4,9]
-    cumdist = list(itertools.accumulate(weights))
-    # Pick a random number within the range of cumdist
-    x = random.random() * cumdist[-1]
-    # Use bisect() to find the index where x would fall if sorted into cumdist
-    # E.g. x = 1.3 --> index 1 (falls between 1 and 4 in cumlist)
-    return choices[bisect.bisect(cumdist, x)]
-
 def convert_heif(fname):
     """Attempt to open .heif image file and return a PIL image object if 
     successful and None oterwise"""
@@ -43,29 +39,87 @@ def convert_heif(fname):
                                 "raw", heif_file.mode, heif_file.stride)
         return image
     except ImportError as e:
-        logger.error("Cannot handle .heif file. pyheif not installed.")
+        logging.error("Cannot handle .heif file. pyheif not installed.")
         raise ValueError("pyheif not installed")
 
 
 
 class Manager:
+    # Class Constants
+    SAVE_PERIOD = 300 # sec between writing database changes back to the catalog
+    FIRST_SCAN_DIRS = 20 # directories scanned before the Viewer is let go, the rest are scanned in the background
+
     def __init__(self):
         self.alive = True
-        self.ready = False
+        self.stop = threading.Event()   # Set by kill() to wake run() at once
+        self.ready = threading.Event()  # Set once there is something to play
+        self.t_start = time.time()
+        self.first_pic_shown = False
         
         self.settings = self.load_settings()
 
         # Can maintain multiple image storage locations 
-        self.root_dirs = config.PIC_DIRS
+        self.root_dirs = [os.path.abspath(d) for d in config.PIC_DIRS]
         self.pic_db = Image_Database()
 
-        # If no database can be loaded, start from scratch
+        # 1/0 mask to instruct play modes which subset of playlists are available
+        self.dirs_to_play = {}
+        # Function giving the flag of directories not in dirs_to_play (e.g. 
+        # found after the mask was set). None plays them.
+        self.dir_filter = None
+
+        # Number of images of each playable directory, by directory id. Kept up
+        # to date as directories change so play_randomly doesn't have to
+        # rebuild its weights on every pick.
+        self.pic_weights = Weighted_Sampler()
+        # Playable directories with images that can be opened, for the
+        # random playlist modes
+        self.playlists = Indexed_Set()
+        self.pic_db.on_directory_change = self.on_directory_changed
+        # Called after the play index changed, e.g. to wake a prefetcher that
+        # found nothing to play
+        self.on_play_index_change = None
+
+        # pic_db.version when the snapshot was last written, and whether the
+        # catalog has had changes since then
+        self.snapshot_version = None
+        self.snapshot_stale = False
+
+        # Saved positions of play methods, so they carry on where they were
+        # after a restart
+        self.play_state = self.load_play_state()
+        # JSON of the play state as last saved, so only what changed is written
+        self.saved_play_state = {name : json.dumps(value) for name, value in self.play_state.items()}
+        self.shuffle = Shuffle(state=self.play_state.get('shuffle'),     # Cursor of play_shuffled
+                               layout=self.play_state.get('shuffle_layout'))
+        self.seq_cursor = self.play_state.get('sequential') # (directory path, filename) played last by play_sequentially
+        # Pictures injected with enqueue_pic(), played before anything else.
+        # Those not played before a shutdown are played after the restart.
+        self.pic_queue = deque(self.play_state.get('queue', []))
+        self.queue_lock = threading.Lock()
+        self.play_method = None       # Set once the database is loaded
+
+        # If no database can be loaded, start from scratch. Otherwise load it 
+        # and scan only roots that are new since it was saved.
         if self.settings['Image DB'] is None:
-            self.load_all_dirs(config.PIC_DIRS)
-            logging.info("\n" + self.pic_db.__repr__())
-        # Otherwise prepare at least the first directory before Viewer starts
+            self.scanner = self.scan_roots(self.root_dirs)
         else:
-            self.prepare_first_playlist()
+            self.load_database()
+        self.dirs_to_play.update({img_dir : 1 for img_dir in self.pic_db.keys()})
+        self.rebuild_play_index()
+
+        # Scan just enough for the Viewer to start, the rest is done by run()
+        self.prepare_first_playlist()
+
+        # Fills in EXIF data of images scanned with config.DELAY_EXIF
+        self.enricher = Exif_Enricher(self.pic_db)
+        # Picks up pictures added to/removed from the picture roots
+        self.watcher = Directory_Watcher(self.pic_db)
+        self.watcher.on_change = self.on_db_change
+        # Finds copies of the same picture so they are only played once
+        self.duplicate_finder = Duplicate_Finder(self.pic_db, self.pic_db.duplicates)
+        # Finds corrupt pictures before they are played, when the Viewer is idle
+        self.sweeper = Integrity_Sweeper(self.pic_db, self.viewer_idle)
 
         self.current_playlist = None  # Image_Directory object
         self.current_pic = None       # Int index of current image
@@ -74,22 +128,51 @@ class Manager:
         self.counter = 0
         self.pic_idxs = []
         self.now_imgs = []
-        self.pic_queue = []
+        self.pick_lock = threading.Lock() # Serialises the play method
+        self.on_enqueue = None        # Called after a picture is injected, e.g. to wake the prefetcher
+        self.pick_error = False       # True if the last pick failed (e.g. nothing to play) rather than being skipped
+        self.open_lock = threading.Lock()
+        self.n_opening = 0            # open_pic() calls in progress
+        self.t_last_open = 0.0        # When the last open_pic() call finished
+        # (path, orientation) of the pictures shown, oldest first, for going back
+        self.history = deque(maxlen=max(1, config.HISTORY_SIZE))
+        self.history_start = 0        # Number of pictures that dropped off the front of history
+        self.history_pos = None       # Number (history_start + index) of the picture on screen
+        self.history_lock = threading.Lock()
         self.return_playlist = None
         self.return_pic = None
         self.return_play_method = None
+        self.date_from = None         # Date range for play_date_range, seconds since epoch
+        self.date_to = None
+        self.date_last = None         # (date, key) of the last date index entry played
+        self.seq_iter = None          # pic_db.iter_tree() generator for play_sequentially
         # -----------------------------------------
 
+        # Play methods by the names used in schedules and the saved play state
+        self.play_methods = {'random' : self.play_randomly,
+                             'random_playlist' : self.play_random_playlist,
+                             'random_playlist_randomly' : self.play_random_playlist_randomly,
+                             'sequential' : self.play_sequentially,
+                             'shuffled' : self.play_shuffled,
+                             'date_range' : self.play_date_range}
+
         #self.set_play_method(self.play_randomly)
         #self.set_play_method(self.play_random_playlist)
+        #self.set_play_method(self.play_shuffled)
         self.set_play_method(self.play_random_playlist_randomly)
-
-        # 1/0 mask to instruct play modes which subset of playlists are available
-        self.dirs_to_play = {img_dir : 1 for img_dir in self.pic_db.keys()}
+        self.default_play_method = self.play_method
 
         # Testing 
-        self.dirs_to_play['/home/diehl/Pictures'] = 0
-        self.dirs_to_play['/home/diehl/Pictures/Sub1'] = 0
+        self.set_dir_to_play('/home/diehl/Pictures', 0)
+        self.set_dir_to_play('/home/diehl/Pictures/Sub1', 0)
+
+        # Sets dirs_to_play and the play method from the calendar schedule
+        self.scheduler = Scheduler(self, config.SCHEDULE_PATH)
+        if config.SCHEDULE_PATH:
+            self.scheduler.update()
+
+        # Carry on with the playlist that was playing at the last shutdown
+        self.restore_play_position()
 
     
     def run(self):
@@ -97,84 +180,427 @@ class Manager:
         and in handling logic of which image to hand off next to Viewer. The run
         function handles the first part of those responsibilities"""
 
-        self.ready = True # TODO - move this to init function
-        while self.alive:
-            time.sleep(0.5)
+        enricher_thread = threading.Thread(target=self.enricher.run, name="ExifEnricher", daemon=True)
+        enricher_thread.start()
+        if config.SCHEDULE_PATH:
+            scheduler_thread = threading.Thread(target=self.scheduler.run, name="Scheduler", daemon=True)
+            scheduler_thread.start()
+        # Finishes the startup scan, then starts the watcher and duplicate finder
+        scanner_thread = threading.Thread(target=self.finish_scan, name="Scanner", daemon=True)
+        scanner_thread.start()
+
+        # Nothing to do between saves, other than react to kill()
+        while not self.stop.wait(self.SAVE_PERIOD):
+            self.save_database()
+
+        self.enricher.kill()
+        self.watcher.kill()
+        self.duplicate_finder.kill()
+        self.sweeper.kill()
+        self.scheduler.kill()
+        self.save_database(final=True)
+
+    def kill(self):
+        self.alive = False
+        self.stop.set()
+
+    def finish_scan(self):
+        """Scan the directories prepare_first_playlist() left for later. The 
+        watcher and duplicate finder only start once the tree is complete, as
+        both walk the whole database."""
+        t_start = time.time()
+        n_dirs = 0
+        for img_dir in self.scanner:
+            n_dirs += 1
+            if not self.alive:
+                return
+        if n_dirs > 0:
+            logging.info("Background scan of {} more folders done in {:.1f} sec".format(
+                n_dirs, time.time()-t_start))
+        if n_dirs + self.n_first_scan > 0:
+            self.save_database()
+            logging.info("\n" + self.pic_db.summary())
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug("\n" + self.pic_db.__repr__())
+
+        watcher_thread = threading.Thread(target=self.watcher.run, name="DirWatcher", daemon=True)
+        watcher_thread.start()
+        if config.SKIP_DUPLICATES:
+            duplicate_thread = threading.Thread(target=self.duplicate_finder.run, name="DupFinder", daemon=True)
+            duplicate_thread.start()
+        if config.VERIFY_LIBRARY:
+            sweeper_thread = threading.Thread(target=self.sweeper.run, name="Sweeper", daemon=True)
+            sweeper_thread.start()
+
+    def on_db_change(self, paths):
+        """Called by the watcher after directories in pic_db were rescanned"""
+        self.duplicate_finder.directories_changed(paths)
             
     def enqueue_pic(self, filename):
-        self.pic_queue.append(filename)
+        """Play filename next, ahead of the play method. Can be called from any
+        thread."""
+        with self.queue_lock:
+            self.pic_queue.append(filename)
+        if self.on_enqueue is not None:
+            self.on_enqueue()
+
+    def record_shown(self, path, orientation, number=None):
+        """Called by the Viewer when a picture goes on screen. number is its 
+        place in the history if it was taken from there, None if it is new."""
+        with self.history_lock:
+            if number is None:
+                if len(self.history) == self.history.maxlen:
+                    self.history_start += 1
+                self.history.append((path, orientation))
+                self.history_pos = self.history_start + len(self.history) - 1
+            elif number >= self.history_start:
+                self.history_pos = number
+
+    def history_entry(self, offset):
+        """Returns (number, (path, orientation)) of the picture offset places
+        from the one on screen in the history, or None if there is none"""
+        with self.history_lock:
+            if self.history_pos is None:
+                return None
+            number = self.history_pos + offset
+            i = number - self.history_start
+            if 0 <= i < len(self.history):
+                return number, self.history[i]
+            return None
+
+    def take_queued_pic(self):
+        """Returns the oldest injected picture, or None if there is none"""
+        with self.queue_lock:
+            return self.pic_queue.popleft() if self.pic_queue else None
 
     def get_next_pic(self):
         """Main method called by Viewer to get the next picture to be played. 
         Attempts for 1/2 frame delay time to find an image that can be opened 
         as a PIL image object. If an image object cannot be created in that time,
-        then the default error image is passed to the viewer.
-        
-        TODO: Must be thread safe."""
+        then the default error image is passed to the viewer."""
 
         t_timeout = time.time() + config.TIME_DELAY/2
 
         while time.time() < t_timeout:
-            try:
-                # If we have pictures in our local queue, return those first
-                if len(self.pic_queue) > 0:
-                    pic_path = self.pic_queue[0]
-                    self.pic_queue = self.pic_queue[1:]
-                    img_tuple = Img_Tup(pic_path, 1, 0)
-                else: 
-                    # Otherwise, run the chosen play method to find the next image
-                    self.play_method()
-                    img_tuple = self.current_playlist.images[self.current_pic]
-                    pic_path = os.path.join(self.current_playlist.path, img_tuple.fname)
-
-                if os.path.isfile(pic_path):
-                    ext = os.path.splitext(pic_path)[1].lower()
-                    if ext in ('.heif','.heic'):
-                        im = self.convert_heif(pic_path)
-                    else:
-                        im = Image.open(pic_path)
-
-                    logging.info("Next playing: {}, pic: {} ({})".format(self.current_playlist.path, 
-                        img_tuple.fname, self.current_pic ))
-
-                    return im, img_tuple.orientation
-
-                else: 
-                    logging.error("manager.get_next_pic() - Could not find " + pic_path)
-
-            except Exception as e:
-                    logging.error("Error obtaining image file: ", e)
+            pic = self.pick_next_pic()
+            if pic is None:
+                continue
+            im = self.open_pic(pic[0])
+            if im is not None:
+                return im, pic[1]
 
         return {"path" : "PictureFrame2020img.jpg", "orientation" : 1 }
 
+    def pick_next_pic(self):
+        """Choose the next picture to play, without opening it. Returns 
+        (path, orientation), or None if the pick has to be skipped (e.g. the 
+        file failed to open before) and another one should be made."""
+        # If we have pictures in our local queue, return those first
+        pic_path = self.take_queued_pic()
+        if pic_path is not None:
+            return pic_path, ORIENTATION_PENDING
+
+        with self.pick_lock:
+            return self.pick_from_play_method()
+
+    def pick_from_play_method(self):
+        self.pick_error = False
+        try:
+            # Run the chosen play method to find the next image. Hold the
+            # database lock so the watcher can't change it underneath.
+            with self.pic_db.lock:
+                self.play_method()
+            img_tuple = self.current_playlist.images[self.current_pic]
+            pic_path = os.path.join(self.current_playlist.path, img_tuple.fname)
+
+            # Files that failed to open before are skipped until they change
+            if self.pic_db.is_failed(pic_path):
+                return None
+
+            # Only one copy of each duplicate group is played - the first one
+            # in a directory that is played
+            if config.SKIP_DUPLICATES and self.pic_db.duplicates.is_duplicate(pic_path, self.playable):
+                return None
+
+            # Get the enricher working on this playlist, and read the 
+            # EXIF data of this image now if it hasn't been done yet
+            if self.current_playlist.exif_pending > 0:
+                self.enricher.prioritise(self.current_playlist)
+                if img_tuple.orientation == ORIENTATION_PENDING:
+                    self.enricher.enrich_image(self.current_playlist, self.current_pic)
+                    img_tuple = self.current_playlist.images[self.current_pic]
+
+            logging.info("Next playing: {}, pic: {} ({})".format(self.current_playlist.path, 
+                img_tuple.fname, self.current_pic ))
+            return pic_path, img_tuple.orientation
+
+        except Exception as e:
+            logging.error("Error obtaining image file: {}".format(e))
+            self.pick_error = True
+            return None
+
+    def open_pic(self, pic_path):
+        """Open and decode a picture chosen by pick_next_pic(). Returns the PIL
+        image, or None if it can't be opened - it is then skipped until the file
+        changes. Safe to call from any thread."""
+        with self.open_lock:
+            self.n_opening += 1
+        try:
+            return self.open_pic_file(pic_path)
+        finally:
+            with self.open_lock:
+                self.n_opening -= 1
+                self.t_last_open = time.time()
+
+    def viewer_idle(self):
+        """Seconds since a picture was last opened for display, 0 while one is
+        being opened. Background work that reads the disk waits for this."""
+        with self.open_lock:
+            return 0.0 if self.n_opening > 0 else time.time() - self.t_last_open
+
+    def open_pic_file(self, pic_path):
+        if not os.path.isfile(pic_path):
+            logging.error("manager.get_next_pic() - Could not find " + pic_path)
+            self.pic_db.add_failure(pic_path, "File not found")
+            return None
+
+        ext = os.path.splitext(pic_path)[1].lower()
+        try:
+            if ext in ('.heif','.heic'):
+                im = convert_heif(pic_path)
+            else:
+                im = Image.open(pic_path)
+                # Decode now, so a corrupt file fails here rather than in the
+                # Viewer. PIL keeps the decoded data, so it isn't done twice.
+                im.load()
+        except (OSError, SyntaxError, Image.DecompressionBombError) as e:
+            self.pic_db.add_failure(pic_path, "{}: {}".format(type(e).__name__, e))
+            return None
+        except Exception as e:
+            logging.error("Error opening image file {}: {}".format(pic_path, e))
+            return None
+
+        if not self.first_pic_shown:
+            self.first_pic_shown = True
+            logging.info("Time to first image: {:.2f} sec ({} folders scanned)".format(
+                time.time()-self.t_start, len(self.pic_db)))
+        return im
 
     def load_all_dirs(self, root_dirs):
         """Method to recursively search from give root directories and add all 
         directories to the database"""
+        for img_dir in self.scan_roots(root_dirs):
+            pass
+
+    def scan_roots(self, root_dirs):
+        """Generator that scans the given root directories, adding each 
+        directory to the database and to dirs_to_play as soon as it is read. 
+        Yields the Image_Directory objects, so the caller can stop and resume
+        the scan (also from another thread)."""
         for root_dir in root_dirs:
-            t_start = time.time()
-            self.pic_db.add_directory(root_dir)
-
             # Keep track of root names
             if root_dir not in self.pic_db.roots:
                 self.pic_db.roots.append(root_dir)
 
-            # Recursively add all subdirectories to pic_db
-            for root, dirnames, filenames in os.walk(root_dir):
-                for directory in dirnames:
-                    self.pic_db.add_directory(os.path.join(root, directory))
+            # A drive that isn't plugged in yet is scanned by the watcher once it is
+            if not self.pic_db.root_available(root_dir):
+                self.pic_db.set_offline(root_dir)
+                continue
+            self.pic_db.volumes[root_dir] = get_volume_id(root_dir)
+
+            t_start = time.time()
+            n_dirs = 0
 
-            logging.info("Image root {:} loaded in {:.1f} sec: ".format(root_dir, time.time()-t_start))
+            # Subtrees are scanned in parallel. Each directory is read once.
+            for img_dir in scan_tree(root_dir):
+                self.pic_db.insert_directory(img_dir)
+                self.dirs_to_play.setdefault(img_dir.path, self.default_to_play(img_dir.path))
+                n_dirs += 1
+                yield img_dir
+
+            logging.info("Image root {:} loaded in {:.1f} sec ({} folders, {} scan workers)".format(
+                root_dir, time.time()-t_start, n_dirs, config.SCAN_WORKERS))
 
     def load_settings(self):
-        return ({'Image DB' : None, 
+        image_db = config.CATALOG_PATH if os.path.isfile(config.CATALOG_PATH) else None
+        return ({'Image DB' : image_db, 
                  '1' : 0})
 
     def load_database(self):
+        """Load the saved catalog, then only rescan directories that changed on
+        disk since it was written. The snapshot is used instead of the catalog
+        if there is a usable one."""
+        t_start = time.time()
+        source = None
+        if config.SNAPSHOT_PATH and os.path.isfile(config.SNAPSHOT_PATH):
+            try:
+                self.pic_db.load_snapshot(config.SNAPSHOT_PATH)
+                self.pic_db.load_failures(self.settings['Image DB'])
+                self.pic_db.load_duplicates(self.settings['Image DB'])
+                source = config.SNAPSHOT_PATH
+                self.snapshot_version = self.pic_db.version
+            except (OSError, ValueError, KeyError) as e:
+                logging.warning("Could not load snapshot {}: {}. Using the catalog.".format(
+                    config.SNAPSHOT_PATH, e))
+        if source is None:
+            source = self.settings['Image DB']
+            self.pic_db.load_database(source)
+            self.snapshot_stale = True
+        logging.info("Image database loaded from {:} in {:.2f} sec".format(
+            source, time.time()-t_start))
+
+        # Roots may have been added to or removed from picframe.config
+        for root_dir in list(self.pic_db.roots):
+            if root_dir not in self.root_dirs:
+                self.pic_db.remove_directory(root_dir)
+                self.pic_db.roots.remove(root_dir)
+                self.pic_db.volumes.pop(root_dir, None)
+        self.scanner = self.scan_roots([d for d in self.root_dirs if d not in self.pic_db.roots])
+
+        # Roots on drives that aren't plugged in keep their cataloged entries.
+        # The others only have directories whose mtime changed re-listed.
+        t_start = time.time()
+        self.pic_db.check_volumes()
+        n_rescanned = 0
+        for root_dir in self.pic_db.roots:
+            if root_dir not in self.pic_db.offline:
+                n_rescanned += self.pic_db.revalidate_root(root_dir)
+        logging.info("Rescanned {:} changed directories in {:.1f} sec".format(
+            n_rescanned, time.time()-t_start))
+        self.save_database()
+
+    def save_database(self, final=False):
+        """Write any changed directories back to the catalog. The snapshot is
+        rewritten if directories were added, rescanned or removed since it was
+        last written - or, on the final save, if anything changed at all."""
+        try:
+            if self.pic_db.save_database(config.CATALOG_PATH) > 0:
+                self.snapshot_stale = True
+        except Exception as e:
+            logging.error("Could not save image database: {}".format(e))
+        self.save_play_state()
+
+        if config.SNAPSHOT_PATH and self.snapshot_stale and (final or 
+                self.pic_db.version != self.snapshot_version):
+            t_start = time.time()
+            version = self.pic_db.version
+            try:
+                self.pic_db.save_snapshot(config.SNAPSHOT_PATH)
+                self.snapshot_version = version
+                self.snapshot_stale = False
+                logging.info("Snapshot {} written in {:.1f} sec".format(
+                    config.SNAPSHOT_PATH, time.time()-t_start))
+            except Exception as e:
+                logging.error("Could not write snapshot: {}".format(e))
+
+    def load_play_state(self):
+        """Returns the play state saved in the catalog, or {} if there is none"""
+        if self.settings['Image DB'] is None:
+            return {}
+        try:
+            cat = Catalog(self.settings['Image DB'])
+            try:
+                return cat.load_state()
+            finally:
+                cat.close()
+        except Exception as e:
+            logging.warning("Could not load play state: {}".format(e))
+            return {}
+
+    def save_play_state(self):
+        with self.pic_db.lock:
+            self.play_state['shuffle'] = self.shuffle.state()
+            self.play_state['shuffle_layout'] = self.shuffle.layout()
+            self.play_state['sequential'] = self.seq_cursor
+            # The position saved last time is kept until the play method is
+            # set up, so it can be restored
+            if self.play_method is not None:
+                self.play_state['position'] = self.play_position()
+        with self.queue_lock:
+            self.play_state['queue'] = list(self.pic_queue)
+        try:
+            saved = {name : json.dumps(value) for name, value in self.play_state.items()}
+            changed = {name : value for name, value in self.play_state.items() 
+                       if saved[name] != self.saved_play_state.get(name)}
+            if not changed:
+                return
+            cat = Catalog(config.CATALOG_PATH)
+            try:
+                cat.save_state(changed)
+            finally:
+                cat.close()
+            self.saved_play_state = saved
+        except Exception as e:
+            logging.error("Could not save play state: {}".format(e))
+
+    def play_method_name(self):
+        """Name of the current play method in play_methods, None for play_now"""
+        for name, method in self.play_methods.items():
+            if method == self.play_method:
+                return name
         return None
 
+    def play_position(self):
+        """Where the current play method is in its playlist, for the play 
+        state. Shuffle and sequential play keep their own cursors."""
+        name = self.play_method_name()
+        if name is None or self.current_playlist is None:
+            return None
+        position = {'method' : name,
+                    'path' : self.current_playlist.path,
+                    'pic' : self.current_pic}
+        if name == 'random_playlist_randomly':
+            position['counter'] = self.counter
+            position['pic_idxs'] = self.pic_idxs
+        elif name == 'date_range':
+            position['date_range'] = (self.date_from, self.date_to)
+            position['date_last'] = self.date_last
+        return position
+
+    def restore_play_position(self):
+        """Restore the position saved by play_position(), if the same play 
+        method is in force and the playlist hasn't changed since"""
+        position = self.play_state.get('position')
+        if not position or position['method'] != self.play_method_name():
+            return
+        with self.pic_db.lock:
+            img_dir = self.pic_db.get(position['path'])
+            if img_dir is None or not self.playable(img_dir.path):
+                return
+            n = len(img_dir.images)
+            if position['pic'] is None or not 0 <= position['pic'] < n:
+                return
+            if position['method'] == 'random_playlist_randomly':
+                if sorted(position['pic_idxs']) != list(range(n)):
+                    return
+                self.counter = position['counter']
+                self.pic_idxs = position['pic_idxs']
+            elif position['method'] == 'date_range':
+                if tuple(position['date_range']) != (self.date_from, self.date_to):
+                    return
+                self.date_last = tuple(position['date_last'])
+            self.current_playlist = img_dir
+            self.current_pic = position['pic']
+        logging.info("Resuming {} at {} ({})".format(position['method'], img_dir.path, self.current_pic))
+
     def prepare_first_playlist(self):
-        return None
+        """Scan until there is something to play - at least FIRST_SCAN_DIRS 
+        directories and one picture - then let the Viewer start. The play 
+        method picks the first playlist from whatever has been found so far,
+        and sees the rest of the library appear as finish_scan() goes on."""
+        have_pics = any(self.pic_db[r].sub_pics > 0 for r in self.pic_db.roots
+                        if r in self.pic_db and r not in self.pic_db.offline)
+        n_dirs = 0
+        for img_dir in self.scanner:
+            n_dirs += 1
+            have_pics = have_pics or len(img_dir.images) > 0
+            if have_pics and n_dirs >= self.FIRST_SCAN_DIRS:
+                break
+
+        self.n_first_scan = n_dirs
+        self.ready.set()
+        logging.info("Ready to play after {:.2f} sec ({} folders in database, {} scanned so far)".format(
+            time.time()-self.t_start, len(self.pic_db), n_dirs))
 
     def set_play_method(self, method):
         """Expect method to be a callback function"""
@@ -186,7 +612,84 @@ class Manager:
     def play_mask(self, playlists): 
         """Applies the dirs_to_play mask to return a subset of playlists available
         to play. Expect all play methods to call this function"""
-        return [x for x in playlists if self.dirs_to_play[x]]
+        return [x for x in playlists if self.playable(x)]
+
+    def set_dir_to_play(self, path, flag):
+        """Set the dirs_to_play flag of a directory. Use this rather than
+        changing dirs_to_play directly, so the play index follows."""
+        with self.pic_db.lock:
+            self.dirs_to_play[path] = flag
+            self.on_directory_changed(path)
+
+    def on_directory_changed(self, path):
+        """Called by pic_db (under its lock) when a directory was added,
+        rescanned or removed, or its drive went away or came back"""
+        self.index_directory(path)
+        if self.on_play_index_change is not None:
+            self.on_play_index_change()
+
+    def index_directory(self, path):
+        """Update the play index entries of the directory at path"""
+        img_dir = self.pic_db.get(path)
+        if img_dir is not None and self.playable(path):
+            self.pic_weights.set(self.pic_db.get_dir_id(path), len(img_dir.images))
+            self.shuffle.add(path, len(img_dir.images))
+            if len(img_dir.images) > img_dir.image_reads_failed:
+                self.playlists.add(path)
+            else:
+                self.playlists.discard(path)
+        else:
+            if path in self.pic_db.dir_ids:
+                self.pic_weights.set(self.pic_db.dir_ids[path], 0)
+            self.playlists.discard(path)
+
+    def rebuild_play_index(self):
+        """Recompute the play index from scratch, e.g. after loading a snapshot
+        (which assigns new directory ids)"""
+        with self.pic_db.lock:
+            self.pic_weights.clear()
+            self.playlists.clear()
+            for path in self.pic_db.keys():
+                self.index_directory(path)
+        if self.on_play_index_change is not None:
+            self.on_play_index_change()
+
+    def playable(self, path):
+        """True if the directory at path is selected in dirs_to_play and its 
+        drive is plugged in"""
+        flag = self.dirs_to_play.get(path)
+        if flag is None:
+            flag = self.default_to_play(path)
+        return flag and self.pic_db.is_online(path)
+
+    def default_to_play(self, path):
+        """dirs_to_play flag of a directory that isn't in the mask yet"""
+        # Directories found after startup are played by default
+        return 1 if self.dir_filter is None else self.dir_filter(path)
+
+    def apply_schedule(self, selects, play=None, photos_from=None, photos_to=None):
+        """Switch to a schedule rule (see schedule.py). selects is a function
+        giving the dirs_to_play flag of a directory path, or None to play 
+        everything. play names the play method, None for the default one. 
+        photos_from/photos_to (date tuples) play a date range instead. The 
+        mask and play index are computed here, once, rather than on every pick.
+        Returns the number of directories selected."""
+        with self.pick_lock, self.pic_db.lock:
+            self.dir_filter = selects
+            if selects is None:
+                self.dirs_to_play = {path : 1 for path in self.pic_db.keys()}
+            else:
+                self.dirs_to_play = {path : selects(path) for path in self.pic_db.keys()}
+            self.rebuild_play_index()
+            self.seq_iter = None
+
+            if photos_from is not None or photos_to is not None:
+                self.set_date_range(photos_from, photos_to)
+            elif play is not None:
+                self.set_play_method(self.play_methods[play])
+            else:
+                self.set_play_method(self.default_play_method)
+            return sum(1 for flag in self.dirs_to_play.values() if flag)
 
     # *************** PLAY MODES *********************************************
 
@@ -203,12 +706,47 @@ class Manager:
         # To ensure a uniform probability over all pictures, must select playlists
         # using weighted distribution since not all playlists have same size.
         # This also neatly removes the chance of selecting playlist with zero pics.
-        playlists = self.play_mask(self.pic_db.keys())
-        weights = [len(self.pic_db[img_dir].images) for img_dir in playlists]
-        self.current_playlist = self.pic_db[weighted_choice(playlists, weights)]
+        # pic_weights holds the weights of playable directories, O(log n) a pick.
+        dir_id = self.pic_weights.sample()
+        if dir_id is None:
+            raise ValueError("No images to play")
+        self.current_playlist = self.pic_db[self.pic_db.dir_paths[dir_id]]
 
         # Pick a random image tuple index using a uniform distribution
-        self.current_pic = random.randint(0,len(self.current_playlist.images)-1)
+        self.current_pic = random.randrange(len(self.current_playlist.images))
+
+    def choose_playlist(self):
+        """Returns the path of a random playlist from the directories that have
+        images that can be opened. Uniform over playlists, and not the same
+        playlist twice in a row unless there is only a single playlist."""
+        current = None if self.current_playlist is None else self.current_playlist.path
+        path = self.playlists.choice(exclude=current)
+        if path is None:
+            raise ValueError("No images to play")
+        return path
+
+    def play_shuffled(self):
+        """Plays every image once, in random order, before repeating any. The
+        shuffle is over (directory path, image index) runs laid out by 
+        directory, so the order of the whole library is never stored - only a
+        seed, a cursor and a run per directory, which are saved with the play
+        state. Images added while a shuffle is under way are played in it, 
+        without moving the images already laid out. Images of directories
+        removed or not selected any more are skipped."""
+        for attempt in range(2):
+            pic = self.shuffle.next()
+            while pic is not None:
+                path, idx = pic
+                img_dir = self.pic_db.get(path)
+                if img_dir is not None and idx < len(img_dir.images) and self.playable(path):
+                    self.current_playlist = img_dir
+                    self.current_pic = idx
+                    return
+                pic = self.shuffle.next()
+            # Everything was played - shuffle the directories played now
+            self.shuffle.start([(path, len(img_dir.images)) for path, img_dir in self.pic_db.items()
+                                if self.playable(path)])
+        raise ValueError("No images to play")
 
     def play_random_playlist(self):
         """Selects a playlist at random and then sequentially plays the images
@@ -223,19 +761,7 @@ class Manager:
             load_new = True
 
         if load_new:
-            # Select directories that have images
-            playlists = [x for x in self.pic_db.keys() if len(self.pic_db[x].images) > 0 ]
-            playlists = self.play_mask(playlists)
-            
-            # Remove current playlist from list so we don't play the same 
-            # playlist twice in a row. Unless there is only a single playlist.
-            if self.current_playlist is not None:
-                if self.current_playlist.path in playlists and len(playlists) > 1:
-                    idx = playlists.index(self.current_playlist.path)
-                    playlists.pop(idx)
-
-            # Select playlist using uniform distribution
-            self.current_playlist = self.pic_db[playlists[random.randint(0, len(playlists)-1)]]
+            self.current_playlist = self.pic_db[self.choose_playlist()]
             self.current_pic = 0
 
         else:
@@ -255,19 +781,7 @@ class Manager:
             load_new = True
 
         if load_new:
-            # Select directories that have images
-            playlists = [x for x in self.pic_db.keys() if len(self.pic_db[x].images) > 0 ]
-            playlists = self.play_mask(playlists)
-
-            # Remove current playlist from list so we don't play the same 
-            # playlist twice in a row. Unless there is only a single playlist.
-            if self.current_playlist is not None:
-                if self.current_playlist.path in playlists and len(playlists) > 1:
-                    idx = playlists.index(self.current_playlist.path)
-                    playlists.pop(idx)
-
-            # Select playlist using uniform distribution
-            self.current_playlist = self.pic_db[playlists[random.randint(0, len(playlists)-1)]]
+            self.current_playlist = self.pic_db[self.choose_playlist()]
             
             self.pic_idxs = list(range(len(self.current_playlist.images)))
             random.shuffle(self.pic_idxs)
@@ -282,13 +796,61 @@ class Manager:
     def play_sequentially(self):
         """Plays images and playlists in order. Order = alphabetical, recursively
         goes traverses the directory tree in a depth first fashion"""
-        # playlists = self.play_mask(playlists)
-        pass
+        # Carries on after the last picture played, also after a restart. 
+        # Starts over from the first root once the whole tree has been played.
+        for attempt in range(2):
+            if self.seq_iter is None:
+                if self.seq_cursor is None:
+                    self.seq_iter = self.pic_db.iter_tree(include=self.playable)
+                else:
+                    self.seq_iter = self.pic_db.iter_tree_from(*self.seq_cursor, include=self.playable)
+            for img_dir, idx in self.seq_iter:
+                self.current_playlist = img_dir
+                self.current_pic = idx
+                self.seq_cursor = (img_dir.path, img_dir.images[idx].fname)
+                return
+            self.seq_iter = None
+            self.seq_cursor = None
+
+        raise ValueError("No images to play")
+
+    def set_date_range(self, dt_from=None, dt_to=None):
+        """Switch to playing the images taken between two dates. dt_from and 
+        dt_to are either None (open ended) or tuples (2016,12,25). Both dates
+        are inclusive."""
+        self.date_from = None if dt_from is None else time.mktime(tuple(dt_from) + (0, 0, 0, 0, 0, -1))
+        self.date_to = None if dt_to is None else time.mktime(tuple(dt_to) + (0, 0, 0, 0, 0, -1)) + 86400
+        self.date_last = None
+        self.set_play_method(self.play_date_range)
 
     def play_date_range(self):
         """Plays all images within a specified date range"""
-        # playlists = self.play_mask(playlists)
-        pass
+        # Images are played in date order, wrapping around at the end of the
+        # range. Only the position of the last image played is kept, so changes
+        # to the date index while playing are picked up automatically.
+        with self.pic_db.lock:
+            index = self.pic_db.date_index
+            lo, hi = index.range(self.date_from, self.date_to)
+            if lo == hi:
+                raise ValueError("No images in date range")
+
+            pos = lo if self.date_last is None else max(lo, index.position_after(*self.date_last))
+            for i in range(hi - lo):
+                if pos >= hi:
+                    pos = lo
+                date, dir_id, img_idx = index[pos]
+                img_dir = self.pic_db.get(self.pic_db.dir_paths[dir_id])
+                if img_dir is not None and self.playable(img_dir.path):
+                    break
+                pos += 1
+            else:
+                raise ValueError("No playable images in date range")
+
+            # Plain numbers - the index may be a view of a snapshot (numpy), 
+            # and date_last goes into the play state as JSON
+            self.date_last = (float(date), int(index.keys[pos]))
+            self.current_playlist = img_dir
+            self.current_pic = img_idx
 
     def set_play_now(self, img_dir, imgs=None):
         """Set up play mode that interrupts the current play mode to play a 
@@ -175,6 +175,7 @@ def get_files(dt_from=None, dt_to=None):
       mod_tm = os.stat(root).st_mtime # time of alteration in a directory
       if mod_tm > last_file_change:
         last_file_change = mod_tm
+      dir_files = [] # files in this directory, and their GPS info to look up in one batch
       for filename in filenames:
           ext = os.path.splitext(filename)[1].lower()
           if ext in extensions and not '.AppleDouble' in root and not filename.startswith('.'):
@@ -184,18 +185,24 @@ def get_files(dt_from=None, dt_to=None):
               dt = None # if exif data not read - used for checking in tex_load
               fdt = None
               location = ""
+              gps_info = None
               if not config.DELAY_EXIF and EXIF_DATID is not None and EXIF_ORIENTATION is not None:
-                (orientation, dt, fdt, location) = get_exif_info(file_path_name)
+                (orientation, dt, fdt, gps_info) = read_exif_info(file_path_name)
                 if (dt_from is not None and dt < dt_from) or (dt_to is not None and dt > dt_to):
                   include_flag = False
               if include_flag:
-                # iFiles now list of lists [file_name, orientation, file_changed_date, exif_date, exif_formatted_date]
-                file_list.append([file_path_name,
+                # iFiles now list of lists [file_name, orientation, file_changed_date, exif_date, exif_formatted_date, location]
+                dir_files.append(([file_path_name,
                                   orientation,
                                   os.path.getmtime(file_path_name),
                                   dt,
                                   fdt,
-                                  location])
+                                  location], gps_info))
+      if config.LOAD_GEOLOC:
+        with_gps = [(entry, gps_info) for (entry, gps_info) in dir_files if gps_info is not None]
+        for (entry, gps_info), location in zip(with_gps, geo.get_locations([g for (e, g) in with_gps])):
+          entry[5] = location
+      file_list.extend(entry for (entry, gps_info) in dir_files)
   if shuffle:
     file_list.sort(key=lambda x: x[2]) # will be later files last
     temp_list_first = file_list[-config.RECENT_N:]
@@ -209,9 +216,18 @@ def get_files(dt_from=None, dt_to=None):
   return file_list, len(file_list) # tuple of file list, number of pictures
 
 def get_exif_info(file_path_name, im=None):
+  (orientation, dt, fdt, gps_info) = read_exif_info(file_path_name, im)
+  location = ""
+  if gps_info is not None:
+    location = geo.get_location(gps_info)
+  return (orientation, dt, fdt, location)
+
+def read_exif_info(file_path_name, im=None):
+  """ as get_exif_info() but returns the GPSInfo dict (or None) instead of
+  looking up the location, so a whole directory can be looked up at once """
   dt = os.path.getmtime(file_path_name) # so use file last modified date
   orientation = 1
-  location = ""
+  gps_info = None
   try:
     if im is None:
       im = Image.open(file_path_name) # lazy operation so shouldn't load (better test though)
@@ -222,12 +238,12 @@ def get_exif_info(file_path_name, im=None):
     if EXIF_ORIENTATION in exif_data:
         orientation = int(exif_data[EXIF_ORIENTATION])
     if config.LOAD_GEOLOC and geo.EXIF_GPSINFO in exif_data:
-      location = geo.get_location(exif_data[geo.EXIF_GPSINFO])
+      gps_info = exif_data[geo.EXIF_GPSINFO]
   except Exception as e: # NB should really check error here but it's almost certainly due to lack of exif data
     if config.VERBOSE:
       print('trying to read exif', e)
   fdt = time.strftime(config.SHOW_TEXT_FM, time.localtime(dt))
-  return (orientation, dt, fdt, location)
+  return (orientation, dt, fdt, gps_info)
 
 def convert_heif(fname):
     try:
@@ -64,8 +64,10 @@ parse.add_argument(      "--auto_resize",   default=True, type=str_to_bool, help
 parse.add_argument(      "--delay_exif",    default=True, type=str_to_bool, help="set this to false if there are problems with date filtering - it will take a long time for initial loading if there are many images.")
 parse.add_argument(      "--locale",        default="en_US.utf8", help="set the locale")
 parse.add_argument(      "--load_geoloc",   default=False, type=str_to_bool, help="load geolocation code")
-parse.add_argument(      "--geo_key",       default="picture_frame_hello", help="set the Nominatim key - change to something unique to you")
-parse.add_argument(      "--geo_path",      default="/home/pi/PictureFrame2020gpsdata.txt", help="set the local file to store data from geopy - ignored if --load_geoloc is not true")
+parse.add_argument(      "--geo_key",       default="picture_frame_hello", help="no longer used - locations are looked up offline in --geo_places")
+parse.add_argument(      "--geo_path",      default="/home/pi/PictureFrame2020gpsdata.txt", help="old text file of locations from geopy - imported into --geo_db when that is first created")
+parse.add_argument(      "--geo_places",    default="/home/pi/cities1000.txt", help="GeoNames places file used to look up locations offline - ignored if --load_geoloc is not true")
+parse.add_argument(      "--geo_db",        default="/home/pi/PictureFrame2020gps.db", help="set the local file to cache looked up locations - ignored if --load_geoloc is not true")
 parse.add_argument(      "--display_x",     default=0, type=int, help="offset from left of screen (can be negative)")
 parse.add_argument(      "--display_y",     default=0, type=int, help="offset from top of screen (can be negative)")
 parse.add_argument(      "--display_w",     default=None, type=int, help="width of display surface (None will use max returned by hardware)")
@@ -114,6 +116,8 @@ LOCALE = args.locale
 LOAD_GEOLOC = args.load_geoloc
 GEO_KEY = args.geo_key
 GEO_PATH = args.geo_path
+GEO_PLACES = args.geo_places
+GEO_DB = args.geo_db
 DISPLAY_X = args.display_x
 DISPLAY_Y = args.display_y
 DISPLAY_W = args.display_w
@@ -1,9 +1,28 @@
 import os
-import locale
+import math
+import sqlite3
+import threading
 from PIL import ExifTags
-from geopy.geocoders import Nominatim ## NB other geo services will need different code
 import PictureFrame2020config as config
 
+""" Offline reverse geocoding of the GPS data in photos.
+
+Locations are looked up in a local places dataset instead of over the network,
+so they work on a frame with no internet and take microseconds rather than an
+HTTP round trip per coordinate. The dataset is a GeoNames dump (e.g.
+cities1000.txt from https://download.geonames.org/export/dump/) given by
+config.GEO_PLACES. If admin1CodesASCII.txt is next to it, region names are
+shown too. Places are put in a grid of GRID_DEG cells, and a query only looks
+at the cells around the coordinate.
+
+Results are cached in an SQLite file (config.GEO_DB) keyed by the rounded
+coordinate, and looked up for a whole directory of photos at a time. Entries
+of the old GEO_PATH text cache are imported into it the first time it is used.
+"""
+
+GRID_DEG = 0.5 # size of a grid cell in degrees
+MAX_DIST_DEG = 5.0 # no place further away than this counts (e.g. photos taken at sea)
+
 EXIF_GPSINFO = None
 EXIF_GPSINFO_LAT = None
 EXIF_GPSINFO_LAT_REF = None
@@ -24,53 +43,174 @@ for k in ExifTags.GPSTAGS:
   if ExifTags.GPSTAGS[k] == 'GPSLongitudeRef':
     EXIF_GPSINFO_LON_REF = k
 
-gps_data = {}
-if os.path.isfile(config.GEO_PATH):
-  with open(config.GEO_PATH) as gps_file:
-    for line in gps_file:
-      if line == '\n':
+##############################################
+# Places index
+##############################################
+places = None # (lat cell, lon cell) : [(lat, lon, address)], loaded on first use
+places_lock = threading.Lock()
+N_LON_CELLS = int(round(360 / GRID_DEG))
+
+def grid_cell(lat, lon):
+  return int(math.floor(lat / GRID_DEG)), int(math.floor(lon / GRID_DEG)) % N_LON_CELLS
+
+def format_address(parts):
+  """ join the non empty parts that can be shown with the font's codepoints """
+  return ", ".join(p for p in parts if p and any(c in config.CODEPOINTS for c in p))
+
+def load_places(fname):
+  """ read a GeoNames dump into the grid index. Returns an empty index if the
+  file doesn't exist """
+  grid = {}
+  if not os.path.isfile(fname):
+    print("places file {} not found - no locations will be shown".format(fname))
+    return grid
+  admin1 = {}
+  admin1_path = os.path.join(os.path.dirname(fname), 'admin1CodesASCII.txt')
+  if os.path.isfile(admin1_path):
+    with open(admin1_path, encoding='utf-8') as f:
+      for line in f:
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) >= 2:
+          admin1[fields[0]] = fields[1]
+  with open(fname, encoding='utf-8') as f:
+    for line in f:
+      fields = line.rstrip('\n').split('\t')
+      if len(fields) < 11:
         continue
-      (name, var) = line.partition('=')[::2]
-      gps_data[name] = var.rstrip('\n')
+      try:
+        lat, lon = float(fields[4]), float(fields[5])
+      except ValueError:
+        continue
+      country = fields[8]
+      address = format_address([fields[1], admin1.get("{}.{}".format(country, fields[10]), ""), country])
+      grid.setdefault(grid_cell(lat, lon), []).append((lat, lon, address))
+  return grid
 
-def get_location(gps_info):
+def ring_cells(ring, max_lat_ring):
+  """ (d_lat, d_lon) offsets of the cells on the edge of the square of cells
+  ring cells out from the centre, not going further than max_lat_ring in latitude """
+  lat_ring = min(ring, max_lat_ring)
+  for d_lat in range(-lat_ring, lat_ring + 1):
+    if abs(d_lat) == ring:
+      for d_lon in range(-ring, ring + 1):
+        yield d_lat, d_lon
+    else:
+      yield d_lat, -ring
+      if ring > 0:
+        yield d_lat, ring
+
+def nearest_place(lat, lon):
+  """ address of the closest place to lat, lon, or None if there is none within
+  MAX_DIST_DEG. Cells are searched in rings of growing size until no cell
+  further out can hold anything closer """
+  global places
+  with places_lock:
+    if places is None:
+      places = load_places(config.GEO_PLACES)
+  cos_lat = max(math.cos(math.radians(lat)), 0.01)
+  c_lat, c_lon = grid_cell(lat, lon)
+  best_d, best = MAX_DIST_DEG ** 2, None
+  max_lat_ring = int(math.ceil(MAX_DIST_DEG / GRID_DEG)) + 1
+  max_ring = min(int(math.ceil(MAX_DIST_DEG / (GRID_DEG * cos_lat))) + 1, N_LON_CELLS // 2)
+  for ring in range(max_ring + 1):
+    # nothing in this ring or beyond can be closer than this
+    bound = max(0.0, (ring - 1) * GRID_DEG * cos_lat)
+    if bound * bound > best_d:
+      break
+    for d_lat, d_lon in ring_cells(ring, max_lat_ring):
+      for p_lat, p_lon, address in places.get((c_lat + d_lat, (c_lon + d_lon) % N_LON_CELLS), ()):
+        dx = abs(lon - p_lon)
+        if dx > 180.0:
+          dx = 360.0 - dx
+        d = (lat - p_lat) ** 2 + (dx * cos_lat) ** 2
+        if d < best_d:
+          best_d, best = d, address
+  return best
+
+##############################################
+# Location cache
+##############################################
+cache_conn = None
+cache_lock = threading.Lock()
+
+def open_cache():
+  """ open the SQLite cache, importing the old text file cache if it's new """
+  conn = sqlite3.connect(config.GEO_DB, check_same_thread=False)
+  with conn:
+    conn.execute("CREATE TABLE IF NOT EXISTS locations (key TEXT PRIMARY KEY, address TEXT)")
+    empty = conn.execute("SELECT COUNT(*) FROM locations").fetchone()[0] == 0
+    if empty and os.path.isfile(config.GEO_PATH):
+      rows = []
+      with open(config.GEO_PATH) as gps_file:
+        for line in gps_file:
+          if line == '\n':
+            continue
+          (name, var) = line.partition('=')[::2]
+          rows.append((name, var.rstrip('\n')))
+      conn.executemany("INSERT OR REPLACE INTO locations (key, address) VALUES (?,?)", rows)
+  return conn
+
+def rational(value):
+  """ older PIL versions give EXIF rationals as (numerator, denominator) """
+  if isinstance(value, tuple):
+    return value[0] / value[1]
+  return float(value)
+
+def gps_to_decimal(gps_info):
+  """ (lat, lon) in decimal degrees from an EXIF GPSInfo dict """
   lat = gps_info[EXIF_GPSINFO_LAT]
   latRef = gps_info[EXIF_GPSINFO_LAT_REF]
   lon = gps_info[EXIF_GPSINFO_LON]
   lonRef = gps_info[EXIF_GPSINFO_LON_REF]
-  decimal_lat = ((lat[0][0] / lat[0][1])
-               + (lat[1][0] / lat[1][1] / 60)
-               + (lat[2][0] / lat[2][1] / 3600))
-  decimal_lon = ((lon[0][0] / lon[0][1])
-               + (lon[1][0] / lon[1][1] / 60)
-               + (lon[2][0] / lon[2][1] / 3600))
+  decimal_lat = (rational(lat[0])
+               + (rational(lat[1]) / 60)
+               + (rational(lat[2]) / 3600))
+  decimal_lon = (rational(lon[0])
+               + (rational(lon[1]) / 60)
+               + (rational(lon[2]) / 3600))
   if latRef == 'S':
     decimal_lat = -decimal_lat
   if lonRef == 'W':
     decimal_lon = -decimal_lon
-  geo_key = "{:.4f},{:.4f}".format(decimal_lat, decimal_lon)
+  return decimal_lat, decimal_lon
 
-  if geo_key not in gps_data:
-    language = locale.getlocale()[0][:2]
+def get_locations(gps_infos):
+  """ location text for each EXIF GPSInfo dict in the list (None entries give
+  "No GPS Data"). The cache is read and written once for the whole batch """
+  global cache_conn
+  keys = []
+  coords = {}
+  for gps_info in gps_infos:
     try:
-      geolocator = Nominatim(user_agent=config.GEO_KEY)
-      location = geolocator.reverse(geo_key, language=language).address.split(",")
-      location_split = [loc.strip() for loc in location]
-      formatted_address = ""
-      comma = ""
-      for part in location_split:
-        if any(c in config.CODEPOINTS for c in part):
-          formatted_address = "{}{}{}".format(formatted_address, comma, part)
-          comma = ", "
-      if len(formatted_address) > 0:
-        gps_data[geo_key] = formatted_address
-        with open(config.GEO_PATH, 'a+') as file:
-          file.write("{}={}\n".format(geo_key, formatted_address))
-        return formatted_address
-    except Exception as e:
-      print(e) #TODO debugging
-      return "Location Not Available"
-  else:
-    return gps_data[geo_key]
-
-  return "No GPS Data"
\ No newline at end of file
+      decimal_lat, decimal_lon = gps_to_decimal(gps_info)
+    except (KeyError, TypeError, IndexError, ValueError, ZeroDivisionError):
+      keys.append(None)
+      continue
+    geo_key = "{:.4f},{:.4f}".format(decimal_lat, decimal_lon)
+    keys.append(geo_key)
+    coords[geo_key] = (decimal_lat, decimal_lon)
+
+  found = {}
+  with cache_lock:
+    if cache_conn is None:
+      cache_conn = open_cache()
+    wanted = list(coords)
+    for i in range(0, len(wanted), 500): # keep within SQLite's limit on parameters
+      chunk = wanted[i:i + 500]
+      found.update(cache_conn.execute("SELECT key, address FROM locations WHERE key IN ({})".format(
+                        ",".join("?" * len(chunk))), chunk))
+    new_rows = []
+    for geo_key in wanted:
+      if geo_key not in found:
+        address = nearest_place(*coords[geo_key])
+        if address:
+          found[geo_key] = address
+          new_rows.append((geo_key, address))
+    if new_rows:
+      with cache_conn:
+        cache_conn.executemany("INSERT OR REPLACE INTO locations (key, address) VALUES (?,?)", new_rows)
+
+  return ["No GPS Data" if k is None else found.get(k, "Location Not Available") for k in keys]
+
+def get_location(gps_info):
+  return get_locations([gps_info])[0]
@@ -0,0 +1,291 @@
+import time
+import logging
+import threading
+from collections import deque, namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+
+import image_utils
+import warm_start
+from database import ORIENTATION_PENDING
+
+"""Lookahead queue of pictures that are decoded and ready to display.
+
+Opening a large JPEG, scaling it and blurring its edges takes over a second on
+a Pi 3. Done on the render thread, that stalls the display. The Prefetcher
+instead keeps the next config.PREFETCH_DEPTH pictures in the works: its own
+thread makes the Manager's picks, in order, and a pool of config.PREFETCH_WORKERS
+threads opens and prepares them (see image_utils.prepare_image). The Viewer
+takes them in the same order with get(), which leaves it just the texture
+upload.
+
+Pictures injected with Manager.enqueue_pic() wake the prefetch thread at once,
+and go ahead of the pictures already picked.
+
+A get() that finds its picture ready counts as a hit, one that has to wait for
+it as a miss.
+
+Pictures handed to the Viewer are also kept in an Image_Cache, a least recently
+used cache limited by memory size. Going back and forward through the Manager's
+history (see step()) takes pictures from there, without decoding them again.
+
+At shutdown the picture on screen and the ones lined up after it are saved with
+save_warm_start(), and put back at the next start with restore() (see
+warm_start.py).
+"""
+
+# A picture ready for display. number is its place in Manager.history when it
+# was taken from there, None for a new picture.
+Prepared = namedtuple('Prepared', 'path orientation image number')
+
+def image_bytes(im):
+    return im.size[0] * im.size[1] * len(im.getbands())
+
+
+class Image_Cache:
+    """Prepared PIL images by path. Least recently used images are dropped once
+    the cache holds more than budget bytes."""
+    # Class Constants
+    LOG_PERIOD = 50 # lookups between logging the hit/miss counts
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.images = OrderedDict()     # path : image, least recently used first
+        self.n_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.images)
+
+    def get(self, path):
+        with self.lock:
+            im = self.images.get(path)
+            if im is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.images.move_to_end(path)
+            if (self.hits + self.misses) % self.LOG_PERIOD == 0:
+                logging.info(self.stats())
+        return im
+
+    def put(self, path, im):
+        with self.lock:
+            old = self.images.pop(path, None)
+            if old is not None:
+                self.n_bytes -= image_bytes(old)
+            self.images[path] = im
+            self.n_bytes += image_bytes(im)
+            # The newest image is kept even if it is over budget on its own
+            while self.n_bytes > self.budget and len(self.images) > 1:
+                path, old = self.images.popitem(last=False)
+                self.n_bytes -= image_bytes(old)
+
+    def stats(self):
+        n = self.hits + self.misses
+        return "Image cache hits: {}, misses: {} ({:.0f}% hit rate), {} images in {:.1f} MB".format(
+            self.hits, self.misses, 100.0 * self.hits / n if n else 0.0, len(self.images), self.n_bytes / 1e6)
+
+
+class Prefetcher:
+    # Class Constants
+    LOG_PERIOD = 100 # pictures between logging the hit/miss counts
+    MIN_BACKOFF = 1.0 # sec before picking again after a failed pick, doubled while picks keep failing...
+    MAX_BACKOFF = 5.0 # ...up to this
+    MAX_SKIPS = 100   # skipped picks in a row (failed files, duplicates) before backing off as for a failed pick
+
+    def __init__(self, manager, size, max_dimension, depth, workers, cache_bytes=0):
+        self.manager = manager
+        self.size = size                    # Display (width, height)
+        self.max_dimension = max_dimension  # Largest texture side
+        self.depth = max(1, depth)
+        self.alive = True
+
+        self.pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="Prefetch")
+        self.pending = deque()              # ((path, orientation), future of the Prepared picture), in play order
+        self.returned = None                # Picture given back with unget(), handed out again first
+        self.on_screen = None               # Prepared picture shown last
+        self.cache = Image_Cache(cache_bytes)
+        self.n_injected = 0                 # Number of futures at the front of pending that were injected
+        self.cond = threading.Condition()
+        manager.on_enqueue = self.wake
+        manager.on_play_index_change = self.wake
+
+        self.hits = 0
+        self.misses = 0
+
+    def kill(self):
+        with self.cond:
+            self.alive = False
+            self.cond.notify_all()
+        self.pool.shutdown(wait=False)
+        logging.info("Prefetcher stopped. {}. {}".format(self.stats(), self.cache.stats()))
+
+    def stats(self):
+        n = self.hits + self.misses
+        return "Prefetch hits: {}, misses: {} ({:.0f}% hit rate)".format(
+            self.hits, self.misses, 100.0 * self.hits / n if n else 0.0)
+
+    def wake(self):
+        with self.cond:
+            self.cond.notify_all()
+
+    def run(self):
+        """Keep depth pictures picked and being prepared"""
+        backoff = self.MIN_BACKOFF
+        n_skipped = 0
+        while self.alive:
+            with self.cond:
+                while self.alive and len(self.pending) >= self.depth and not self.manager.pic_queue:
+                    self.cond.wait()
+                if not self.alive:
+                    break
+
+            pic_path = self.manager.take_queued_pic()
+            if pic_path is not None:
+                pic = (pic_path, ORIENTATION_PENDING)
+                future = self.pool.submit(self.prepare, *pic)
+                with self.cond:
+                    self.pending.insert(self.n_injected, (pic, future))
+                    self.n_injected += 1
+                    self.cond.notify_all()
+                continue
+
+            pic = self.manager.pick_next_pic()
+            if pic is None:
+                # A skipped pick (e.g. a duplicate) is made again at once, 
+                # unless picks keep being skipped - e.g. every playable image
+                # failed to open
+                n_skipped += 1
+                if self.manager.pick_error or n_skipped >= self.MAX_SKIPS:
+                    # Nothing to play, e.g. an empty library, everything masked
+                    # out or the drive unplugged. Try again when the database 
+                    # or schedule changes, or after a while.
+                    with self.cond:
+                        if self.alive and not self.manager.pic_queue:
+                            self.cond.wait(backoff)
+                    backoff = min(self.MAX_BACKOFF, 2 * backoff)
+                    n_skipped = 0
+                continue
+            backoff = self.MIN_BACKOFF
+            n_skipped = 0
+            future = self.pool.submit(self.prepare, *pic)
+            with self.cond:
+                self.pending.append((pic, future))
+                self.cond.notify_all()
+
+    def prepare(self, pic_path, orientation, number=None):
+        """Runs on a worker. Returns the Prepared picture, or None if it 
+        couldn't be opened."""
+        im = self.manager.open_pic(pic_path)
+        if im is None:
+            return None
+        try:
+            im = image_utils.prepare_image(im, orientation, self.size, self.max_dimension)
+        except Exception as e:
+            logging.error("Could not prepare {} for display: {}".format(pic_path, e))
+            return None
+        return Prepared(pic_path, orientation, im, number)
+
+    def get(self, timeout):
+        """Returns the next Prepared picture, or None if none is ready within
+        timeout seconds. After going back in the history, that is the next
+        picture in the history."""
+        entry = self.manager.history_entry(1)
+        if entry is not None:
+            return self.from_history(*entry)
+        if self.returned is not None:
+            prepared, self.returned = self.returned, None
+            return prepared
+
+        t_timeout = time.time() + timeout
+        while True:
+            with self.cond:
+                while not self.pending:
+                    remaining = t_timeout - time.time()
+                    if remaining <= 0 or not self.alive:
+                        return None
+                    self.cond.wait(remaining)
+                pic, future = self.pending.popleft()
+                self.n_injected = max(0, self.n_injected - 1)
+                self.cond.notify_all()
+
+            if future.done():
+                self.hits += 1
+            else:
+                self.misses += 1
+            try:
+                prepared = future.result(max(0.0, t_timeout - time.time()))
+            except Exception:
+                # Timed out - the picture is dropped, the next one may be ready
+                prepared = None
+            if (self.hits + self.misses) % self.LOG_PERIOD == 0:
+                logging.info(self.stats())
+            if prepared is not None:
+                self.cache.put(prepared.path, prepared.image)
+                return prepared
+            if time.time() >= t_timeout:
+                return None
+
+    def step(self, offset):
+        """Returns the Prepared picture offset places from the one on screen in
+        the Manager's history (e.g. -1 for the previous one), or None if the
+        history doesn't go that far"""
+        entry = self.manager.history_entry(offset)
+        if entry is None:
+            return None
+        return self.from_history(*entry)
+
+    def from_history(self, number, pic):
+        path, orientation = pic
+        im = self.cache.get(path)
+        if im is not None:
+            return Prepared(path, orientation, im, number)
+        # Dropped from the cache - has to be prepared again
+        prepared = self.prepare(path, orientation, number)
+        if prepared is not None:
+            self.cache.put(path, prepared.image)
+        return prepared
+
+    def unget(self, prepared):
+        """Give back a picture that was taken with get() but not shown, so it
+        is shown later instead of being skipped"""
+        if prepared.number is None:
+            self.returned = prepared
+
+    def shown(self, prepared):
+        """To be called when a picture goes on screen"""
+        self.on_screen = prepared
+        self.manager.record_shown(prepared.path, prepared.orientation, prepared.number)
+
+    def restore(self, upcoming):
+        """Line up the pictures saved by save_warm_start(), as (path, 
+        orientation, image) tuples, ahead of any new picks. Pictures saved
+        without their image are prepared again. Call before run()."""
+        with self.cond:
+            for path, orientation, im in upcoming:
+                pic = (path, orientation)
+                if im is None:
+                    future = self.pool.submit(self.prepare, *pic)
+                else:
+                    future = Future()
+                    future.set_result(Prepared(path, orientation, im, None))
+                self.pending.insert(self.n_injected, (pic, future))
+                self.n_injected += 1
+
+    def save_warm_start(self, path, n_images):
+        """Save the picture on screen and the ones lined up after it, in play 
+        order, so the next start carries on with them. Call after kill(), once
+        run() has returned."""
+        upcoming = [] if self.returned is None else [self.returned]
+        with self.cond:
+            for (pic_path, orientation), future in self.pending:
+                if not future.done():
+                    upcoming.append(Prepared(pic_path, orientation, None, None))
+                elif future.exception() is None and future.result() is not None:
+                    upcoming.append(future.result())
+        t_start = time.time()
+        warm_start.save(path, self.on_screen, upcoming, n_images)
+        logging.info("Warm start: {} pictures saved in {:.2f} sec".format(
+            len(upcoming) + (self.on_screen is not None), time.time()-t_start))
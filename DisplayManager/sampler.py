@@ -0,0 +1,258 @@
+import random
+import bisect
+import hashlib
+import itertools
+
+"""Structures that let play methods pick at random without rebuilding lists.
+
+Weighted_Sampler picks an index with probability proportional to its weight,
+e.g. a directory id weighted by its number of images, so that every picture is
+equally likely. It is a Fenwick (binary indexed) tree: changing a weight and
+picking are both O(log n), and a pick allocates nothing.
+
+Indexed_Set is a set that can also pick a member uniformly at random, in O(1),
+optionally leaving one member out (e.g. the playlist currently playing).
+
+Shuffle plays every image of a set of directories once, in random order, before
+repeating any - without building or storing the shuffled list. Position i of
+the shuffle is computed on the fly by Permutation, a seeded bijection of 
+range(size), over runs of images laid out per directory. The state is a seed, a
+cursor and a run per directory, and can be saved to resume the same shuffle 
+after a reboot.
+"""
+
+class Weighted_Sampler:
+    def __init__(self):
+        self.weights = []   # Weight of each index
+        self.tree = [0]     # Fenwick tree, 1-based: tree[i] holds the sum of weights (i - lowbit(i), i]
+        self.top = 0        # Highest power of two <= len(weights)
+        self.total = 0
+
+    def __len__(self):
+        return len(self.weights)
+
+    def grow(self, size):
+        """Make room for indexes below size. Rebuilds the tree in O(n), and at
+        least doubles it, so growing one index at a time is O(1) amortised."""
+        size = max(size, 2 * len(self.weights), 16)
+        self.weights.extend([0] * (size - len(self.weights)))
+        self.tree = [0] + self.weights
+        for i in range(1, size + 1):
+            j = i + (i & -i)
+            if j <= size:
+                self.tree[j] += self.tree[i]
+        self.top = 1 << (size.bit_length() - 1)
+
+    def set(self, idx, weight):
+        if idx >= len(self.weights):
+            if weight == 0:
+                return
+            self.grow(idx + 1)
+        delta = weight - self.weights[idx]
+        if delta == 0:
+            return
+        self.weights[idx] = weight
+        self.total += delta
+        i = idx + 1
+        n = len(self.weights)
+        while i <= n:
+            self.tree[i] += delta
+            i += i & -i
+
+    def get(self, idx):
+        return self.weights[idx] if idx < len(self.weights) else 0
+
+    def find(self, x):
+        """Returns the index whose share of the cumulative weight contains x,
+        for 0 <= x < total"""
+        pos = 0
+        step = self.top
+        n = len(self.weights)
+        while step:
+            nxt = pos + step
+            if nxt <= n and self.tree[nxt] <= x:
+                pos = nxt
+                x -= self.tree[nxt]
+            step >>= 1
+        return pos
+
+    def sample(self):
+        """Returns a random index, chosen in proportion to the weights, or None
+        if all weights are zero"""
+        if self.total <= 0:
+            return None
+        return self.find(random.randrange(self.total))
+
+    def clear(self):
+        self.__init__()
+
+
+class Indexed_Set:
+    def __init__(self):
+        self.items = []     # Members, in no particular order
+        self.pos = {}       # Member : its index in items
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, item):
+        return item in self.pos
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def add(self, item):
+        if item not in self.pos:
+            self.pos[item] = len(self.items)
+            self.items.append(item)
+
+    def discard(self, item):
+        """Remove item, if present, by moving the last member into its slot"""
+        idx = self.pos.pop(item, None)
+        if idx is None:
+            return
+        last = self.items.pop()
+        if idx < len(self.items):
+            self.items[idx] = last
+            self.pos[last] = idx
+
+    def choice(self, exclude=None):
+        """Returns a random member other than exclude - unless exclude is the
+        only member. Returns None if the set is empty."""
+        n = len(self.items)
+        if n == 0:
+            return None
+        skip = self.pos.get(exclude)
+        if skip is None or n == 1:
+            return self.items[random.randrange(n)]
+        idx = random.randrange(n - 1)
+        if idx >= skip:
+            idx += 1
+        return self.items[idx]
+
+    def clear(self):
+        self.__init__()
+
+
+class Permutation:
+    """Seeded bijection of range(size). A balanced Feistel network permutes the
+    smallest range of an even number of bits that holds size, and values that
+    land outside range(size) are fed through again (cycle walking) until they
+    land inside. The Feistel range is less than 4 * size, so that takes less
+    than 4 rounds on average."""
+    ROUNDS = 4
+
+    def __init__(self, size, seed):
+        self.size = size
+        self.half_bits = max(1, ((size - 1).bit_length() + 1) // 2)
+        self.mask = (1 << self.half_bits) - 1
+        self.keys = [int.from_bytes(hashlib.blake2b("{}:{}".format(seed, r).encode(),
+                     digest_size=8).digest(), 'little') for r in range(self.ROUNDS)]
+
+    def feistel(self, x):
+        left, right = x >> self.half_bits, x & self.mask
+        for key in self.keys:
+            # Any mixing function will do; it doesn't have to be invertible
+            f = ((right ^ key) * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+            left, right = right, left ^ ((f >> 29) & self.mask)
+        return (left << self.half_bits) | right
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.size:
+            raise IndexError(i)
+        x = self.feistel(i)
+        while x >= self.size:
+            x = self.feistel(x)
+        return x
+
+
+class Shuffle:
+    """Cursor through a shuffle of the images of a set of directories. 
+
+    A shuffle runs over a layout of [directory path, first image index, count]
+    runs, laid end to end and fixed once laid out, so positions don't move when
+    the library changes. Images added to a directory, and new directories, are
+    passed to add() and laid out in a further segment, which is shuffled on its
+    own and played once the earlier ones are used up. The caller skips
+    positions whose directory has lost images or isn't played any more. Once
+    every segment is used up, next() returns None and a new shuffle is
+    start()ed.
+
+    Image indexes are taken to be stable - a file inserted in the middle of a
+    directory's order shifts the ones after it, so one of them may be played
+    twice and the new one not until the next shuffle."""
+
+    def __init__(self, seed=None, state=None, layout=None):
+        self.seed = random.getrandbits(32) if seed is None else seed
+        self.cycle = 0          # Number of shuffles started
+        self.segments = []      # Layouts - lists of runs, each shuffled on its own, played in order
+        self.pending = []       # Runs added since the last segment was laid out
+        self.covered = {}       # Directory path : number of its images laid out in this shuffle
+        self.segment = 0        # Index of the segment being played
+        self.position = 0       # Position within that segment
+        self.perm = None        # Permutation of the current segment
+        self.ends = None        # Positions where each run of the current segment ends
+        # A shuffle is resumed from its state() together with its layout()
+        if state is not None and layout is not None:
+            self.seed = state['seed']
+            self.cycle = state['cycle']
+            self.segment = state['segment']
+            self.position = state['position']
+            self.segments = [[list(run) for run in seg] for seg in layout['segments']]
+            self.pending = [list(run) for run in layout['pending']]
+            for path, first, count in itertools.chain(self.pending, *self.segments):
+                self.covered[path] = max(self.covered.get(path, 0), first + count)
+
+    def state(self):
+        """The cursor of the shuffle as JSON serialisable dict"""
+        return {'seed' : self.seed, 'cycle' : self.cycle, 
+                'segment' : self.segment, 'position' : self.position}
+
+    def layout(self):
+        """The runs of the shuffle as JSON serialisable dict. Only changes when
+        a shuffle starts or images are added, unlike state()."""
+        return {'segments' : [[list(run) for run in seg] for seg in self.segments],
+                'pending' : [list(run) for run in self.pending]}
+
+    def start(self, counts):
+        """Start a new shuffle of counts, a list of (directory path, number of
+        images)"""
+        runs = [[path, 0, n] for path, n in counts if n > 0]
+        self.cycle += 1
+        self.segments = [runs] if runs else []
+        self.pending = []
+        self.covered = {path : n for path, n in counts if n > 0}
+        self.segment = 0
+        self.position = 0
+        self.perm = None
+
+    def add(self, path, count):
+        """Directory path has count images to play. Those beyond the ones 
+        already laid out are played after them, in this shuffle."""
+        n = self.covered.get(path, 0)
+        if count > n:
+            self.pending.append([path, n, count - n])
+            self.covered[path] = count
+
+    def next(self):
+        """Returns the next (directory path, image index), or None once the
+        shuffle is used up"""
+        while True:
+            if self.segment >= len(self.segments):
+                if not self.pending:
+                    return None
+                self.segments.append(self.pending)
+                self.pending = []
+            runs = self.segments[self.segment]
+            if self.perm is None:
+                self.ends = list(itertools.accumulate(run[2] for run in runs))
+                self.perm = Permutation(self.ends[-1], "{}:{}:{}".format(self.seed, self.cycle, self.segment))
+            if self.position < self.perm.size:
+                x = self.perm[self.position]
+                self.position += 1
+                i = bisect.bisect_right(self.ends, x)
+                path, first, count = runs[i]
+                return path, first + x - (self.ends[i] - count)
+            self.segment += 1
+            self.position = 0
+            self.perm = None
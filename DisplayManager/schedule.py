@@ -0,0 +1,204 @@
+import os
+import time
+import logging
+import datetime
+import threading
+import configparser
+
+import config
+
+"""Calendar schedules: which pictures to play, and how, on which days.
+
+Rules are read from config.SCHEDULE_PATH, an INI file with one section per
+rule, e.g.
+
+    [Anniversary]
+    dates = 06-15                       ; MM-DD every year, or YYYY-MM-DD
+    dirs = /home/pi/Pictures/Wedding    ; ';' separated, subdirectories included
+    play = random_playlist_randomly
+    priority = 10
+
+    [Sunday family]
+    weekdays = Sun
+    dirs = /media/pi/photos/Family
+    exclude = /media/pi/photos/Family/Scans
+    play = shuffled
+
+    [Christmas]
+    dates = 12-20..12-31
+    photos_from = 2000-12-20            ; play the pictures taken in a date range
+    photos_to = 2000-12-31              ; (by date, in date order)
+
+A rule applies on a day if any of its dates and any of its weekdays match
+(a rule without dates or weekdays matches every day). Of the rules that apply,
+the one with the highest priority is used, the later one in the file on a tie.
+Without any, everything is played with the Manager's default play method.
+
+The rules are not looked at when pictures are picked. Scheduler compiles the
+day's rule once - at midnight, and whenever the file changes - into a
+dirs_to_play mask over every directory, and the Manager rebuilds its play index
+from it (see Manager.apply_schedule). A timer thread does the switching.
+"""
+
+PLAY_METHODS = ('random', 'random_playlist', 'random_playlist_randomly', 'sequential', 'shuffled')
+WEEKDAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+
+def parse_day(s):
+    """'MM-DD' or 'YYYY-MM-DD' to (year or None, month, day)"""
+    parts = [int(x) for x in s.strip().split('-')]
+    if len(parts) == 2:
+        return (None,) + tuple(parts)
+    if len(parts) == 3:
+        return tuple(parts)
+    raise ValueError("Bad date: " + s)
+
+def parse_date(s):
+    """'YYYY-MM-DD' to a (year, month, day) tuple"""
+    year, month, day = parse_day(s)
+    if year is None:
+        raise ValueError("Date needs a year: " + s)
+    return (year, month, day)
+
+def split_list(s):
+    return [x.strip() for x in s.replace(',', ';').split(';') if x.strip()]
+
+
+class Rule:
+    def __init__(self, name, section, order):
+        self.name = name
+        self.order = order
+        self.priority = section.getint('priority', 0)
+        self.days = []      # ((year, month, day), (year, month, day)) ranges, year None for every year
+        for item in split_list(section.get('dates', '')):
+            first, _, last = item.partition('..')
+            self.days.append((parse_day(first), parse_day(last or first)))
+        self.weekdays = set()
+        for item in split_list(section.get('weekdays', '')):
+            if item[:3].lower() not in WEEKDAYS:
+                raise ValueError("Bad weekday in rule {}: {}".format(name, item))
+            self.weekdays.add(WEEKDAYS.index(item[:3].lower()))
+        self.dirs = tuple(os.path.abspath(d) for d in split_list(section.get('dirs', '')))
+        self.exclude = tuple(os.path.abspath(d) for d in split_list(section.get('exclude', '')))
+        self.play = section.get('play', None)
+        if self.play is not None and self.play not in PLAY_METHODS:
+            raise ValueError("Bad play method in rule {}: {}".format(name, self.play))
+        photos_from = section.get('photos_from', None)
+        photos_to = section.get('photos_to', None)
+        self.photos_from = None if photos_from is None else parse_date(photos_from)
+        self.photos_to = None if photos_to is None else parse_date(photos_to)
+
+    def __eq__(self, other):
+        """Same settings, e.g. after the file was changed elsewhere. The place
+        in the file only matters when choosing between rules."""
+        if not isinstance(other, Rule):
+            return False
+        return dict(vars(self), order=None) == dict(vars(other), order=None)
+
+    __hash__ = None
+
+    def applies(self, day):
+        """True if the rule is in force on datetime.date day"""
+        if self.weekdays and day.weekday() not in self.weekdays:
+            return False
+        if not self.days:
+            return True
+        for first, last in self.days:
+            if first[0] is None:
+                # Every year. A range like 12-20..01-05 wraps over new year.
+                md, lo, hi = (day.month, day.day), first[1:], last[1:]
+                if (lo <= md <= hi) if lo <= hi else (md >= lo or md <= hi):
+                    return True
+            elif first <= (day.year, day.month, day.day) <= last:
+                return True
+        return False
+
+    def selects(self, path):
+        """1 if the rule plays the directory at path, 0 otherwise"""
+        def under(dirs):
+            return any(path == d or path.startswith(d + os.sep) for d in dirs)
+        if self.dirs and not under(self.dirs):
+            return 0
+        return 0 if under(self.exclude) else 1
+
+
+def load_rules(fname):
+    """Returns the list of Rules in the file, [] if it doesn't exist"""
+    parser = configparser.ConfigParser(inline_comment_prefixes=(';', '#'))
+    if not parser.read(fname):
+        return []
+    return [Rule(name, parser[name], order) for order, name in enumerate(parser.sections())]
+
+def rule_for_day(rules, day):
+    """The rule in force on day, or None"""
+    applying = [r for r in rules if r.applies(day)]
+    if not applying:
+        return None
+    return max(applying, key=lambda r: (r.priority, r.order))
+
+
+class Scheduler:
+    # Class Constants
+    CHECK_PERIOD = 60 # sec between checks of the rules file for changes
+
+    def __init__(self, manager, fname):
+        self.alive = True
+        self.manager = manager
+        self.fname = fname
+        self.wake = threading.Event()
+        self.rules = []
+        self.rules_mtime = None
+        self.day = None
+        self.rule = None
+        self.applied = False    # Whether apply() has been called yet
+
+    def kill(self):
+        self.alive = False
+        self.wake.set()
+
+    def run(self):
+        """Re-apply the schedule at midnight, and when the rules file changes"""
+        while self.alive:
+            now = datetime.datetime.now()
+            midnight = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time())
+            self.wake.wait(min(self.CHECK_PERIOD, (midnight - now).total_seconds() + 1))
+            self.wake.clear()
+            if self.alive:
+                self.update()
+
+    def update(self):
+        """Apply the rule for today, if it isn't the one in force. The rule is
+        only looked up again when the day or the rules file changed, and only
+        applied at startup or when it changes - re-applying the same rule 
+        would undo folder choices and play methods set since."""
+        try:
+            mtime = os.path.getmtime(self.fname)
+        except OSError:
+            mtime = None
+        today = datetime.date.today()
+        if mtime == self.rules_mtime and today == self.day:
+            return
+        if mtime != self.rules_mtime:
+            self.rules_mtime = mtime
+            try:
+                self.rules = [] if mtime is None else load_rules(self.fname)
+                logging.info("Schedule: {} rules read from {}".format(len(self.rules), self.fname))
+            except (configparser.Error, ValueError) as e:
+                logging.error("Schedule {} not used: {}".format(self.fname, e))
+                self.rules = []
+        self.day = today
+        rule = rule_for_day(self.rules, today)
+        if self.applied and rule == self.rule:
+            return
+        self.apply(rule)
+
+    def apply(self, rule):
+        t_start = time.time()
+        self.rule = rule
+        self.applied = True
+        if rule is None:
+            self.manager.apply_schedule(None, None)
+            logging.info("Schedule: no rule for {}, playing everything".format(self.day))
+            return
+        n_dirs = self.manager.apply_schedule(rule.selects, rule.play, rule.photos_from, rule.photos_to)
+        logging.info("Schedule: rule '{}' for {} - {} folders, play {}, compiled in {:.2f} sec".format(
+            rule.name, self.day, n_dirs, rule.play or "default", time.time()-t_start))
@@ -0,0 +1,179 @@
+import json
+import mmap
+import os
+import struct
+
+import numpy as np
+
+"""Read-only binary snapshot of Image_Database, loaded with mmap.
+
+Loading the SQLite catalog means reading every image row and building its
+Python objects before the first picture can be shown. A snapshot instead lays
+the database out as fixed-width record arrays that numpy can view in place:
+
+    header      magic, format version, record counts and section offsets
+    meta        JSON: roots and their volume ids
+    dirs        one DIR_DTYPE record per directory, incl. subtree aggregates
+    children    uint32 directory record numbers, a run per directory
+    images      one IMAGE_DTYPE record per image, a run per directory
+    dates       float64 dates of the date index, sorted
+    keys        uint64 date index keys (directory record number, image index)
+    heap        UTF-8 directory paths and filenames, referenced by offset
+
+At load time only the directory paths are decoded, and each directory's record
+and children are read from the mapped tables as its node is built - no table is
+copied. The date index starts out as views of the dates and keys sections.
+Image records and names are paged in by the OS as play modes touch them.
+
+A snapshot is never modified in place. write() saves a temp file, fsyncs it and
+renames it over the old one, so a power cut leaves either the old or the new
+snapshot behind, never a torn one. Readers of the old file keep a valid mapping.
+"""
+
+MAGIC = b'PFSNAP\0\0'
+FORMAT_VERSION = 1
+
+HEADER = struct.Struct('<8sI4x' + 'Q' * 13)
+
+DIR_DTYPE = np.dtype([
+    ('path', '<u8'), ('path_len', '<u4'), ('n_children', '<u4'),
+    ('first_child', '<u8'), ('first_image', '<u8'),
+    ('n_images', '<u4'), ('reads_failed', '<u4'), ('exif_pending', '<u4'), ('date_n', '<u4'),
+    ('mtime', '<f8'), ('date_sum', '<f8'), ('date_min', '<f8'), ('date_max', '<f8'),
+    ('sub_pics', '<u8'), ('sub_folders', '<u8'), ('sub_date_n', '<u8'),
+    ('sub_date_sum', '<f8'), ('sub_date_min', '<f8'), ('sub_date_max', '<f8')])
+
+IMAGE_DTYPE = np.dtype([
+    ('name', '<u4'), ('name_len', '<u2'), ('orientation', 'i1'), ('pad', 'u1'), ('date', '<f8')])
+
+def align(n):
+    return (n + 7) & ~7
+
+
+class String_Heap:
+    """Builds the heap section. Repeated strings (e.g. camera filenames) are
+    stored once."""
+    def __init__(self):
+        self.data = bytearray()
+        self.offsets = {}
+
+    def add(self, s):
+        """Returns (offset, length) of the encoded string"""
+        ref = self.offsets.get(s)
+        if ref is None:
+            b = os.fsencode(s)
+            ref = (len(self.data), len(b))
+            self.data += b
+            self.offsets[s] = ref
+        return ref
+
+
+def pack(roots, directories, dir_records, date_dates, date_keys):
+    """Build the contents of a snapshot file, returned as a list of byte 
+    strings. directories is a list of Image_Directory objects, in record order.
+    dir_records maps a path to its record number. date_dates and date_keys are
+    the date index arrays, with keys using record numbers."""
+    heap = String_Heap()
+    dirs = []
+    children = []
+    images = []
+    for d in directories:
+        path, path_len = heap.add(d.path)
+        child_ids = [dir_records[c] for c in d.child_names if c in dir_records]
+        first_child, first_image = len(children), len(images)
+        children += child_ids
+        for img in d.images:
+            name, name_len = heap.add(img.fname)
+            images.append((name, name_len, img.orientation, 0, img.date))
+        dirs.append((path, path_len, len(child_ids), first_child, first_image, len(d.images),
+                     d.image_reads_failed, d.exif_pending, d.date_n, d.mtime,
+                     d.date_sum, d.date_min, d.date_max, d.sub_pics, d.sub_folders, d.sub_date_n,
+                     d.sub_date_sum, d.sub_date_min, d.sub_date_max))
+    n_images = len(images)
+    dirs = np.array(dirs, DIR_DTYPE)
+    children = np.array(children, '<u4')
+    images = np.array(images, IMAGE_DTYPE)
+
+    meta = json.dumps({'roots' : roots}).encode()
+    sections = [meta, dirs.tobytes(), children.tobytes(), images.tobytes(),
+                np.asarray(date_dates, '<f8').tobytes(), np.asarray(date_keys, '<u8').tobytes(),
+                bytes(heap.data)]
+    offsets = []
+    pos = align(HEADER.size)
+    for data in sections:
+        offsets.append(pos)
+        pos = align(pos + len(data))
+
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, len(meta), len(directories), len(children),
+                         n_images, len(date_dates), len(heap.data), *offsets)
+    parts = [header]
+    pos = len(header)
+    for offset, data in zip(offsets, sections):
+        parts += [b'\0' * (offset - pos), data]
+        pos = offset + len(data)
+    return parts
+
+def write(fname, parts):
+    """Atomically replace fname with a file holding parts"""
+    tmp = fname + '.tmp'
+    with open(tmp, 'wb') as f:
+        for data in parts:
+            f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, fname)
+
+    # Make the rename itself durable
+    try:
+        dir_fd = os.open(os.path.dirname(os.path.abspath(fname)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    except OSError:
+        pass
+
+
+class Snapshot:
+    """A snapshot file mapped into memory. Raises ValueError if the file is not
+    a complete snapshot of the current format."""
+
+    def __init__(self, fname):
+        with open(fname, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.mm) < HEADER.size:
+            raise ValueError("Snapshot truncated: " + fname)
+        (magic, version, meta_len, n_dirs, n_children, n_images, n_dates, heap_len,
+            meta_off, dirs_off, children_off, images_off, dates_off, keys_off,
+            heap_off) = HEADER.unpack_from(self.mm)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError("Not a snapshot of format version {}: {}".format(FORMAT_VERSION, fname))
+        if len(self.mm) < heap_off + heap_len:
+            raise ValueError("Snapshot truncated: " + fname)
+
+        self.meta = json.loads(self.mm[meta_off:meta_off+meta_len].decode())
+        self.dirs = np.frombuffer(self.mm, DIR_DTYPE, n_dirs, dirs_off)
+        self.children = np.frombuffer(self.mm, '<u4', n_children, children_off)
+        self.images = np.frombuffer(self.mm, IMAGE_DTYPE, n_images, images_off)
+        self.dates = np.frombuffer(self.mm, '<f8', n_dates, dates_off)
+        self.keys = np.frombuffer(self.mm, '<u8', n_dates, keys_off)
+        self.heap_off = heap_off
+
+    def string(self, offset, length):
+        start = self.heap_off + offset
+        return os.fsdecode(self.mm[start:start+length])
+
+    def dir_paths(self):
+        """Returns the paths of all directory records, in record order"""
+        return [self.string(offset, length) for offset, length in 
+                zip(self.dirs['path'].tolist(), self.dirs['path_len'].tolist())]
+
+    def child_records(self, rec):
+        """Returns the record numbers of the children of a directory record"""
+        first_child, n_children = rec[3], rec[2]
+        return self.children[first_child:first_child+n_children].tolist()
+
+    def image(self, i):
+        """Returns (fname, date, orientation) of image record i"""
+        name, name_len, orientation, pad, date = self.images[i].item()
+        return self.string(name, name_len), date, orientation
@@ -0,0 +1,124 @@
+"""DESCRIPTION: Stress test of Manager.enqueue_pic(). Many threads inject
+pictures at once while a consumer takes them off the queue, woken through
+Manager.on_enqueue the way the prefetcher is. Checks that every picture comes
+out exactly once, that each producer's pictures come out in the order they were
+injected, and reports how long pictures waited in the queue - under the flood,
+and for a single picture injected while the consumer is idle.
+
+Builds a Manager on a small temporary picture library, so no picture
+directories or catalog are touched.
+
+Usage:
+    python enqueue_stress.py"""
+
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from PIL import Image
+
+import config
+
+N_PRODUCERS = 32
+PICS_PER_PRODUCER = 2000
+
+
+def make_manager(tmp):
+    pic_dir = os.path.join(tmp, "pics")
+    os.mkdir(pic_dir)
+    for i in range(3):
+        Image.new('RGB', (64, 48)).save(os.path.join(pic_dir, "{}.jpg".format(i)))
+    config.PIC_DIRS = [pic_dir]
+    config.CATALOG_PATH = os.path.join(tmp, "catalog.db")
+    config.SNAPSHOT_PATH = os.path.join(tmp, "catalog.snap")
+
+    import manager
+    return manager.Manager()
+
+
+if __name__ == "__main__":
+    m = make_manager(tempfile.mkdtemp())
+
+    wake = threading.Event()
+    m.on_enqueue = wake.set
+    enqueued_at = {}
+    received = []
+    latencies = []
+    done = threading.Event()
+
+    def consumer():
+        expected = N_PRODUCERS * PICS_PER_PRODUCER
+        while len(received) < expected:
+            if not wake.wait(5):
+                print("consumer timed out waiting for pictures")
+                break
+            wake.clear()
+            while True:
+                pic = m.take_queued_pic()
+                if pic is None:
+                    break
+                latencies.append(time.perf_counter() - enqueued_at[pic])
+                received.append(pic)
+        done.set()
+
+    def producer(p):
+        for i in range(PICS_PER_PRODUCER):
+            pic = "{}/{}".format(p, i)
+            enqueued_at[pic] = time.perf_counter()
+            m.enqueue_pic(pic)
+
+    consumer_thread = threading.Thread(target=consumer)
+    consumer_thread.start()
+    producers = [threading.Thread(target=producer, args=(p,)) for p in range(N_PRODUCERS)]
+    t_start = time.time()
+    for t in producers:
+        t.start()
+    for t in producers:
+        t.join()
+    done.wait()
+    t_total = time.time() - t_start
+
+    n = N_PRODUCERS * PICS_PER_PRODUCER
+    print("{} producers x {} pictures in {:.2f} sec".format(N_PRODUCERS, PICS_PER_PRODUCER, t_total))
+    print("received: {} of {}, duplicates: {}".format(len(received), n, len(received) - len(set(received))))
+    last = {}
+    in_order = True
+    for pic in received:
+        p, i = (int(x) for x in pic.split("/"))
+        if i <= last.get(p, -1):
+            in_order = False
+        last[p] = i
+    print("per producer order kept: {}".format(in_order))
+    latencies.sort()
+    if latencies:
+        print("queue latency: median {:.3f} ms, max {:.3f} ms".format(
+            1000 * latencies[len(latencies) // 2], 1000 * latencies[-1]))
+
+    # Wake up time of an idle consumer, without the backlog of the flood above
+    idle = []
+    def idle_consumer():
+        for i in range(50):
+            wake.wait()
+            wake.clear()
+            pic = m.take_queued_pic()
+            idle.append(time.perf_counter() - enqueued_at[pic])
+    wake.clear()
+    consumer_thread = threading.Thread(target=idle_consumer)
+    consumer_thread.start()
+    for i in range(50):
+        time.sleep(0.01)
+        enqueued_at["idle"] = time.perf_counter()
+        m.enqueue_pic("idle")
+        while len(idle) <= i:
+            time.sleep(0.001)
+    consumer_thread.join()
+    idle.sort()
+    print("idle wake up latency: median {:.3f} ms, max {:.3f} ms".format(
+        1000 * idle[len(idle) // 2], 1000 * idle[-1]))
+
+    # The play method is still used once the queue is empty
+    print("next pick after the queue drained: {}".format(m.pick_next_pic()))
@@ -0,0 +1,66 @@
+"""DESCRIPTION: Measure the memory used by Image_Directory image records with
+and without config.COMPACT_RECORDS. Builds a synthetic 300k image library
+(no files needed) both ways, and reports the traced allocation size and the
+time taken by a full garbage collection pass. Filenames are generated two ways:
+all unique (worst case for the string table) and camera style, where the
+IMG_xxxx counter wraps every 10000 pictures.
+
+Usage:
+    python memory_benchmark.py"""
+
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import config
+import database
+
+N_DIRS = 10000
+IMAGES_PER_DIR = 30
+
+
+def unique_name(d, i):
+    return "IMG_{:04d}_{}.jpg".format(i, d)
+
+def camera_name(d, i):
+    return "IMG_{:04d}.JPG".format((d * IMAGES_PER_DIR + i) % 10000)
+
+
+def build_library(make_name):
+    dirs = []
+    for d in range(N_DIRS):
+        images = [(make_name(d, i), 1.5e9 + d * 86400.0 + i, 1 + i % 8)
+                  for i in range(IMAGES_PER_DIR)]
+        dirs.append(database.Image_Directory.from_catalog("/media/pi/pics/{:05d}".format(d),
+                                                          0.0, [], 0, images))
+    return dirs
+
+
+def measure(compact, make_name):
+    config.COMPACT_RECORDS = compact
+    database.FILENAMES = database.String_Table()
+    gc.collect()
+
+    tracemalloc.start()
+    dirs = build_library(make_name)
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    t_start = time.time()
+    gc.collect()
+    t_gc = time.time() - t_start
+
+    print("{:>12} names, compact_records={!s:5}: {:6.1f} MB, full gc pass {:5.1f} ms".format(
+        make_name.__name__.split('_')[0], compact, size / 1e6, 1e3 * t_gc))
+    return dirs
+
+
+if __name__ == "__main__":
+    print("{} directories x {} images".format(N_DIRS, IMAGES_PER_DIR))
+    for make_name in (unique_name, camera_name):
+        measure(False, make_name)
+        measure(True, make_name)
@@ -0,0 +1,66 @@
+"""DESCRIPTION: Compare startup load time of the SQLite catalog and the memory
+mapped snapshot. Builds a synthetic 300k image library (no image files needed),
+saves it both ways to a temp directory, and times loading each back. Also
+checks that the snapshot gives back the same images and date index.
+
+Usage:
+    python snapshot_benchmark.py"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import database
+
+N_DIRS = 10000
+IMAGES_PER_DIR = 30
+ROOT = "/media/pi/pics"
+
+
+def build_library():
+    db = database.Image_Database()
+    db.roots = [ROOT]
+    root = database.Image_Directory.from_catalog(ROOT, 0.0, [], 0, [])
+    db.insert_directory(root)
+    for d in range(N_DIRS):
+        path = "{}/{:05d}".format(ROOT, d)
+        root.child_names.append(path)
+        images = [("IMG_{:04d}.JPG".format((d * IMAGES_PER_DIR + i) % 10000),
+                   1.5e9 + random.random() * 1e8, 1 + i % 8) for i in range(IMAGES_PER_DIR)]
+        db.insert_directory(database.Image_Directory.from_catalog(path, 0.0, [], 0, images))
+    return db
+
+
+def timed(label, func, *args):
+    t_start = time.time()
+    result = func(*args)
+    print("{:>16}: {:6.2f} sec".format(label, time.time() - t_start))
+    return result
+
+
+if __name__ == "__main__":
+    print("{} directories x {} images".format(N_DIRS, IMAGES_PER_DIR))
+    db = build_library()
+    tmp = tempfile.mkdtemp()
+    cat_path = os.path.join(tmp, "catalog.db")
+    snap_path = os.path.join(tmp, "catalog.snap")
+
+    timed("catalog save", db.save_database, cat_path)
+    timed("snapshot save", db.save_snapshot, snap_path)
+    print("{:>16}: {:6.1f} MB / {:.1f} MB".format("file sizes",
+        os.path.getsize(cat_path) / 1e6, os.path.getsize(snap_path) / 1e6))
+
+    from_cat = database.Image_Database()
+    timed("catalog load", from_cat.load_database, cat_path)
+    from_snap = database.Image_Database()
+    timed("snapshot load", from_snap.load_snapshot, snap_path)
+
+    expected = [(d.path, i, d.images[i]) for d, i in db.iter_tree()]
+    loaded = [(d.path, i, d.images[i]) for d, i in from_snap.iter_tree()]
+    print("images match: {}".format(expected == loaded))
+    by_date = [(d.path, i) for d, i in db.iter_by_date()]
+    print("date index matches: {}".format(by_date == [(d.path, i) for d, i in from_snap.iter_by_date()]))
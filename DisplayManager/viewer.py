@@ -1,4 +1,6 @@
 import time
+import logging
+import threading
 
 import pi3d
 import config
@@ -9,6 +11,8 @@ from PIL import Image, ExifTags, ImageFilter # these are needed for getting exif
 from pi3d.Texture import MAX_SIZE
 
 import database
+import warm_start
+from prefetch import Prefetcher, Prepared
 # Supporting Enums
 
 class view_state:
@@ -21,6 +25,8 @@ class view_signal:
     PLAY = 0
     PAUSE = 1
     TRANSITION_NOW = 2
+    BACK = 3            # Show the previous picture now
+    FORWARD = 4         # Show the next picture now
 
 viewer_signal = None
 
@@ -56,6 +62,7 @@ class ViewerBase:
         next_pic_ready = False
         
         if self.state == view_state.INIT:
+            self.show_warm_start()
             self.wait_for_manager_ready()
             self.viewer_init()
 
@@ -82,6 +89,14 @@ class ViewerBase:
                     self.display_now()
                     self.state = view_state.DISPLAY
                     self.t_next_pic = t + config.TIME_DELAY
+
+                elif viewer_signal in (view_signal.BACK, view_signal.FORWARD):
+                    # Pictures already shown come from the image cache
+                    if self.step_history(-1 if viewer_signal == view_signal.BACK else 1):
+                        self.display_now()
+                        self.state = view_state.DISPLAY
+                        self.t_next_pic = t + config.TIME_DELAY
+                        next_pic_ready = False
                     
                 viewer_signal = None
                 
@@ -141,8 +156,12 @@ class ViewerBase:
 
     def wait_for_manager_ready(self):
        """Returns when Manager thread is initialized"""
-       while not self.manager.ready:
-           sleep(0.1)
+       self.manager.ready.wait()
+
+    def show_warm_start(self):
+        """Show the picture that was on screen at the last shutdown, if it was
+        saved, while the Manager is still starting up"""
+        raise ValueError("Method should be implemented in child class")
 
     def get_next_pic(self):
         """Retrieve the next picture's path from the manager and prepare it for
@@ -153,6 +172,11 @@ class ViewerBase:
         """Run when Viewer enters INIT state"""
         raise ValueError("Method should be implemented in child class")
 
+    def step_history(self, offset):
+        """Prepare the picture offset places from the current one (e.g. -1 for
+        the previous one) to be displayed now. Return False if there is none"""
+        raise ValueError("Method should be implemented in child class")
+
     def display_now(self):
         """Force a change of pictures now (i.e. skip transition)"""
         raise ValueError("Method should be implemented in child class")
@@ -213,88 +237,98 @@ class ViewerPi3D(ViewerBase):
         self.text_bkg.set_material((0, 0, 0))
 
         # Additional variables
-        self.next_pic = None
+        self.next_pic = None # Prepared picture in sfg, until it goes on screen
         self.alpha = 0.0
         self.delta_alpha = 1.0 / (config.FPS * config.FADE_TIME)
         self.sfg = None
         self.sbg = None
 
+        # Pictures are decoded, oriented and resized ahead of time, off the
+        # render thread
+        max_dimension = MAX_SIZE # TODO changing MAX_SIZE causes serious crash on linux laptop!
+        if not config.AUTO_RESIZE: # turned off for 4K display - will cause issues on RPi before v4
+            max_dimension = 3840 # TODO check if mipmapping should be turned off with this setting.
+        self.prefetcher = Prefetcher(self.manager, (self.DISPLAY.width, self.DISPLAY.height),
+                                     max_dimension, config.PREFETCH_DEPTH, config.PREFETCH_WORKERS,
+                                     config.IMAGE_CACHE_MB * 1000000)
+        self.prefetch_thread = None # Started in viewer_init()
+
     def create_display(self):
         self.DISPLAY = pi3d.Display.create(x=config.DISPLAY_X, y=config.DISPLAY_Y,
               w=config.DISPLAY_W, h=config.DISPLAY_H, frames_per_second=config.FPS,
               display_config=pi3d.DISPLAY_CONFIG_HIDE_CURSOR, background=config.BACKGROUND)
         
     def get_next_pic(self):
-        """Retrieve the next picture's path from the manager and prepare it for
-        display"""
-        im, orientation = self.manager.get_next_pic()
+        """Take the next picture from the prefetch queue, already decoded and 
+        prepared for display, and turn it into a texture"""
+        self.load_texture(self.prefetcher.get(config.TIME_DELAY/2))
+
+    def step_history(self, offset):
+        """Prepare the picture offset places from the current one (e.g. -1 for
+        the previous one) to be displayed now. Return False if there is none"""
+        prepared = self.prefetcher.step(offset)
+        if prepared is None:
+            if offset > 0:
+                # Past the end of the history - just show the next picture now
+                if self.next_pic is None:
+                    self.get_next_pic()
+                return self.next_pic is not None
+            return False
+        # The picture lined up next is shown later rather than skipped
+        if self.next_pic is not None:
+            self.prefetcher.unget(self.next_pic)
+        self.load_texture(prepared)
+        return True
+
+    def load_texture(self, prepared):
+        """Make a texture of a Prepared picture, to be shown next"""
         tex = None
-        
-        orientation = self.get_orientation(im)
-
-        try:
-            # Resize image to fit display? TODO - Figure out what this does...
-            (w, h) = im.size
-            max_dimension = MAX_SIZE # TODO changing MAX_SIZE causes serious crash on linux laptop!
-            if not config.AUTO_RESIZE: # turned off for 4K display - will cause issues on RPi before v4
-                max_dimension = 3840 # TODO check if mipmapping should be turned off with this setting.
-            if w > max_dimension:
-                im = im.resize((max_dimension, int(h * max_dimension / w)), resample=Image.BICUBIC)
-            elif h > max_dimension:
-                im = im.resize((int(w * max_dimension / h), max_dimension), resample=Image.BICUBIC)
-
-            # Fix orientation if needed
-            if orientation == 2:
-                im = im.transpose(Image.FLIP_LEFT_RIGHT)
-            elif orientation == 3:
-                im = im.transpose(Image.ROTATE_180) # rotations are clockwise
-            elif orientation == 4:
-                im = im.transpose(Image.FLIP_TOP_BOTTOM)
-            elif orientation == 5:
-                im = im.transpose(Image.FLIP_LEFT_RIGHT).transpose(Image.ROTATE_270)
-            elif orientation == 6:
-                im = im.transpose(Image.ROTATE_270)
-            elif orientation == 7:
-                im = im.transpose(Image.FLIP_LEFT_RIGHT).transpose(Image.ROTATE_90)
-            elif orientation == 8:
-                im = im.transpose(Image.ROTATE_90)
-
-            # Fill edges with blurred image if configured
-            size = (self.DISPLAY.width, self.DISPLAY.height)
-            if config.BLUR_EDGES:
-                wh_rat = (size[0] * im.size[1]) / (size[1] * im.size[0])
-                if abs(wh_rat - 1.0) > 0.01: # make a blurred background
-                    (sc_b, sc_f) = (size[1] / im.size[1], size[0] / im.size[0])
-                    if wh_rat > 1.0:
-                        (sc_b, sc_f) = (sc_f, sc_b) # swap round
-                    (w, h) =  (round(size[0] / sc_b / BLUR_ZOOM), round(size[1] / sc_b / BLUR_ZOOM))
-                    (x, y) = (round(0.5 * (im.size[0] - w)), round(0.5 * (im.size[1] - h)))
-                    box = (x, y, x + w, y + h)
-                    blr_sz = (int(x * 512 / size[0]) for x in size)
-                    im_b = im.resize(size, resample=0, box=box).resize(blr_sz)
-                    im_b = im_b.filter(ImageFilter.GaussianBlur(BLUR_AMOUNT))
-                    im_b = im_b.resize(size, resample=Image.BICUBIC)
-                    im_b.putalpha(round(255 * EDGE_ALPHA))  # to apply the same EDGE_ALPHA as the no blur method.
-                    im = im.resize((int(x * sc_f) for x in im.size), resample=Image.BICUBIC)
-                    im_b.paste(im, box=(round(0.5 * (im_b.size[0] - im.size[0])),
-                                        round(0.5 * (im_b.size[1] - im.size[1]))))
-                    im = im_b # have to do this as paste applies in place
-
-            # Create pi3D texture object from image object
-            tex = pi3d.Texture(im, blend=True, m_repeat=True, automatic_resize=config.AUTO_RESIZE,
-                            free_after_load=True)
-
-        except Exception as e:
-            if config.VERBOSE:
-                print('''Couldn't load file {} giving error: {}'''.format(fname, e))
-            tex = None
+        if prepared is not None:
+            try:
+                # Create pi3D texture object from image object
+                tex = pi3d.Texture(prepared.image, blend=True, m_repeat=True, automatic_resize=config.AUTO_RESIZE,
+                                free_after_load=True)
+            except Exception as e:
+                if config.VERBOSE:
+                    print("Couldn't create texture giving error: {}".format(e))
+                tex = None
+                prepared = None
 
         # TODO - what to do if tex is None?
         self.sbg = self.sfg
         self.sfg = tex
+        self.next_pic = prepared
+
+    def show_warm_start(self):
+        """Show the picture that was on screen at the last shutdown, if it was
+        saved, while the Manager is still starting up"""
+        if not config.WARM_START_PATH:
+            return
+        current, upcoming = warm_start.load(config.WARM_START_PATH)
+        self.prefetcher.restore(upcoming)
+        if current is None or current[2] is None:
+            return
+
+        prepared = Prepared(*current, None)
+        self.prefetcher.cache.put(prepared.path, prepared.image)
+        self.load_texture(prepared)
+        if self.sfg is None:
+            return
+        self.update_slide(self.sfg)
+        self.alpha = 1.0
+        self.step_transition()
+        # pi3d shows a frame on the loop_running() call after it is drawn
+        self.display_running()
+        self.draw_slide()
+        self.display_running()
 
     def viewer_init(self):
         """Run when Viewer enters INIT state"""
+        self.prefetch_thread = threading.Thread(target=self.prefetcher.run, name="Prefetcher", daemon=True)
+        self.prefetch_thread.start()
+        if self.prefetcher.on_screen is not None:
+            return # Carrying on from the warm start picture
+
         self.get_next_pic()
         if self.sfg is None:
             print("\n\nERROR - sfg is none\n\n")
@@ -309,6 +343,9 @@ class ViewerPi3D(ViewerBase):
             self.sbg = sfg
 
         self.slide.set_textures([self.sfg, self.sbg])
+        if self.next_pic is not None:
+            self.prefetcher.shown(self.next_pic)
+            self.next_pic = None
         self.slide.unif[45:47] = self.slide.unif[42:44] # transfer front width and height factors to back
         self.slide.unif[51:53] = self.slide.unif[48:50] # transfer front width and height offsets
 
@@ -361,19 +398,20 @@ class ViewerPi3D(ViewerBase):
 
     def cleanup(self):
         """Clean up any resources on Viewer exit"""
+        self.prefetcher.kill()
+        if config.WARM_START_PATH:
+            # No more picks once the prefetch thread is done, so what is
+            # saved follows on from the Manager's saved play state
+            if self.prefetch_thread is not None:
+                self.prefetch_thread.join(1.0)
+            if self.next_pic is not None:
+                self.prefetcher.unget(self.next_pic)
+            try:
+                self.prefetcher.save_warm_start(config.WARM_START_PATH, config.WARM_START_IMAGES)
+            except Exception as e:
+                logging.error("Could not save warm start pictures: {}".format(e))
         self.DISPLAY.destroy()
 
-    def get_orientation(self, im):
-        orientation = 1
-        try:
-            exif_data = im._getexif()
-            if database.EXIF_ORIENTATION in exif_data:
-                orientation = int(exif_data[database.EXIF_ORIENTATION])
-        except Exception as e:
-            print(e)
-        
-        return orientation
-                
     @staticmethod
     def get_exif_info(file_path_name, im=None):
         dt = os.path.getmtime(file_path_name) # so use file last modified date
@@ -431,7 +469,7 @@ class ViewerPi3D(ViewerBase):
 Signals
 1. Play/Pause
 2. Forward/Backward 1 picture
-    - Signal Viewer to transition now
+    - view_signal.FORWARD/BACK. Pictures come from the history and the prefetcher's image cache
 3. To beginning/end of playlist. To next/previous playlist.
     - Update manager. Signal Viewer to transition now
 4. Start new playlist (user selects new playlist to play now)
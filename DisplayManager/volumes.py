@@ -0,0 +1,71 @@
+import os
+
+"""Helpers to identify the volume (disk partition) a picture root lives on.
+
+Removable drives are mounted under /media/pi/<label or UUID> while plugged in.
+When unplugged, the mount point may disappear, or be left behind as an empty
+directory on the SD card. Either way the catalogued entries for that root must
+not be thrown away, so Image_Database records which volume each root was
+scanned from and only treats the root as available while that volume is mounted.
+"""
+
+BY_UUID = '/dev/disk/by-uuid'
+
+def find_mount_point(path):
+    path = os.path.realpath(path)
+    while not os.path.ismount(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+def mount_entry(mount_point):
+    """Returns (device, filesystem type) mounted at mount_point according to 
+    /proc/self/mounts, or (None, None)"""
+    entry = (None, None)
+    try:
+        with open('/proc/self/mounts') as f:
+            for line in f:
+                fields = line.split()
+                # Spaces etc. in mount points are octal escaped
+                mnt = fields[1].encode().decode('unicode_escape')
+                if mnt == mount_point:
+                    entry = (fields[0], fields[2]) # Later mounts hide earlier ones
+    except OSError:
+        pass
+    return entry
+
+def mounted_device(mount_point):
+    """Returns the device mounted at mount_point according to /proc/self/mounts,
+    or None"""
+    return mount_entry(mount_point)[0]
+
+def filesystem_type(path):
+    """Returns the type of the filesystem holding path (e.g. 'ext4', 'nfs4',
+    'fuse.sshfs'), or None"""
+    return mount_entry(find_mount_point(path))[1]
+
+def device_uuid(device):
+    """Returns the filesystem UUID of a block device, or None"""
+    try:
+        real = os.path.realpath(device)
+        for uuid in os.listdir(BY_UUID):
+            if os.path.realpath(os.path.join(BY_UUID, uuid)) == real:
+                return uuid
+    except OSError:
+        pass
+    return None
+
+def get_volume_id(path):
+    """Returns an id for the volume holding path: the filesystem UUID where there
+    is one, otherwise device and mount point (e.g. network shares). Returns None
+    if path is not an existing directory."""
+    if not os.path.isdir(path):
+        return None
+    mount_point = find_mount_point(path)
+    device = mounted_device(mount_point)
+    uuid = device_uuid(device) if device is not None and device.startswith('/dev/') else None
+    if uuid is not None:
+        return uuid
+    return "{}:{}".format(device, mount_point)
@@ -0,0 +1,74 @@
+import os
+import json
+import shutil
+import logging
+
+from PIL import Image
+
+"""Warm restart: the pictures on screen and next in line, kept across a reboot.
+
+At shutdown the Viewer's Prefetcher saves the picture on screen and those it
+has picked to show next, in order, into a directory (config.WARM_START_PATH).
+The first few are saved as the display-size images they were prepared as, so
+at the next start the picture that was on screen can be shown at once, before
+the Manager is ready and without decoding anything. The rest are saved by path
+and prepared again.
+
+The Manager saves the position of its play method and its queue with the play
+state in the catalog. Its picks at shutdown already include the pictures saved
+here, so the slideshow carries on with the same sequence.
+
+The directory is emptied when it is read, so a warm start is only made from a
+clean shutdown - after a crash, whatever was saved before is stale.
+"""
+
+MANIFEST = 'warm.json'
+
+def save(path, current, upcoming, n_images):
+    """Save the Prepared pictures current (on screen, or None) and upcoming (in
+    play order). Images are saved for the first n_images of them."""
+    entries = []
+    clear(path)
+    os.makedirs(path, exist_ok=True)
+    pics = ([] if current is None else [current]) + list(upcoming)
+    for i, prepared in enumerate(pics):
+        entry = {'path' : prepared.path, 'orientation' : prepared.orientation, 'image' : None}
+        if i < n_images and prepared.image is not None:
+            entry['image'] = "{}.png".format(i)
+            # Fast compression - these are written on the way down
+            prepared.image.save(os.path.join(path, entry['image']), compress_level=1)
+        entries.append(entry)
+    with open(os.path.join(path, MANIFEST), 'w') as f:
+        json.dump({'current' : current is not None, 'pictures' : entries}, f)
+
+def load(path):
+    """Returns (current, upcoming) as saved by save(). current is a
+    (path, orientation, image) tuple or None, upcoming a list of them, image
+    None where it has to be prepared again. The saved files are removed."""
+    try:
+        with open(os.path.join(path, MANIFEST)) as f:
+            manifest = json.load(f)
+        pics = []
+        for entry in manifest['pictures']:
+            im = None
+            if entry['image'] is not None:
+                try:
+                    with Image.open(os.path.join(path, entry['image'])) as saved:
+                        im = saved.copy()
+                except OSError as e:
+                    logging.warning("Warm start image of {} not loaded: {}".format(entry['path'], e))
+            pics.append((entry['path'], entry['orientation'], im))
+    except FileNotFoundError:
+        return None, []
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logging.warning("Warm start data in {} not used: {}".format(path, e))
+        return None, []
+    finally:
+        clear(path)
+
+    if manifest['current'] and pics:
+        return pics[0], pics[1:]
+    return None, pics
+
+def clear(path):
+    shutil.rmtree(path, ignore_errors=True)
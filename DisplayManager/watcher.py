@@ -0,0 +1,313 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import time
+
+import config
+from database import IMAGE_EXTENSIONS
+from volumes import filesystem_type
+
+"""Filesystem watcher that keeps Image_Database in sync with the picture roots.
+
+On Linux every directory in the database gets an inotify watch. When a file or
+subdirectory is added, removed or renamed, the directory it lives in is
+rescanned with Image_Database.rescan_directory, which reuses the metadata of
+images that are still present and adds/removes whole subtrees as needed.
+
+inotify doesn't see changes made on the far side of a network or FUSE mount, 
+and the kernel limits the number of watches per user. Roots like that are 
+polled every POLL_TM instead (Image_Database.refresh - one stat() per 
+directory, no listings), as are all roots if inotify isn't available. Roots 
+inotify covers aren't polled. After an event queue overflow, when events may
+have been lost, all roots are checked once.
+
+Roots on removable drives come and go. Every VOLUME_CHECK_PERIOD the watcher
+checks that each root's volume is still mounted (Image_Database.check_volumes).
+A root that disappears is set offline with its entries kept, and when it comes
+back only the directories whose mtime changed meanwhile are re-listed.
+"""
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ONLYDIR     = 0x01000000
+IN_ISDIR       = 0x40000000
+IN_NONBLOCK    = 0o4000
+IN_CLOEXEC     = 0o2000000
+
+# Filesystems whose changes may be made elsewhere, out of sight of inotify.
+# FUSE mounts too, except fuseblk (local drives, e.g. NTFS).
+REMOTE_FILESYSTEMS = ('nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'ncpfs', 'afs', '9p',
+                      'ceph', 'glusterfs', 'davfs', 'fuse')
+
+def is_remote_filesystem(fstype):
+    if fstype is None or fstype == 'fuseblk':
+        return False
+    return fstype in REMOTE_FILESYSTEMS or fstype.startswith('fuse.')
+
+# A new file is only interesting once it has been completely written (or moved
+# in), but new directories need to be picked up (and watched) as soon as they
+# are created. IN_CREATE can't be asked for directories only, so it is ignored
+# for files when events are handled.
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+              IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class Inotify:
+    """Minimal ctypes binding to the Linux inotify API"""
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+    def add_watch(self, path, mask):
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), path)
+        return wd
+
+    def rm_watch(self, wd):
+        self._rm_watch(self.fd, wd)
+
+    def read_events(self):
+        """Returns a list of (wd, mask, name) for all queued events"""
+        events = []
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return events
+            pos = 0
+            while pos < len(buf):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(buf, pos)
+                pos += EVENT_HEADER.size
+                name = os.fsdecode(buf[pos:pos+length].rstrip(b'\0'))
+                pos += length
+                events.append((wd, mask, name))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Directory_Watcher:
+    # Class Constants
+    SETTLE_TIME = 0.3 # sec to wait for more events before rescanning, so a burst of copies costs one rescan
+    VOLUME_CHECK_PERIOD = 5.0 # sec between checks for picture roots being unplugged/plugged in
+
+    def __init__(self, pic_db):
+        self.alive = True
+        self.pic_db = pic_db
+
+        self.inotify = None
+        self.wd_paths = {}   # wd : directory path
+        self.path_wds = {}   # directory path : wd
+        self.watch_limit_hit = False
+        self.unwatched_roots = set() # Roots with directories left without a watch by the watch limit
+
+        # Called with the list of rescanned directory paths after each update
+        self.on_change = None
+
+    def kill(self):
+        self.alive = False
+
+    def run(self):
+        try:
+            self.inotify = Inotify()
+        except (OSError, AttributeError) as e:
+            logging.warning("inotify not available ({}). Polling picture directories every {} sec".format(
+                e, config.POLL_TM))
+
+        if self.inotify is not None:
+            t_start = time.time()
+            for root in list(self.pic_db.roots):
+                self.watch_subtree(root)
+            logging.info("Watching {} directories for changes (set up in {:.1f} sec)".format(
+                len(self.path_wds), time.time()-t_start))
+            polled = self.polled_roots()
+            if polled:
+                logging.info("Polling picture roots inotify doesn't cover every {} sec: {}".format(
+                    config.POLL_TM, ", ".join(polled)))
+
+        t_next_poll = time.time() + config.POLL_TM if config.POLL_TM > 0 else float("inf")
+        t_next_volume_check = time.time() + self.VOLUME_CHECK_PERIOD
+        while self.alive:
+            timeout = max(0.0, min(1.0, t_next_poll - time.time()))
+            if self.inotify is not None:
+                ready, _, _ = select.select([self.inotify.fd], [], [], timeout)
+                if ready:
+                    self.handle_events()
+            else:
+                time.sleep(timeout)
+
+            if time.time() >= t_next_poll:
+                self.poll()
+                t_next_poll = time.time() + config.POLL_TM
+
+            if time.time() >= t_next_volume_check:
+                self.check_volumes()
+                t_next_volume_check = time.time() + self.VOLUME_CHECK_PERIOD
+
+        if self.inotify is not None:
+            self.inotify.close()
+
+    def handle_events(self):
+        """Collect events until things settle down, then rescan each affected
+        directory once"""
+        events = self.inotify.read_events()
+        t_settle = time.time() + self.SETTLE_TIME
+        while self.alive and time.time() < t_settle:
+            ready, _, _ = select.select([self.inotify.fd], [], [], t_settle - time.time())
+            if ready:
+                events += self.inotify.read_events()
+
+        dirty = set()
+        overflow = False
+        for wd, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+                continue
+            path = self.wd_paths.get(wd)
+            if path is None or not self.pic_db.is_online(path):
+                continue
+            if mask & IN_IGNORED:
+                # Watch removed by the kernel, e.g. the directory was deleted
+                self.wd_paths.pop(wd, None)
+                self.path_wds.pop(path, None)
+            elif mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                if mask & IN_MOVE_SELF:
+                    self.unwatch_subtree(path)
+                dirty.add(os.path.dirname(path))
+            elif mask & IN_MOVED_FROM and mask & IN_ISDIR:
+                # The watches stay with the moved directories, so they would 
+                # report under the old paths - and a new directory made at an
+                # old path would never get a watch
+                self.unwatch_subtree(os.path.join(path, name))
+                dirty.add(path)
+            elif mask & IN_CREATE and not mask & IN_ISDIR:
+                continue # Still being written - IN_CLOSE_WRITE follows
+            elif mask & IN_ISDIR or os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                dirty.add(path)
+
+        if overflow:
+            logging.warning("inotify event queue overflowed. Checking all picture directories.")
+            self.poll(all_roots=True)
+            return
+
+        # Parents first, so new subtrees are in the database before their
+        # own events are looked at
+        rescanned = []
+        for path in sorted(dirty, key=len):
+            if path in self.pic_db:
+                self.pic_db.rescan_directory(path)
+                rescanned.append(path)
+                self.watch_subtree(path)
+
+        if rescanned:
+            logging.info("Picture directories changed: {}".format(", ".join(rescanned)))
+            if self.on_change is not None:
+                self.on_change(rescanned)
+
+    def polled_roots(self):
+        """Roots whose changes inotify may miss: all of them without inotify,
+        otherwise those on network or FUSE mounts, and those the watch limit
+        left directories of without a watch"""
+        roots = [r for r in self.pic_db.roots if self.pic_db.is_online(r)]
+        if self.inotify is None:
+            return roots
+        return [r for r in roots if r in self.unwatched_roots or is_remote_filesystem(filesystem_type(r))]
+
+    def poll(self, all_roots=False):
+        """Fallback check of the mtime of every directory under the roots 
+        inotify doesn't cover, or under all roots"""
+        if all_roots:
+            roots = [r for r in self.pic_db.roots if self.pic_db.is_online(r)]
+        else:
+            roots = self.polled_roots()
+        if not roots:
+            return
+        t_start = time.time()
+        n_rescanned = self.pic_db.refresh(roots)
+        logging.info("Polled {} picture roots in {:.1f} sec, {} directories changed".format(
+            len(roots), time.time()-t_start, n_rescanned))
+        # Watches for new directories, and ones the watch limit kept out before
+        for root in roots:
+            self.watch_subtree(root)
+        if n_rescanned and self.on_change is not None:
+            self.on_change([])
+
+    def check_volumes(self):
+        """Set roots whose drive was unplugged offline, and revalidate the ones
+        that were plugged back in"""
+        returned = self.pic_db.check_volumes()
+        for root in returned:
+            t_start = time.time()
+            n_rescanned = self.pic_db.revalidate_root(root)
+            logging.info("Picture root {} is available again. {} directories rescanned in {:.1f} sec".format(
+                root, n_rescanned, time.time()-t_start))
+            self.watch_subtree(root)
+        if returned and self.on_change is not None:
+            self.on_change([])
+
+    def watch_subtree(self, path):
+        """Add watches for path and any directories below it that aren't watched
+        yet. A root left with directories without a watch is polled until they
+        all have one."""
+        if self.inotify is None or not self.pic_db.is_online(path):
+            return
+        root = self.pic_db.root_of(path)
+        stack = [path]
+        while stack:
+            directory = stack.pop()
+            img_dir = self.pic_db.get(directory)
+            if img_dir is None:
+                continue
+            if directory not in self.path_wds:
+                try:
+                    wd = self.inotify.add_watch(directory, WATCH_MASK)
+                    self.wd_paths[wd] = directory
+                    self.path_wds[directory] = wd
+                except OSError as e:
+                    if e.errno == errno.ENOSPC:
+                        if not self.watch_limit_hit:
+                            logging.warning("inotify watch limit reached. Directories without a "
+                                "watch are only checked by polling. Raise fs.inotify.max_user_watches")
+                        self.watch_limit_hit = True
+                        if root is not None:
+                            self.unwatched_roots.add(root)
+                        return
+                    continue
+            stack.extend(img_dir.child_names)
+        if path == root:
+            self.unwatched_roots.discard(root)
+
+    def unwatch_subtree(self, path):
+        """Remove the watches of path and the directories below it, e.g. once
+        it has been moved away. The rescan of its new location (if that is 
+        under a root) watches it again under its new path."""
+        prefix = path + os.sep
+        for directory in [d for d in self.path_wds if d == path or d.startswith(prefix)]:
+            wd = self.path_wds.pop(directory)
+            self.wd_paths.pop(wd, None)
+            self.inotify.rm_watch(wd)
+